@@ -0,0 +1,153 @@
+"""Fixtures of the benchmark suite: an offscreen main window and synthetic micrographs and results"""
+
+import os
+import time
+
+# must be set before Qt and matplotlib are imported
+os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+os.environ.setdefault('MPLBACKEND', 'Agg')
+
+import numpy as np
+import PIL.Image
+import pytest
+from PyQt5 import QtCore, QtWidgets
+
+IMAGE_SIZES = [512, 2048, 8192]
+STACK_FRAMES = 8
+CIRCLE_COUNTS = [100, 1000, 10000, 100000]
+PIXELSIZE = 0.5
+
+
+def syntheticMicrograph(size: int, seed: int = 0) -> np.ndarray:
+    """Dark particles of 20-40 pixels diameter on a noisy background, covering about 10 % of the area"""
+    rng = np.random.default_rng(seed)
+    image = rng.normal(200, 10, (size, size)).astype(np.float32)
+    ncircles = int(0.1 * size * size / (np.pi * 15 ** 2))
+    for x, y, d in zip(rng.uniform(20, size - 20, ncircles), rng.uniform(20, size - 20, ncircles),
+                       rng.uniform(20, 40, ncircles)):
+        r0, c0 = int(y - d / 2) - 1, int(x - d / 2) - 1
+        rows, cols = np.ogrid[r0:r0 + int(d) + 3, c0:c0 + int(d) + 3]
+        patch = image[r0:r0 + int(d) + 3, c0:c0 + int(d) + 3]
+        patch[(cols - x) ** 2 + (rows - y) ** 2 < (d / 2) ** 2] -= 140
+    return np.clip(image, 0, 65535).astype(np.uint16)
+
+
+def syntheticResults(count: int, seed: int = 0, imagesize: int = 2048) -> np.ndarray:
+    """Circles (x, y, diameter in nm) scattered over an image of `imagesize` pixels"""
+    rng = np.random.default_rng(seed)
+    return np.stack([rng.uniform(0, imagesize * PIXELSIZE, count), rng.uniform(0, imagesize * PIXELSIZE, count),
+                     rng.normal(15, 2, count)], axis=1)
+
+
+@pytest.fixture(scope='session')
+def micrographs(tmp_path_factory):
+    """Uncompressed TIFF files of each size, each in its own directory (thus nothing is prefetched)"""
+    files = {}
+    for size in IMAGE_SIZES:
+        dirname = tmp_path_factory.mktemp(f'micrograph{size}')
+        filename = str(dirname / f'micrograph{size}.tif')
+        PIL.Image.fromarray(syntheticMicrograph(size)).save(filename)
+        files[size] = filename
+    return files
+
+
+@pytest.fixture(scope='session')
+def imagestack(tmp_path_factory):
+    """An uncompressed multi-page TIFF file of 2048x2048 frames"""
+    filename = str(tmp_path_factory.mktemp('imagestack') / 'imagestack.tif')
+    frames = [PIL.Image.fromarray(syntheticMicrograph(2048, seed)) for seed in range(STACK_FRAMES)]
+    frames[0].save(filename, save_all=True, append_images=frames[1:])
+    return filename
+
+
+def removeJournal(filename: str):
+    for fn in [filename, filename + '.lock', filename + '.tmp']:
+        try:
+            os.remove(fn)
+        except OSError:
+            pass
+
+
+@pytest.fixture(scope='session')
+def qapp():
+    # the session journal of the benchmarks is kept in the test location (~/.qttest), away from that of the user
+    QtCore.QStandardPaths.setTestModeEnabled(True)
+    app = QtWidgets.QApplication.instance() or QtWidgets.QApplication([])
+    yield app
+
+
+@pytest.fixture(scope='session')
+def mainwindow(qapp):
+    from tem_circlefind.tem_circlefind import TEMCircleFind
+    journal = os.path.join(QtCore.QStandardPaths.writableLocation(QtCore.QStandardPaths.AppLocalDataLocation),
+                           'session.journal')
+    # neither restore the session of an interrupted run nor leave this one behind
+    removeJournal(journal)
+    window = TEMCircleFind()
+    yield window
+    window.close()
+    removeJournal(journal)
+
+
+@pytest.fixture
+def window(mainwindow, qapp, micrographs):
+    """The main window showing the 2048x2048 micrograph, with no results, pending clicks or undo history"""
+    mainwindow.resultsModel.clear()
+    mainwindow.pendingClicksModel.clear()
+    # the models are changed directly by the benchmarks, not through the undo stack
+    mainwindow.undoStack.clear()
+    mainwindow.resultsModel.setPixelSize(PIXELSIZE)
+    if getattr(mainwindow, 'source', None) is None or mainwindow.source.filename != micrographs[2048]:
+        loadImage(qapp, mainwindow, micrographs[2048])
+    processEvents(qapp)
+    return mainwindow
+
+
+def processEvents(qapp, duration: float = 0.0):
+    """Process Qt events, including those posted by timers in the next `duration` seconds"""
+    t0 = time.monotonic()
+    while True:
+        qapp.processEvents()
+        if time.monotonic() - t0 >= duration:
+            break
+        time.sleep(0.005)
+
+
+def waitForImage(qapp, window, filename: str, timeout: float = 60):
+    t0 = time.monotonic()
+    while time.monotonic() - t0 < timeout:
+        qapp.processEvents()
+        source = getattr(window, 'source', None)
+        if source is not None and source.filename == filename:
+            return
+        time.sleep(0.001)
+    raise TimeoutError(f'Image {filename} not loaded in {timeout} seconds')
+
+
+def loadImage(qapp, window, filename: str):
+    window.loadImage(filename)
+    waitForImage(qapp, window, filename)
+
+
+def detectCircles(qapp, window, timeout: float = 60):
+    """Detect circles and wait for the results (detection runs in the background)"""
+    window.detectCircles()
+    waitForDetection(qapp, window, timeout)
+
+
+def waitForDetection(qapp, window, timeout: float = 60):
+    t0 = time.monotonic()
+    while not window.detectPushButton.isEnabled():
+        if time.monotonic() - t0 > timeout:
+            raise TimeoutError(f'Circle detection not finished in {timeout} seconds')
+        qapp.processEvents()
+        time.sleep(0.001)
+
+
+def checkBudget(benchmark, seconds: float):
+    """Absolute regression threshold: the median time of a benchmark must not exceed `seconds`"""
+    if benchmark.stats is None:
+        # benchmarks disabled (--benchmark-disable): the function has been run once
+        return
+    median = benchmark.stats.stats.median
+    assert median <= seconds, f'Median time {median * 1000:.1f} ms exceeds the budget of {seconds * 1000:.1f} ms'
@@ -0,0 +1,72 @@
+"""Automatic circle detection: accuracy on a synthetic micrograph with known particles"""
+
+import numpy as np
+import pytest
+
+from conftest import detectCircles, loadImage, waitForDetection
+from tem_circlefind.circledetection import findCircles
+
+# pixels
+POSITION_TOLERANCE = 1.5
+DIAMETER_TOLERANCE = 1.5
+
+
+def knownParticles(size: int = 512, seed: int = 1):
+    """Dark particles of 20-50 pixels diameter on a noisy background, one in each cell of a 128 pixel grid. Returns
+    the image and the rows of x, y, diameter of the particles."""
+    rng = np.random.default_rng(seed)
+    image = rng.normal(200, 10, (size, size)).astype(np.float32)
+    rows, cols = np.ogrid[:size, :size]
+    particles = []
+    for x0 in range(64, size, 128):
+        for y0 in range(64, size, 128):
+            x, y, d = x0 + rng.uniform(-10, 10), y0 + rng.uniform(-10, 10), rng.uniform(20, 50)
+            image[(cols - x) ** 2 + (rows - y) ** 2 < (d / 2) ** 2] -= 140
+            particles.append((x, y, d))
+    return image, np.array(particles)
+
+
+@pytest.mark.parametrize('polarity', ['dark', 'both'])
+def test_accuracy(polarity):
+    """Every particle is found, and the best scoring detections are the particles"""
+    image, particles = knownParticles()
+    circles = findCircles(image, 15, 60, polarity=polarity)
+    assert len(circles) >= len(particles)
+    # sorted by decreasing score
+    best = circles[:len(particles)]
+    distances = np.hypot(best[:, np.newaxis, 0] - particles[:, 0], best[:, np.newaxis, 1] - particles[:, 1])
+    matches = distances.argmin(axis=1)
+    assert sorted(matches) == list(range(len(particles)))
+    assert distances.min(axis=1).max() <= POSITION_TOLERANCE
+    assert np.abs(best[:, 2] - particles[matches, 2]).max() <= DIAMETER_TOLERANCE
+
+
+def test_polarity():
+    """Bright particles are found when looking for bright ones only"""
+    image, particles = knownParticles()
+    inverted = 400 - image
+    assert len(findCircles(inverted, 15, 60, polarity='bright')) >= len(particles)
+    assert not len(findCircles(inverted, 15, 60, polarity='dark'))
+
+
+def test_background(window, qapp):
+    """Detection runs in the background, with the button disabled, and adds the circles as one undo step"""
+    window.detectCircles()
+    assert not window.detectPushButton.isEnabled()
+    assert window.resultsModel.rowCount() == 0
+    waitForDetection(qapp, window)
+    assert window.resultsModel.rowCount() > 0
+    assert window.undoStack.count() == 1
+    window.undoStack.undo()
+    assert window.resultsModel.rowCount() == 0
+
+
+def test_otherFrame(window, qapp, imagestack):
+    """Circles found on a frame no longer shown are dropped"""
+    loadImage(qapp, window, imagestack)
+    window.detectCircles()
+    window.frameSpinBox.setValue(1)
+    window.showFrame()
+    waitForDetection(qapp, window)
+    assert window.resultsModel.rowCount() == 0
+    assert window.undoStack.count() == 0
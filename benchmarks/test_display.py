@@ -0,0 +1,77 @@
+"""Correctness of the conversion to display data"""
+
+import numpy as np
+import pytest
+
+from tem_circlefind.display import DisplayPipeline
+from tem_circlefind.imagesource import ImagePyramid
+
+
+@pytest.fixture
+def ramp() -> np.ndarray:
+    return np.add.outer(np.arange(300), np.arange(400)).astype(np.uint16) + 1000
+
+
+def test_settings(ramp):
+    pipeline = DisplayPipeline(ImagePyramid(ramp, tilesize=128))
+    assert not pipeline.setSettings(contrast='percentile')
+    assert pipeline.setSettings(contrast='minmax')
+    assert pipeline.settings['contrast'] == 'minmax'
+    with pytest.raises(TypeError):
+        pipeline.setSettings(gamma=2.0)
+    with pytest.raises(ValueError):
+        pipeline.setSettings(contrast='log')
+    assert pipeline.settings['contrast'] == 'minmax'
+
+
+@pytest.mark.parametrize('dtype', [np.uint16, np.float32])
+def test_minmax(ramp, dtype):
+    """The full range of the pixel values is mapped linearly to 0-255"""
+    data = ramp.astype(dtype)
+    pipeline = DisplayPipeline(ImagePyramid(data, tilesize=128), maxsamples=data.size, contrast='minmax')
+    values, display = pipeline.mapping()
+    assert values.tolist() == [data.min(), data.max()]
+    converted = pipeline.convert(0, 0, 300, 0, 400)
+    assert converted.dtype == np.uint8
+    assert converted[0, 0] == 0 and converted[-1, -1] == 255
+    expected = np.round((data.astype(np.float64) - data.min()) * 255 / np.ptp(data))
+    assert np.abs(converted - expected).max() <= 1
+
+
+def test_percentile(ramp):
+    """Values outside the percentiles are saturated"""
+    pipeline = DisplayPipeline(ImagePyramid(ramp, tilesize=128), maxsamples=ramp.size, low=10, high=90)
+    low, high = np.percentile(ramp, [10, 90])
+    converted = pipeline.convert(0, 0, 300, 0, 400)
+    assert (converted[ramp <= low] == 0).all()
+    assert (converted[ramp >= high] == 255).all()
+
+
+def test_equalize(ramp):
+    """After histogram equalization, the display values are roughly uniformly distributed"""
+    pipeline = DisplayPipeline(ImagePyramid(ramp.astype(np.float32) ** 2, tilesize=128), maxsamples=ramp.size,
+                               contrast='equalize')
+    counts = np.bincount(pipeline.convert(0, 0, 300, 0, 400).ravel() // 64, minlength=4)
+    assert counts == pytest.approx(np.full(4, ramp.size / 4), rel=0.1)
+
+
+def test_caching(ramp):
+    """Tiles are converted once, and again only after a change of the settings"""
+    pipeline = DisplayPipeline(ImagePyramid(ramp, tilesize=128), contrast='minmax')
+    first = pipeline.convert(0, 0, 100, 0, 100)
+    assert pipeline._converted[0].tolist() == [[True, False, False, False], [False] * 4, [False] * 4]
+    buffer = pipeline._buffers[0]
+    assert np.shares_memory(pipeline.convert(0, 10, 50, 20, 60), buffer)
+    assert np.array_equal(pipeline.convert(0, 10, 50, 20, 60), first[10:50, 20:60])
+    pipeline.setSettings(contrast='minmax')
+    assert pipeline._buffers[0] is buffer
+    pipeline.setSettings(contrast='percentile')
+    assert pipeline._buffers[0] is None
+    assert not np.array_equal(pipeline.convert(0, 0, 100, 0, 100), first)
+
+
+def test_constant():
+    """A constant image does not give a division by zero"""
+    pipeline = DisplayPipeline(ImagePyramid(np.full((64, 64), 7.0, dtype=np.float32)), contrast='minmax')
+    converted = pipeline.convert(0, 0, 64, 0, 64)
+    assert (converted == converted[0, 0]).all()
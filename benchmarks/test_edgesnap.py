@@ -0,0 +1,45 @@
+"""Correctness of the edge snapping"""
+
+import numpy as np
+import pytest
+
+from tem_circlefind.edgesnap import EdgeSnapper
+
+CENTRE = (100.3, 90.7)
+RADIUS = 30.0
+
+
+@pytest.fixture(scope='module')
+def disk() -> np.ndarray:
+    """A dark disk on a bright background, with an antialiased edge"""
+    rows, cols = np.indices((200, 220), dtype=np.float64)
+    distance = np.hypot(cols - CENTRE[0], rows - CENTRE[1])
+    return 200 * np.clip(distance - RADIUS + 0.5, 0, 1).astype(np.float32) + 20
+
+
+@pytest.mark.parametrize('offset', [-3.0, -1.0, 1.0, 3.0])
+def test_snap(disk, offset):
+    """Clicks near the edge are moved onto it"""
+    snapper = EdgeSnapper(disk)
+    for angle in np.linspace(0, 2 * np.pi, 16, endpoint=False):
+        x = CENTRE[0] + (RADIUS + offset) * np.cos(angle)
+        y = CENTRE[1] + (RADIUS + offset) * np.sin(angle)
+        sx, sy = snapper.snap(x, y)
+        assert np.hypot(sx - CENTRE[0], sy - CENTRE[1]) == pytest.approx(RADIUS, abs=0.5)
+        # along the normal of the edge, not sideways
+        assert np.hypot(sx - x, sy - y) < abs(offset) + 1
+
+
+def test_unchanged(disk):
+    """Points outside the image, or without an edge nearby, are not moved"""
+    snapper = EdgeSnapper(disk)
+    assert snapper.snap(-5.0, 10.0) == (-5.0, 10.0)
+    assert snapper.snap(10.0, 500.0) == (10.0, 500.0)
+    assert EdgeSnapper(np.ones((50, 50))).snap(20.2, 30.7) == (20.2, 30.7)
+
+
+def test_tiles(disk):
+    """The gradients do not depend on the tiling"""
+    whole = EdgeSnapper(disk, tilesize=256).gradients(0, 200, 0, 220)
+    tiled = EdgeSnapper(disk, tilesize=32, maxtiles=4).gradients(0, 200, 0, 220)
+    assert np.allclose(whole, tiled, atol=1e-3)
@@ -0,0 +1,114 @@
+"""Circle calculations: from the clicks to the results, and the vectorized kernels"""
+
+import numpy as np
+import pytest
+
+from conftest import checkBudget, syntheticResults
+from tem_circlefind.geometry import fitCircleGeometric, fitCircleKasa, threePointCircles, twoPointCircles
+
+CLICKS = {'circlediameter': [(10.0, 10.0), (40.0, 12.0)],
+          'threepoints': [(10.0, 10.0), (40.0, 12.0), (25.0, 30.0)]}
+# median time limits in seconds
+PROCESSCLICKS_BUDGET = 0.03
+KERNEL_BUDGET = {1: 0.001, 10000: 0.02}
+FIT_BUDGET = {1: 0.005, 10000: 3.0}
+
+
+@pytest.mark.parametrize('count', [100, 10000])
+@pytest.mark.parametrize('mode', sorted(CLICKS))
+def test_processWaitingClicks(benchmark, window, mode, count):
+    """Creating a circle from the pending clicks and adding it to the results"""
+    benchmark.group = f'processWaitingClicks ({mode})'
+    window.resultsModel.extend(syntheticResults(count))
+    getattr(window, mode + 'RadioButton').setChecked(True)
+
+    def setup():
+        for x, y in CLICKS[mode]:
+            window.pendingClicksModel.append(x, y)
+
+    benchmark.pedantic(window.processWaitingClicks, setup=setup, rounds=50)
+    assert window.pendingClicksModel.rowCount() == 0
+    checkBudget(benchmark, PROCESSCLICKS_BUDGET)
+
+
+@pytest.fixture(params=[1, 10000])
+def points(request):
+    """Sets of 10 points on circles, with 0.5 pixel random error"""
+    rng = np.random.default_rng(0)
+    count = request.param
+    centres = rng.uniform(0, 1000, (count, 1, 2))
+    radii = rng.uniform(10, 20, (count, 1))
+    angles = rng.uniform(0, 2 * np.pi, (count, 10))
+    return centres + radii[..., np.newaxis] * np.stack([np.cos(angles), np.sin(angles)], axis=-1) + rng.normal(
+        0, 0.5, (count, 10, 2))
+
+
+def test_twoPointCircles(benchmark, points):
+    benchmark.group = 'geometry'
+    benchmark(twoPointCircles, points[:, :2])
+    checkBudget(benchmark, KERNEL_BUDGET[len(points)])
+
+
+def test_threePointCircles(benchmark, points):
+    benchmark.group = 'geometry'
+    benchmark(threePointCircles, points[:, :3])
+    checkBudget(benchmark, KERNEL_BUDGET[len(points)])
+
+
+def test_fitCircleGeometric(benchmark, points):
+    benchmark.group = 'geometry'
+    benchmark(fitCircleGeometric, points)
+    checkBudget(benchmark, FIT_BUDGET[len(points)])
+
+
+def circlePoints(x: float, y: float, diameter: float, angles) -> np.ndarray:
+    angles = np.asarray(angles, dtype=np.float64)
+    return np.stack([x + diameter / 2 * np.cos(angles), y + diameter / 2 * np.sin(angles)], axis=-1)
+
+
+def test_exactCircles():
+    """Points exactly on a circle give that circle"""
+    circle = [120.5, 80.25, 31.0]
+    assert twoPointCircles(circlePoints(*circle, [0.3, 0.3 + np.pi])) == pytest.approx(circle)
+    assert threePointCircles(circlePoints(*circle, [0.1, 2.0, 4.0])) == pytest.approx(circle)
+    points = circlePoints(*circle, np.linspace(0, 2 * np.pi, 12, endpoint=False))
+    assert fitCircleKasa(points) == pytest.approx(circle)
+    assert fitCircleGeometric(points) == pytest.approx(circle)
+
+
+def test_shortArc():
+    """The geometric fit is unbiased on a short arc of noisy points, where the algebraic fit underestimates"""
+    rng = np.random.default_rng(1)
+    circle = np.array([500.0, 500.0, 200.0])
+    points = circlePoints(*circle, rng.uniform(0, np.pi / 3, (200, 30))) + rng.normal(0, 1.0, (200, 30, 2))
+    geometric = fitCircleGeometric(points)
+    assert np.median(geometric[:, 2]) == pytest.approx(circle[2], rel=0.02)
+    assert np.median(fitCircleKasa(points)[:, 2]) < np.median(geometric[:, 2])
+
+
+@pytest.mark.parametrize('function', [threePointCircles, fitCircleKasa, fitCircleGeometric])
+def test_degenerate(function):
+    """Collinear or coincident points give NaN, without spoiling the other circles of the batch"""
+    good = circlePoints(10.0, 20.0, 8.0, [0.0, 2.0, 4.0])
+    collinear = np.array([[0.0, 0.0], [1.0, 1.0], [3.0, 3.0]])
+    coincident = np.array([[5.0, 5.0]] * 3)
+    circles = function(np.stack([good, collinear, coincident]))
+    assert circles[0] == pytest.approx([10.0, 20.0, 8.0])
+    assert np.isnan(circles[1:]).all(axis=-1).all()
+
+
+def test_twoPointCoincident():
+    assert twoPointCircles(np.array([[3.0, 4.0], [3.0, 4.0]]))[2] == 0
+
+
+@pytest.mark.parametrize('function', [fitCircleKasa, fitCircleGeometric])
+def test_padded(function):
+    """Point sets padded with NaN give the same circles as fitted one by one"""
+    rng = np.random.default_rng(2)
+    sets = [circlePoints(*rng.uniform(20, 100, 3), rng.uniform(0, 2 * np.pi, n)) + rng.normal(0, 0.3, (n, 2))
+            for n in (3, 5, 12)]
+    padded = np.full((len(sets), 12, 2), np.nan)
+    for i, points in enumerate(sets):
+        padded[i, :len(points)] = points
+    expected = np.array([function(points) for points in sets])
+    assert np.allclose(function(padded), expected)
@@ -0,0 +1,63 @@
+"""Correctness of the incrementally maintained histogram"""
+
+import numpy as np
+
+from tem_circlefind.histogram import IncrementalHistogram
+
+
+def test_update():
+    """The same counts and edges as np.histogram(), including the closed last bin and NaN values"""
+    data = np.array([1.0, 2.0, 2.0, 3.5, 7.0, np.nan, 10.0])
+    counts, edges = IncrementalHistogram(nbins=6).update(data)
+    expected, expectededges = np.histogram(data[np.isfinite(data)], bins=6)
+    assert np.array_equal(counts, expected)
+    assert np.allclose(edges, expectededges)
+
+
+def test_addRemove():
+    """Adding and removing values within the range keeps the edges and gives the counts of np.histogram()"""
+    rng = np.random.default_rng(3)
+    data = rng.uniform(0, 100, 1000)
+    data[[0, 1]] = 0, 100
+    histogram = IncrementalHistogram(nbins=20)
+    _, edges = histogram.update(data)
+    added = rng.uniform(0, 100, 200)
+    added[0] = 100
+    histogram.add(added)
+    data = np.concatenate([data, added])
+    removed = np.arange(2, 600)
+    histogram.remove(data[removed])
+    data = np.delete(data, removed)
+    counts, newedges = histogram.update(data)
+    assert newedges is edges
+    assert np.array_equal(counts, np.histogram(data, bins=edges)[0])
+
+
+def test_outOfRange():
+    """A value outside the range recalculates the edges"""
+    histogram = IncrementalHistogram(nbins=4)
+    data = np.array([1.0, 2.0, 3.0])
+    histogram.update(data)
+    histogram.add([5.0])
+    data = np.append(data, 5.0)
+    counts, edges = histogram.update(data)
+    expected, expectededges = np.histogram(data, bins=4)
+    assert np.array_equal(counts, expected)
+    assert np.allclose(edges, expectededges)
+
+
+def test_setBins():
+    histogram = IncrementalHistogram(nbins=4)
+    data = np.arange(10.0)
+    histogram.update(data)
+    histogram.setBins(5)
+    counts, edges = histogram.update(data)
+    assert len(counts) == 5
+    assert np.array_equal(counts, np.histogram(data, bins=5)[0])
+
+
+def test_constant():
+    """A single distinct value gets a bin of unit width"""
+    counts, edges = IncrementalHistogram(nbins=3).update(np.full(4, 2.0))
+    assert edges[0] == 1.5 and edges[-1] == 2.5
+    assert counts.sum() == 4
@@ -0,0 +1,99 @@
+"""Loading images in the background: correctness of the loader, not its speed"""
+
+import threading
+from concurrent.futures import Future
+
+import numpy as np
+import PIL.Image
+import pytest
+
+from conftest import processEvents
+from tem_circlefind.imageloader import ImageLoader
+
+# seconds
+TIMEOUT = 10
+
+
+class ImmediateExecutor:
+    """Runs the submitted functions at once: the futures are done before the loader sees them"""
+
+    def submit(self, function, *args):
+        future = Future()
+        future.set_result(function(*args))
+        return future
+
+    def shutdown(self, wait=True, cancel_futures=False):
+        pass
+
+
+@pytest.fixture
+def tinyimage(tmp_path):
+    filename = str(tmp_path / 'tiny.png')
+    PIL.Image.fromarray(np.arange(64 * 64, dtype=np.uint8).reshape(64, 64)).save(filename)
+    return filename
+
+
+def loadInThread(qapp, loader: ImageLoader, filename: str) -> list:
+    """Load an image, failing instead of hanging if the loader deadlocks. Returns the images delivered."""
+    loaded = []
+    loader.imageLoaded.connect(lambda fn, source: loaded.append((fn, source)))
+    thread = threading.Thread(target=loader.load, args=(filename,), daemon=True)
+    thread.start()
+    thread.join(TIMEOUT)
+    assert not thread.is_alive(), 'ImageLoader.load() did not return'
+    processEvents(qapp)
+    return loaded
+
+
+@pytest.mark.parametrize('finished', [False, True], ids=['background', 'already finished'])
+def test_tinyImage(qapp, tinyimage, finished):
+    """A small image may be loaded before the loader registers its callback"""
+    loader = ImageLoader()
+    if finished:
+        loader._executor.shutdown()
+        loader._executor = ImmediateExecutor()
+    loaded = loadInThread(qapp, loader, tinyimage)
+    for i in range(int(TIMEOUT / 0.01)):
+        if loaded:
+            break
+        processEvents(qapp, 0.01)
+    assert [fn for fn, source in loaded] == [tinyimage]
+    assert loaded[0][1].data.shape == (64, 64)
+    # from the cache
+    assert [source for fn, source in loadInThread(qapp, loader, tinyimage)] == [loaded[0][1]]
+    loader.shutdown()
+
+
+def waitForLoad(qapp, loader: ImageLoader, filename: str):
+    loaded = []
+    loader.imageLoaded.connect(lambda fn, source: loaded.append(source) if fn == filename else None)
+    loader.load(filename)
+    for i in range(int(TIMEOUT / 0.01)):
+        if loaded:
+            return loaded[0]
+        processEvents(qapp, 0.01)
+    raise AssertionError('{} not loaded'.format(filename))
+
+
+def test_close(qapp, tmp_path):
+    """Images dropped from the cache are closed, except the one delivered last, until it is replaced"""
+    filenames = []
+    for name in ('a', 'b', 'c'):
+        filenames.append(str(tmp_path / '{}.tif'.format(name)))
+        frames = [PIL.Image.fromarray(np.full((64, 64), i, dtype=np.float32)) for i in range(3)]
+        frames[0].save(filenames[-1], save_all=True, append_images=frames[1:])
+    loader = ImageLoader(prefetch=0)
+    first = waitForLoad(qapp, loader, filenames[0])
+    assert first._image is not None
+    loader.clearCache()
+    # still on display
+    assert first._image is not None and first.frame(1).level(0)[0, 0] == 1
+    second = waitForLoad(qapp, loader, filenames[1])
+    assert first._image is None and first.data is None
+    third = waitForLoad(qapp, loader, filenames[2])
+    # still in the cache
+    assert second._image is not None
+    loader.clearCache()
+    assert second._image is None and third._image is not None
+    loader.shutdown()
+    assert third._image is None
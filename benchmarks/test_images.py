@@ -0,0 +1,74 @@
+"""Loading and displaying images"""
+
+import pytest
+
+from conftest import CIRCLE_COUNTS, IMAGE_SIZES, PIXELSIZE, STACK_FRAMES, checkBudget, loadImage, processEvents, \
+    syntheticResults
+
+# median time limits in seconds, by image size
+LOADIMAGE_BUDGET = {512: 0.3, 2048: 1.0, 8192: 6.0}
+REPLOT_BUDGET = {512: 0.3, 2048: 0.5, 8192: 0.5}
+# median time limits in seconds, by the number of circles shown on a 2048x2048 image
+REPLOT_CIRCLES_BUDGET = {100: 0.5, 1000: 0.5, 10000: 1.5, 100000: 10.0}
+# median time limits in seconds of showing another frame of a 2048x2048 stack, not read yet / in the frame cache
+SHOWFRAME_BUDGET = {False: 1.0, True: 0.2}
+
+
+@pytest.mark.parametrize('size', IMAGE_SIZES)
+def test_loadImage(benchmark, qapp, window, micrographs, size):
+    """Opening an image which is not in the cache, until it is shown"""
+    benchmark.group = 'loadImage'
+    filename = micrographs[size]
+
+    def setup():
+        window.imageLoader.clearCache()
+        if hasattr(window, 'source'):
+            del window.source
+
+    benchmark.pedantic(loadImage, args=(qapp, window, filename), setup=setup, rounds=5)
+    checkBudget(benchmark, LOADIMAGE_BUDGET[size])
+
+
+@pytest.mark.parametrize('size', IMAGE_SIZES)
+def test_replotImage(benchmark, qapp, window, micrographs, size):
+    benchmark.group = 'replotImage, by image size'
+    loadImage(qapp, window, micrographs[size])
+    window.resultsModel.extend(syntheticResults(100, imagesize=size))
+    benchmark.pedantic(window.replotImage, rounds=5)
+    checkBudget(benchmark, REPLOT_BUDGET[size])
+
+
+@pytest.mark.parametrize('count', CIRCLE_COUNTS)
+def test_replotImage_circles(benchmark, qapp, window, micrographs, count):
+    benchmark.group = 'replotImage, by number of circles'
+    loadImage(qapp, window, micrographs[2048])
+    window.resultsModel.extend(syntheticResults(count, imagesize=2048))
+    assert window.pixelsizeSpinBox.value() == PIXELSIZE
+    benchmark.pedantic(window.replotImage, rounds=3)
+    checkBudget(benchmark, REPLOT_CIRCLES_BUDGET[count])
+
+
+@pytest.mark.parametrize('cached', [False, True], ids=['read', 'cached'])
+def test_showFrame(benchmark, qapp, window, imagestack, cached):
+    """Stepping to another frame of an image stack, until it is drawn"""
+    benchmark.group = 'showFrame'
+    loadImage(qapp, window, imagestack)
+    window.resultsModel.extend(syntheticResults(1000, imagesize=2048))
+    frames = iter(range(1, 1000))
+
+    def setup():
+        if not cached:
+            # let the frames prefetched in the background arrive before they are forgotten
+            processEvents(qapp, 0.2)
+            window.source.clearFrameCache()
+        return (next(frames) % (STACK_FRAMES - 1) + 1,), {}
+
+    def showFrame(frame):
+        window.frameSpinBox.setValue(frame)
+        window.showFrame()
+        window.canvas.draw()
+
+    benchmark.pedantic(showFrame, setup=setup, rounds=5, warmup_rounds=STACK_FRAMES)
+    window.frameSpinBox.setValue(0)
+    window.showFrame()
+    checkBudget(benchmark, SHOWFRAME_BUDGET[cached])
@@ -0,0 +1,110 @@
+"""Session journal: replaying it gives the state of the session when it was last written"""
+
+import os
+
+import numpy as np
+import pytest
+
+from conftest import syntheticResults
+from tem_circlefind.journal import Journal, replay
+
+
+def session(journal: Journal, seed: int = 0):
+    """Record a session of random changes. Returns the expected final pixel size, results and clicks."""
+    rng = np.random.default_rng(seed)
+    pixelsize = 0.5
+    results = np.column_stack([syntheticResults(50, seed), np.zeros(50)])
+    clicks = rng.uniform(0, 1000, (3, 2))
+    journal.start('micrograph.tif', pixelsize, results, clicks)
+    for i in range(200):
+        action = rng.integers(6)
+        if action == 0:
+            count = int(rng.integers(1, 20))
+            rows = np.column_stack([syntheticResults(count, seed + i), np.full(count, float(rng.integers(3)))])
+            results = np.concatenate([results, rows])
+            journal.resultsAppended(rows)
+        elif action == 1 and len(results) > 10:
+            first = int(rng.integers(len(results) - 5))
+            last = first + int(rng.integers(5))
+            results = np.delete(results, range(first, last + 1), axis=0)
+            journal.resultsRemoved(first, last)
+        elif action == 2:
+            first = int(rng.integers(len(results) + 1))
+            rows = np.column_stack([syntheticResults(3, seed + i), np.ones(3)])
+            results = np.concatenate([results[:first], rows, results[first:]])
+            journal.resultsInserted(first, rows)
+        elif action == 3:
+            points = rng.uniform(0, 1000, (int(rng.integers(1, 3)), 2))
+            clicks = np.concatenate([clicks, points])
+            journal.clicksAppended(points)
+        elif action == 4 and len(clicks):
+            first = int(rng.integers(len(clicks)))
+            clicks = np.delete(clicks, first, axis=0)
+            journal.clicksRemoved(first, first)
+        elif action == 5:
+            pixelsize = float(rng.uniform(0.1, 2))
+            journal.pixelSizeChanged(pixelsize)
+        # changes undone at once: the journal grows, the state does not
+        for j in range(3):
+            journal.clicksAppended(np.array([[0.0, 0.0]]))
+            journal.clicksRemoved(len(clicks), len(clicks))
+    return pixelsize, results, clicks
+
+
+@pytest.mark.parametrize('compactafter', [100000, 50], ids=['appended', 'compacted'])
+def test_replay(tmp_path, compactafter):
+    filename = str(tmp_path / 'session.journal')
+    journal = Journal(filename, compactafter=compactafter)
+    pixelsize, results, clicks = session(journal)
+    journal.close()
+    state = replay(filename)
+    assert state['image'] == 'micrograph.tif'
+    assert state['pixelsize'] == pixelsize
+    assert np.array_equal(state['results'], results)
+    assert np.array_equal(state['clicks'], clicks)
+
+
+def test_cleared(tmp_path):
+    filename = str(tmp_path / 'session.journal')
+    journal = Journal(filename)
+    session(journal)
+    journal.resultsCleared()
+    journal.clicksCleared()
+    journal.close()
+    state = replay(filename)
+    assert state['results'].shape == (0, 4)
+    assert state['clicks'].shape == (0, 2)
+
+
+def test_partialRecord(tmp_path):
+    """A record interrupted while being written is ignored"""
+    filename = str(tmp_path / 'session.journal')
+    journal = Journal(filename)
+    pixelsize, results, clicks = session(journal)
+    journal.clicksAppended(np.array([[1.0, 2.0]]))
+    journal.close()
+    with open(filename, 'r+b') as f:
+        f.truncate(os.path.getsize(filename) - 1)
+    state = replay(filename)
+    assert np.array_equal(state['results'], results)
+    assert np.array_equal(state['clicks'], clicks)
+
+
+def test_noJournal(tmp_path):
+    assert replay(str(tmp_path / 'missing.journal')) is None
+    filename = str(tmp_path / 'other.journal')
+    with open(filename, 'wb') as f:
+        f.write(b'not a journal')
+    assert replay(filename) is None
+
+
+def test_writeError(tmp_path):
+    """The writer thread reports the error and stops, changes are no longer queued"""
+    errors = []
+    journal = Journal(str(tmp_path / 'missing' / 'session.journal'), onerror=errors.append)
+    journal.start(None, 1.0, np.empty((0, 4)), np.empty((0, 2)))
+    journal._thread.join(10)
+    assert journal.failed and isinstance(errors[0], OSError)
+    journal.resultsAppended(np.ones((1, 4)))
+    assert journal._queue.empty()
+    journal.close()
@@ -0,0 +1,110 @@
+"""Projects: saving and loading, and switching between the images of a project"""
+
+import os
+import shutil
+
+import numpy as np
+import pytest
+from PyQt5 import QtWidgets
+
+from conftest import PIXELSIZE, loadImage, processEvents, syntheticResults, waitForImage
+from tem_circlefind.project import Project
+
+
+def syntheticProject(dirname: str) -> Project:
+    project = Project()
+    for i, pixelsize in enumerate([0.5, 100 / 37, 1.25]):
+        results = np.column_stack([syntheticResults(10 * i, seed=i), np.arange(10 * i) % 2])
+        project.addImage(os.path.join(dirname, 'images', f'image{i}.tif'), pixelsize, results)
+    project.setActive(1)
+    return project
+
+
+def checkEqual(project: Project, other: Project):
+    assert other.pixelsizes == project.pixelsizes
+    assert other.active == project.active
+    assert len(other.results) == len(project.results)
+    for results, otherresults in zip(project.results, other.results):
+        assert np.array_equal(otherresults, results)
+
+
+def test_roundTrip(tmp_path):
+    project = syntheticProject(str(tmp_path))
+    project.save(str(tmp_path / 'project.tcproj'))
+    loaded = Project.load(str(tmp_path / 'project.tcproj'))
+    checkEqual(project, loaded)
+    assert loaded.filenames == project.filenames
+    assert loaded.diameters() == pytest.approx(project.diameters())
+
+
+def test_moved(tmp_path):
+    """The images are found relative to the project file"""
+    (tmp_path / 'old').mkdir()
+    project = syntheticProject(str(tmp_path / 'old'))
+    project.save(str(tmp_path / 'old' / 'project.tcproj'))
+    shutil.move(str(tmp_path / 'old'), str(tmp_path / 'new'))
+    loaded = Project.load(str(tmp_path / 'new' / 'project.tcproj'))
+    checkEqual(project, loaded)
+    assert loaded.filenames == [str(tmp_path / 'new' / 'images' / f'image{i}.tif') for i in range(3)]
+
+
+def test_inconsistent(tmp_path):
+    filename = str(tmp_path / 'project.tcproj')
+    syntheticProject(str(tmp_path)).save(filename)
+    with np.load(filename) as data:
+        arrays = dict(data)
+    arrays['counts'] = arrays['counts'] + 1
+    with open(filename, 'wb') as f:
+        np.savez(f, **arrays)
+    with pytest.raises(ValueError):
+        Project.load(filename)
+
+
+def test_switchImages(window, qapp, micrographs, monkeypatch):
+    """Each image of a project keeps its results and pixel size"""
+    results = np.column_stack([syntheticResults(20), np.zeros(20)])
+    window.resultsModel.extend(results)
+    window.newProject()
+    monkeypatch.setattr(QtWidgets.QFileDialog, 'getOpenFileNames', lambda *args: ([micrographs[512]], ''))
+    window.addProjectImages()
+    try:
+        loadImage(qapp, window, micrographs[512])
+        assert window.resultsModel.rowCount() == 0
+        window.resultsModel.setPixelSize(100 / 37)
+        window.resultsModel.append(10.0, 20.0, 30.0)
+        loadImage(qapp, window, micrographs[2048])
+        processEvents(qapp)
+        assert window.resultsModel.pixelSize == PIXELSIZE
+        assert np.allclose(window.resultsModel.getData(), results)
+        loadImage(qapp, window, micrographs[512])
+        assert window.resultsModel.pixelSize == 100 / 37
+        assert np.allclose(window.resultsModel.getData(), [[10.0, 20.0, 30.0, 0.0]])
+        assert window.project.diameters(window.resultsModel.getData()) == pytest.approx(
+            np.concatenate([results[:, 2], [30.0]]))
+    finally:
+        window.project = None
+        window.updateProjectView()
+
+
+def test_browse(window, qapp, micrographs, monkeypatch):
+    """Previous and next step through the images of the project, other images are not added"""
+    window.newProject()
+    monkeypatch.setattr(QtWidgets.QFileDialog, 'getOpenFileNames', lambda *args: ([micrographs[512]], ''))
+    window.addProjectImages()
+    try:
+        window.nextImage()
+        waitForImage(qapp, window, micrographs[512])
+        window.nextImage()
+        waitForImage(qapp, window, micrographs[2048])
+        window.previousImage()
+        waitForImage(qapp, window, micrographs[512])
+        loadImage(qapp, window, micrographs[8192])
+        assert len(window.project) == 2
+        assert window.project.active is None
+        assert window.resultsModel.rowCount() == 0
+        window.nextImage()
+        waitForImage(qapp, window, micrographs[2048])
+        assert window.project.active == 0
+    finally:
+        window.project = None
+        window.updateProjectView()
@@ -0,0 +1,131 @@
+"""Results model, histogram, statistics and results files"""
+
+import pytest
+from PyQt5 import QtWidgets
+
+from conftest import CIRCLE_COUNTS, checkBudget, processEvents, syntheticResults
+
+# median time limits in seconds, by the number of circles
+APPEND_BUDGET = {100: 0.02, 1000: 0.02, 10000: 0.02, 100000: 0.03}
+REMOVEROW_BUDGET = {100: 0.01, 1000: 0.01, 10000: 0.01, 100000: 0.03}
+GETDATA_BUDGET = {100: 0.0001, 1000: 0.0001, 10000: 0.0001, 100000: 0.0001}
+DRAWHISTOGRAM_BUDGET = {100: 0.2, 1000: 0.2, 10000: 0.2, 100000: 0.3}
+UPDATESTATISTICS_BUDGET = {100: 0.005, 1000: 0.005, 10000: 0.005, 100000: 0.005}
+SETPIXELSIZE_BUDGET = {100: 0.01, 1000: 0.01, 10000: 0.01, 100000: 0.02}
+SAVERESULTS_BUDGET = {'text': {100: 0.01, 1000: 0.03, 10000: 0.2, 100000: 2.0},
+                      'binary': {100: 0.005, 1000: 0.005, 10000: 0.01, 100000: 0.05}}
+LOADRESULTS_BUDGET = {'text': {100: 0.1, 1000: 0.1, 10000: 0.2, 100000: 2.0},
+                      'binary': {100: 0.1, 1000: 0.1, 10000: 0.2, 100000: 2.0}}
+FILE_EXTENSIONS = {'text': '.txt', 'binary': '.tcr'}
+
+
+@pytest.fixture
+def nodialogs(monkeypatch):
+    monkeypatch.setattr(QtWidgets.QMessageBox, 'information', lambda *args: None)
+    monkeypatch.setattr(QtWidgets.QMessageBox, 'critical', lambda *args: pytest.fail(args[2]))
+
+
+@pytest.mark.parametrize('count', CIRCLE_COUNTS)
+def test_append(benchmark, window, count):
+    """Adding a single circle, with all the views connected to the model"""
+    benchmark.group = 'ResultsModel.append'
+    window.resultsModel.extend(syntheticResults(count))
+    benchmark(window.resultsModel.append, 100.0, 100.0, 15.0)
+    checkBudget(benchmark, APPEND_BUDGET[count])
+
+
+@pytest.mark.parametrize('count', CIRCLE_COUNTS)
+def test_removeRow(benchmark, window, count):
+    """Removing a circle from the middle, with all the views connected to the model"""
+    benchmark.group = 'ResultsModel.removeRow'
+    window.resultsModel.extend(syntheticResults(count))
+    benchmark.pedantic(window.resultsModel.removeRow, args=(count // 2,),
+                       setup=lambda: window.resultsModel.append(100.0, 100.0, 15.0), rounds=20)
+    checkBudget(benchmark, REMOVEROW_BUDGET[count])
+
+
+@pytest.mark.parametrize('count', CIRCLE_COUNTS)
+def test_getData(benchmark, window, count):
+    benchmark.group = 'ResultsModel.getData'
+    window.resultsModel.extend(syntheticResults(count))
+    benchmark(window.resultsModel.getData)
+    checkBudget(benchmark, GETDATA_BUDGET[count])
+
+
+@pytest.mark.parametrize('count', CIRCLE_COUNTS)
+def test_setPixelSize(benchmark, window, count):
+    """Recalibration: rescaling all circles to a new pixel size, and updating the statistics"""
+    benchmark.group = 'setPixelSize'
+    window.resultsModel.extend(syntheticResults(count))
+    pixelsizes = iter([1.0, 1.5] * 1000000)
+
+    def setPixelSize():
+        window.pixelsizeSpinBox.setValue(next(pixelsizes))
+        window.updateStatistics()
+
+    benchmark(setPixelSize)
+    checkBudget(benchmark, SETPIXELSIZE_BUDGET[count])
+
+
+@pytest.mark.parametrize('count', CIRCLE_COUNTS)
+def test_drawHistogram(benchmark, window, count):
+    """Recalculating the histogram from scratch and repainting it"""
+    benchmark.group = 'drawHistogram'
+    window.resultsModel.extend(syntheticResults(count))
+    window.setupHistogramFigure()
+
+    def drawHistogram():
+        window.drawHistogram()
+        window.canvashistogram.draw()
+
+    benchmark.pedantic(drawHistogram, setup=window.histogram.invalidate, rounds=10)
+    checkBudget(benchmark, DRAWHISTOGRAM_BUDGET[count])
+
+
+@pytest.mark.parametrize('count', CIRCLE_COUNTS)
+def test_updateStatistics(benchmark, window, count):
+    """Refreshing the statistics labels and the (incrementally maintained) histogram"""
+    benchmark.group = 'updateStatistics'
+    window.resultsModel.extend(syntheticResults(count))
+    benchmark(window.updateStatistics)
+    checkBudget(benchmark, UPDATESTATISTICS_BUDGET[count])
+
+
+@pytest.mark.parametrize('fileformat', ['text', 'binary'])
+@pytest.mark.parametrize('count', CIRCLE_COUNTS)
+def test_saveResults(benchmark, window, tmp_path, monkeypatch, nodialogs, count, fileformat):
+    benchmark.group = f'saveResults ({fileformat})'
+    filename = str(tmp_path / ('results' + FILE_EXTENSIONS[fileformat]))
+    monkeypatch.setattr(QtWidgets.QFileDialog, 'getSaveFileName', lambda *args, **kwargs: (filename, ''))
+    window.resultsModel.extend(syntheticResults(count))
+    try:
+        benchmark(window.saveResults)
+    finally:
+        if window._resultsWriter is not None:
+            # do not keep updating the file in the other benchmarks
+            window._resultsWriter.close()
+            window._resultsWriter = None
+    checkBudget(benchmark, SAVERESULTS_BUDGET[fileformat][count])
+
+
+@pytest.mark.parametrize('fileformat', ['text', 'binary'])
+@pytest.mark.parametrize('count', CIRCLE_COUNTS)
+def test_loadResults(benchmark, qapp, window, tmp_path, monkeypatch, nodialogs, count, fileformat):
+    benchmark.group = f'loadResults ({fileformat})'
+    filename = str(tmp_path / ('results' + FILE_EXTENSIONS[fileformat]))
+    monkeypatch.setattr(QtWidgets.QFileDialog, 'getSaveFileName', lambda *args, **kwargs: (filename, ''))
+    monkeypatch.setattr(QtWidgets.QFileDialog, 'getOpenFileName', lambda *args, **kwargs: (filename, ''))
+    window.resultsModel.extend(syntheticResults(count))
+    window.saveResults()
+    if window._resultsWriter is not None:
+        window._resultsWriter.close()
+        window._resultsWriter = None
+
+    def setup():
+        window.resultsModel.clear()
+        # the redraw after clearing is not part of loading
+        processEvents(qapp)
+
+    benchmark.pedantic(window.loadResults, setup=setup, rounds=5)
+    assert window.resultsModel.rowCount() == count
+    checkBudget(benchmark, LOADRESULTS_BUDGET[fileformat][count])
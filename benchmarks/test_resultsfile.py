@@ -0,0 +1,77 @@
+"""Results files: what is written is read back, in both formats"""
+
+import numpy as np
+import pytest
+
+from conftest import syntheticResults
+from tem_circlefind.resultsfile import BinaryResultsWriter, diameterStatistics, loadBinary, readResults, \
+    recalibrate, saveBinary, saveText, toPhysical
+
+# not representable with a few decimals
+PIXELSIZE = 100 / 37
+
+
+def syntheticPixels(count: int, seed: int = 0) -> np.ndarray:
+    """Rows of x, y, diameter in pixels and frame"""
+    return np.column_stack([syntheticResults(count, seed), np.arange(count) % 3])
+
+
+@pytest.mark.parametrize('save', [saveText, saveBinary], ids=['text', 'binary'])
+def test_roundTrip(tmp_path, save):
+    filename = str(tmp_path / 'results')
+    pixels = syntheticPixels(100)
+    save(filename, pixels, PIXELSIZE)
+    results = readResults(filename)
+    assert results['pixelsize'] == PIXELSIZE
+    # the text format has six decimals
+    tolerance = 1e-6 if save is saveText else 0
+    assert np.allclose(results['pixels'], pixels, rtol=0, atol=tolerance)
+    assert np.allclose(results['data'], toPhysical(pixels, PIXELSIZE), rtol=0, atol=tolerance)
+
+
+def test_binaryImage(tmp_path):
+    filename = str(tmp_path / 'results.tcr')
+    saveBinary(filename, syntheticPixels(10), PIXELSIZE, '/data/micrograph.tif')
+    assert readResults(filename)['image'] == '/data/micrograph.tif'
+
+
+def test_empty(tmp_path):
+    filename = str(tmp_path / 'results.tcr')
+    saveBinary(filename, np.empty((0, 4)), PIXELSIZE)
+    results = readResults(filename)
+    assert results['data'].shape == (0, 4)
+    assert results['pixelsize'] == PIXELSIZE
+
+
+def test_writer(tmp_path):
+    """Appending rows gives the same file as writing them at once"""
+    filename = str(tmp_path / 'results.tcr')
+    pixels = syntheticPixels(100)
+    writer = BinaryResultsWriter(filename, pixels[:40], PIXELSIZE, 'micrograph.tif')
+    for first in range(40, 100, 20):
+        rows = pixels[first:first + 20]
+        writer.append(rows, PIXELSIZE, diameterStatistics(pixels[:first + 20, 2] * PIXELSIZE))
+    data, metadata = loadBinary(filename)
+    assert np.array_equal(data[:, [4, 5, 6, 3]], pixels)
+    assert metadata['rows'] == 100
+    assert metadata['statistics']['mean'] == pytest.approx(pixels[:, 2].mean() * PIXELSIZE)
+    # after removing rows
+    writer.rewrite(pixels[::2], 2 * PIXELSIZE, writer.image)
+    writer.close()
+    results = readResults(filename)
+    assert np.array_equal(results['pixels'], pixels[::2])
+    assert results['pixelsize'] == 2 * PIXELSIZE
+    assert results['image'] == 'micrograph.tif'
+
+
+@pytest.mark.parametrize('save', [saveText, saveBinary], ids=['text', 'binary'])
+def test_recalibrate(tmp_path, save):
+    """The pixels are kept, the physical units follow the new pixel size"""
+    filename, outputfile = str(tmp_path / 'results'), str(tmp_path / 'recalibrated')
+    pixels = syntheticPixels(100)
+    save(filename, pixels, PIXELSIZE)
+    assert recalibrate(filename, 1.25, outputfile) == len(pixels)
+    results = readResults(outputfile)
+    assert results['pixelsize'] == 1.25
+    assert np.allclose(results['pixels'], readResults(filename)['pixels'], rtol=0, atol=1e-6)
+    assert np.allclose(results['data'][:, :3], results['pixels'][:, :3] * 1.25, rtol=0, atol=1e-6)
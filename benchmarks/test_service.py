@@ -0,0 +1,112 @@
+"""The local measurement service: round trips of requests through a client on the same machine"""
+
+import threading
+
+import numpy as np
+import pytest
+
+from conftest import PIXELSIZE, checkBudget, syntheticResults
+from tem_circlefind.geometry import twoPointCircles
+from tem_circlefind.service import BackgroundService, ServiceClient, ServiceError
+
+CLICKS = [(10.0, 10.0), (40.0, 12.0)]
+CONCURRENT_CLIENTS = 8
+REQUESTS_PER_CLIENT = 10
+# median time limits in seconds
+CLICKS_BUDGET = {100: 0.02, 10000: 0.03}
+RESULTS_BUDGET = {100: 0.02, 10000: 0.6}
+CONCURRENT_BUDGET = 1.0
+
+
+@pytest.fixture(scope='module')
+def service():
+    with BackgroundService() as service:
+        yield service
+
+
+def openSession(client: ServiceClient, image: str, count: int) -> str:
+    """A session of a micrograph, with `count` circles added as clicked diameters"""
+    session = client.openImage(image, PIXELSIZE)['id']
+    circles = syntheticResults(count, imagesize=512) / PIXELSIZE
+    endpoints = np.stack([circles[:, :2] - [[0.5, 0]] * circles[:, 2:3], circles[:, :2] + [[0.5, 0]] * circles[:, 2:3]],
+                         axis=1)
+    client.addClicks(session, endpoints.reshape(-1, 2))
+    return session
+
+
+@pytest.mark.parametrize('count', [100, 10000])
+def test_clicks(benchmark, service, micrographs, count):
+    """Adding a circle from two clicks, with the response"""
+    benchmark.group = 'service: clicks'
+    with ServiceClient(service.port) as client:
+        session = openSession(client, micrographs[512], count)
+        response = benchmark(client.addClicks, session, CLICKS)
+        # the same calculation as in the GUI
+        assert np.allclose(response['circles'][0], twoPointCircles(np.array(CLICKS)) * PIXELSIZE)
+        client.closeSession(session)
+    checkBudget(benchmark, CLICKS_BUDGET[count])
+
+
+@pytest.mark.parametrize('count', [100, 10000])
+def test_results(benchmark, service, micrographs, count):
+    """Fetching the results as JSON"""
+    benchmark.group = 'service: results'
+    with ServiceClient(service.port) as client:
+        session = openSession(client, micrographs[512], count)
+        results = benchmark(client.results, session)
+        assert len(results['data']) == count
+        client.closeSession(session)
+    checkBudget(benchmark, RESULTS_BUDGET[count])
+
+
+def test_concurrentClients(benchmark, service, micrographs):
+    """Several clients adding circles at the same time, each to its own session"""
+    benchmark.group = 'service: concurrent clients'
+    clients = [ServiceClient(service.port) for i in range(CONCURRENT_CLIENTS)]
+    sessions = [openSession(client, micrographs[512], 100) for client in clients]
+
+    def work(client: ServiceClient, session: str):
+        for i in range(REQUESTS_PER_CLIENT):
+            client.addClicks(session, CLICKS)
+
+    def run():
+        threads = [threading.Thread(target=work, args=args) for args in zip(clients, sessions)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    benchmark.pedantic(run, rounds=5)
+    for client, session in zip(clients, sessions):
+        client.closeSession(session)
+        client.close()
+    checkBudget(benchmark, CONCURRENT_BUDGET)
+
+
+def test_concurrentClose(service, micrographs):
+    """Closing a session while it is busy, by several clients at once: one succeeds, the others get 404"""
+    with ServiceClient(service.port) as client:
+        session = openSession(client, micrographs[512], 100)
+    statuses = []
+
+    def work(close: bool):
+        with ServiceClient(service.port) as client:
+            try:
+                if close:
+                    client.closeSession(session)
+                else:
+                    client.setFrame(session, 0)
+            except ServiceError as exc:
+                status = exc.status
+            else:
+                status = 200
+            if close:
+                statuses.append(status)
+
+    # the session is kept busy by loading the image while the others wait
+    threads = [threading.Thread(target=work, args=(i > 0,)) for i in range(5)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert sorted(statuses) == [200] + [404] * 3
@@ -0,0 +1,62 @@
+"""Correctness of the spatial index of the circles"""
+
+import numpy as np
+import pytest
+
+from tem_circlefind.spatialindex import CircleIndex
+
+# x, y, diameter, frame
+CIRCLES = np.array([[10.0, 10.0, 8.0, 0],
+                    [12.0, 10.0, 8.0, 0],  # duplicate of 0
+                    [30.0, 10.0, 8.0, 0],
+                    [12.0, 10.0, 8.0, 1],  # another frame
+                    [31.0, 11.0, 6.0, 0],  # duplicate of 2
+                    [50.0, 50.0, 20.0, 0],
+                    [57.0, 50.0, 4.0, 0]])  # inside 5, but centres too far apart for the sizes
+
+
+@pytest.fixture(params=[0, 256], ids=['tree', 'tail'])
+def index(request) -> CircleIndex:
+    """The index, with the circles in the k-d tree or in the brute force searched tail"""
+    index = CircleIndex(maxtail=request.param)
+    index.append(CIRCLES)
+    return index
+
+
+def test_duplicates(index):
+    assert index.duplicates() == [1, 4]
+    # all three are duplicates of the first one: only the first one is kept
+    index.reset(np.array([[0.0, 0.0, 10.0], [2.0, 0.0, 10.0], [4.0, 0.0, 10.0]]))
+    assert index.duplicates() == [1, 2]
+    index.reset(np.empty((0, 3)))
+    assert index.duplicates() == []
+
+
+def test_overlaps(index):
+    new = np.array([[11.0, 9.0, 8.0, 0],
+                    [11.0, 9.0, 8.0, 2],
+                    [31.0, 10.0, 4.0, 0],
+                    [80.0, 80.0, 10.0, 0]])
+    assert index.overlaps(new).tolist() == [0, -1, 2, -1]
+    assert index.overlaps(new, tolerance=0.1).tolist() == [-1, -1, -1, -1]
+
+
+def test_circleAt(index):
+    assert index.circleAt(9.0, 10.0) == 0
+    assert index.circleAt(13.0, 10.0) == 1
+    assert index.circleAt(13.0, 10.0, frame=1) == 3
+    assert index.circleAt(56.5, 50.0) == 6
+    assert index.circleAt(45.0, 50.0) == 5
+    assert index.circleAt(10.0, 30.0) is None
+    assert CircleIndex().circleAt(0.0, 0.0) is None
+
+
+def test_remove(index):
+    """The indices follow the removal of rows"""
+    index.remove(0, 1)
+    assert len(index) == 5
+    assert index.circleAt(9.0, 10.0) is None
+    assert index.circleAt(30.0, 10.0) == 0
+    assert index.duplicates() == [2]
+    index.append(CIRCLES[:1])
+    assert index.circleAt(9.0, 10.0) == 5
@@ -0,0 +1,39 @@
+"""Time to the first window: a fresh interpreter importing the program and showing the main window"""
+
+import subprocess
+import sys
+
+from conftest import checkBudget
+
+# median time limit in seconds, including the start of the Python interpreter
+FIRSTWINDOW_BUDGET = 3.0
+
+STARTUP_SCRIPT = """
+import os
+from PyQt5 import QtCore, QtWidgets
+app = QtWidgets.QApplication([])
+app.setApplicationName('tem_circlefind')
+QtCore.QStandardPaths.setTestModeEnabled(True)
+from tem_circlefind.tem_circlefind import TEMCircleFind
+window = TEMCircleFind()
+# quit as soon as the event loop is idle, i.e. the window has been shown
+QtCore.QTimer.singleShot(0, app.quit)
+app.exec_()
+window.close()
+# the session journal in the test location (~/.qttest) is not left behind
+journal = window.journalFileName()
+for fn in [journal, journal + '.lock']:
+    if os.path.exists(fn):
+        os.remove(fn)
+"""
+
+
+def test_timeToFirstWindow(benchmark):
+    benchmark.group = 'startup'
+
+    def start():
+        subprocess.run([sys.executable, '-c', STARTUP_SCRIPT], check=True, stdout=subprocess.DEVNULL,
+                       stderr=subprocess.DEVNULL)
+
+    benchmark.pedantic(start, rounds=5, warmup_rounds=1)
+    checkBudget(benchmark, FIRSTWINDOW_BUDGET)
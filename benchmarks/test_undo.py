@@ -0,0 +1,173 @@
+"""Undo and redo: the models, and everything kept in step with them, return to their former state"""
+
+import numpy as np
+import pytest
+
+from PyQt5 import QtWidgets
+
+from conftest import PIXELSIZE, detectCircles, loadImage, processEvents, syntheticResults
+from tem_circlefind.commands import AppendResultsCommand, ClearResultsCommand, RemoveResultsCommand, \
+    SetPixelSizeCommand
+from tem_circlefind.resultsfile import diameterStatistics, saveBinary, toPixels, withFrames
+from tem_circlefind.resultsmodel import ResultsModel
+
+
+def syntheticPixels(count: int, seed: int = 0) -> np.ndarray:
+    return toPixels(syntheticResults(count, seed), PIXELSIZE)
+
+
+def checkState(window, pixels: np.ndarray):
+    """The results model, its statistics and the duplicate index agree with `pixels`"""
+    pixels = withFrames(pixels)
+    assert np.array_equal(window.resultsModel.getPixelData(), pixels)
+    statistics = window.resultsStatistics()
+    for name, value in diameterStatistics(pixels[:, 2] * PIXELSIZE).items():
+        assert statistics[name] == pytest.approx(value, nan_ok=True)
+    assert (window.circleIndex.overlaps(pixels) >= 0).all()
+    # nothing else is left in the index
+    assert (window.circleIndex.overlaps(pixels + [[1e4, 1e4, 0, 0]]) < 0).all()
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_insertRowList(seed):
+    """insertRowList() is the inverse of removeRowList()"""
+    rng = np.random.default_rng(seed)
+    model = ResultsModel(pixelsize=PIXELSIZE)
+    pixels = syntheticPixels(200, seed)
+    model.extendPixels(pixels)
+    rows = rng.choice(len(pixels), rng.integers(1, len(pixels)), replace=False)
+    removed = pixels[rows]
+    model.removeRowList(rows)
+    assert np.array_equal(model.getPixelData(), np.delete(pixels, rows, axis=0))
+    # in any order
+    order = rng.permutation(len(rows))
+    model.insertRowList(rows[order], removed[order])
+    assert np.array_equal(model.getPixelData(), pixels)
+    assert model.getMeanDiameter() == pytest.approx(pixels[:, 2].mean() * PIXELSIZE)
+    assert model.getMinDiameter() == pytest.approx(pixels[:, 2].min() * PIXELSIZE)
+
+
+def test_insertRowListOutOfRange():
+    model = ResultsModel()
+    model.extendPixels(syntheticPixels(10))
+    with pytest.raises(IndexError):
+        model.insertRowList([12], syntheticPixels(1))
+    with pytest.raises(IndexError):
+        model.insertRowList([3, 3], syntheticPixels(2))
+    with pytest.raises(ValueError):
+        model.insertRowList([3, 4], syntheticPixels(1))
+    assert model.rowCount() == 10
+
+
+def test_removeUndoRedo(window, qapp):
+    pixels = syntheticPixels(1000)
+    window.undoStack.push(AppendResultsCommand(window.resultsModel, pixels))
+    rows = np.r_[0, 10:20, 500, 998:1000]
+    window.undoStack.push(RemoveResultsCommand(window.resultsModel, rows))
+    processEvents(qapp)
+    checkState(window, np.delete(pixels, rows, axis=0))
+    window.undoStack.undo()
+    processEvents(qapp)
+    checkState(window, pixels)
+    window.undoStack.redo()
+    processEvents(qapp)
+    checkState(window, np.delete(pixels, rows, axis=0))
+    window.undoStack.undo()
+    window.undoStack.undo()
+    processEvents(qapp)
+    checkState(window, np.empty((0, 4)))
+
+
+def test_clearUndo(window, qapp):
+    pixels = syntheticPixels(100)
+    window.undoStack.push(AppendResultsCommand(window.resultsModel, pixels))
+    window.undoStack.push(ClearResultsCommand(window.resultsModel))
+    checkState(window, np.empty((0, 4)))
+    window.undoStack.undo()
+    processEvents(qapp)
+    checkState(window, pixels)
+
+
+def test_pixelSizeUndo(window, qapp):
+    """The pixels do not change with the pixel size, and the exact pixel size is restored"""
+    pixels = syntheticPixels(100)
+    window.resultsModel.extendPixels(pixels)
+    window.undoStack.push(SetPixelSizeCommand(window.resultsModel, 100 / 37))
+    assert window.resultsModel.pixelSize == 100 / 37
+    assert np.array_equal(window.resultsModel.getPixelData(), pixels)
+    assert np.allclose(window.resultsModel.getData()[:, :3], pixels[:, :3] * 100 / 37)
+    window.undoStack.undo()
+    assert window.resultsModel.pixelSize == PIXELSIZE
+    window.undoStack.redo()
+    assert window.resultsModel.pixelSize == 100 / 37
+    window.undoStack.undo()
+    processEvents(qapp)
+    checkState(window, pixels)
+
+
+def test_duplicatesOnly(window, qapp, tmp_path, monkeypatch):
+    """Loading results already there, or detecting circles already measured, leaves no empty undo step"""
+    monkeypatch.setattr(QtWidgets.QMessageBox, 'information', lambda *args: None)
+    filename = str(tmp_path / 'results.tcr')
+    pixels = syntheticPixels(100)
+    saveBinary(filename, pixels, PIXELSIZE)
+    monkeypatch.setattr(QtWidgets.QFileDialog, 'getOpenFileName', lambda *args: (filename, ''))
+    window.loadResults()
+    assert window.undoStack.count() == 1
+    window.loadResults()
+    assert window.undoStack.count() == 1
+    detectCircles(qapp, window)
+    detected = window.resultsModel.rowCount() - len(pixels)
+    assert detected > 0
+    detectCircles(qapp, window)
+    assert window.undoStack.count() == 2
+    assert window.resultsModel.rowCount() == len(pixels) + detected
+
+
+def test_frameChange(window, qapp, imagestack):
+    """Showing another frame drops the pending clicks without touching the undo history"""
+    loadImage(qapp, window, imagestack)
+    window.circlediameterRadioButton.setChecked(True)
+    window.pendingClicksModel.append(10.0, 10.0)
+    window.pendingClicksModel.append(30.0, 10.0)
+    window.processWaitingClicks()
+    window.undoStack.undo()
+    window.undoStack.undo()
+    assert window.resultsModel.rowCount() == 0
+    assert window.pendingClicksModel.rowCount() == 2
+    count, index = window.undoStack.count(), window.undoStack.index()
+    window.frameSpinBox.setValue(1)
+    window.showFrame()
+    assert window.pendingClicksModel.rowCount() == 0
+    assert (window.undoStack.count(), window.undoStack.index()) == (count, index)
+    # the circle can still be redone and undone, neither taking the clicks of this frame nor giving back those of the
+    # other one
+    window.pendingClicksModel.append(50.0, 50.0)
+    window.undoStack.redo()
+    window.undoStack.redo()
+    assert window.resultsModel.rowCount() == 1
+    assert window.pendingClicksModel.getData() == [(50.0, 50.0)]
+    window.undoStack.undo()
+    window.undoStack.undo()
+    assert window.resultsModel.rowCount() == 0
+    assert window.pendingClicksModel.getData() == [(50.0, 50.0)]
+    window.frameSpinBox.setValue(0)
+    window.showFrame()
+    assert window.pendingClicksModel.rowCount() == 0
+
+
+def test_pixelSizeEdited(window, qapp):
+    """Changes made in the spin box are undoable, consecutive ones as a single step"""
+    window.undoStack.push(SetPixelSizeCommand(window.resultsModel, 100 / 37, 'Calibrate pixel size'))
+    window.pixelsizeSpinBox.setValue(1.5)
+    window.pixelsizeSpinBox.setValue(1.75)
+    assert window.resultsModel.pixelSize == 1.75
+    assert window.undoStack.count() == 2
+    window.undoStack.undo()
+    assert window.resultsModel.pixelSize == 100 / 37
+    assert window.pixelsizeSpinBox.value() == pytest.approx(100 / 37, abs=1e-3)
+    window.undoStack.undo()
+    assert window.resultsModel.pixelSize == PIXELSIZE
+    window.undoStack.redo()
+    window.undoStack.redo()
+    assert window.resultsModel.pixelSize == 1.75
@@ -1,18 +1,52 @@
-import sys
+import argparse
 import gc
+import sys
+import time
 
-from PyQt5.QtWidgets import QApplication
+# the start of the program, as far as we can tell: for measuring the time to the first window
+_STARTED = time.perf_counter()
 
-from .tem_circlefind import TEMCircleFind
 
 def run():
-    app = QApplication(sys.argv)
+    # Qt is imported here and not at the module level: batch worker processes may import this module as well.
+    from PyQt5.QtCore import QTimer
+    from PyQt5.QtWidgets import QApplication
+    from . import profiling
+    from .tem_circlefind import TEMCircleFind
+
+    parser = argparse.ArgumentParser(prog='tem_circlefind', description='Measure circular particles on TEM images')
+    parser.add_argument('image', nargs='?', default=None, help='Image file to open')
+    parser.add_argument('--profile', action='store_true',
+                        help='Time the main operations and print the latency statistics at exit')
+    parser.add_argument('--cprofile', default=None, metavar='FILE',
+                        help='Profile the GUI thread with cProfile and save the statistics to FILE at exit')
+    # unknown arguments are left to Qt (e.g. -style)
+    args, qtargs = parser.parse_known_args()
+
+    if args.profile:
+        profiling.setEnabled(True)
+    if args.cprofile is not None:
+        profiling.startProfiling()
+    app = QApplication(sys.argv[:1] + qtargs)
+    # the session journal is stored in the application data directory
+    app.setApplicationName('tem_circlefind')
     win = TEMCircleFind()
-    try:
-        win.loadImage(sys.argv[1])
-    except (IndexError, FileNotFoundError):
-        pass
+    if profiling.isEnabled():
+        # the timer fires when the event loop is idle for the first time, i.e. when the window has been painted
+        QTimer.singleShot(0, lambda: profiling.record('startup: time to first window',
+                                                      time.perf_counter() - _STARTED))
+    if args.image is not None:
+        try:
+            win.loadImage(args.image)
+        except FileNotFoundError:
+            pass
     result = app.exec_()
+    if args.cprofile is not None:
+        stats = profiling.stopProfiling()
+        if stats is not None:
+            stats.dump_stats(args.cprofile)
+    if args.profile:
+        print(profiling.formatSummary())
     win.deleteLater()
     del win
     gc.collect()
@@ -20,3 +54,20 @@ def run():
     del app
     gc.collect()
     sys.exit(result)
+
+
+def main():
+    if len(sys.argv) > 1 and sys.argv[1] == 'batch':
+        from .batch import main as batchmain
+        sys.exit(batchmain(sys.argv[2:]))
+    if len(sys.argv) > 1 and sys.argv[1] == 'recalibrate':
+        from .batch import recalibrateMain
+        sys.exit(recalibrateMain(sys.argv[2:]))
+    if len(sys.argv) > 1 and sys.argv[1] == 'serve':
+        from .service import main as servicemain
+        sys.exit(servicemain(sys.argv[2:]))
+    run()
+
+
+if __name__ == '__main__':
+    main()
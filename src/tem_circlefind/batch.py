@@ -0,0 +1,155 @@
+"""Headless batch processing of micrographs
+
+Usage: python -m tem_circlefind batch [options] <image or directory> [...]
+       python -m tem_circlefind recalibrate [options] <results file> [...]
+
+Only numpy, scipy and PIL are imported here (and in the modules imported from here): the worker processes must not
+pull in Qt or matplotlib.
+"""
+
+import argparse
+import os
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List, Optional, Sequence
+
+import numpy as np
+
+from .circledetection import findCircles
+from .imagesource import IMAGE_EXTENSIONS, loadImageData
+from .resultsfile import diameterStatistics, recalibrate, saveText
+
+
+def findImages(paths: Sequence[str]) -> List[str]:
+    images = []
+    for path in paths:
+        if os.path.isdir(path):
+            images.extend(sorted(
+                os.path.join(path, fn) for fn in os.listdir(path)
+                if os.path.splitext(fn)[1].lower() in IMAGE_EXTENSIONS))
+        else:
+            images.append(path)
+    return images
+
+
+def processImage(filename: str, pixelsize: float, mindiameter: float, maxdiameter: float,
+                 outputdir: Optional[str] = None, threshold: float = 1.0, polarity: str = 'both') -> Dict:
+    """Find the circles in a single image and save the results next to it (or into `outputdir`)
+
+    Diameters are in physical units (nm), converted to pixels by `pixelsize`.
+    """
+    data = loadImageData(filename)
+    circles = findCircles(data, mindiameter / pixelsize, maxdiameter / pixelsize, threshold=threshold,
+                          polarity=polarity)
+    resultsfile = os.path.splitext(filename)[0] + '.txt'
+    if outputdir is not None:
+        resultsfile = os.path.join(outputdir, os.path.basename(resultsfile))
+    saveText(resultsfile, circles, pixelsize)
+    return {'filename': filename, 'resultsfile': resultsfile, 'diameters': circles[:, 2] * pixelsize}
+
+
+def writeSummary(filename: str, results: List[Dict], pixelsize: float):
+    alldiameters = np.concatenate([r['diameters'] for r in results]) if results else np.empty(0)
+    total = diameterStatistics(alldiameters)
+    with open(filename, 'wt', encoding='utf-8') as f:
+        f.write('# Number of images: {}\n# Number of circles: {}\n'.format(len(results), len(alldiameters)))
+        f.write(
+            '# Mean diameter: {:.3f}\n# STD diameter: {:.3f}\n# Min diameter: {:.3f}\n# Max diameter: {:.3f}\n'
+            '# P-P diameter: {:.3f}\n'.format(total['mean'], total['std'], total['min'], total['max'], total['ptp']))
+        f.write('# Pixel size: {:.5f}\n'.format(pixelsize))
+        f.write('# Columns: file, number of circles, mean, STD, min, max, P-P diameter\n')
+        for r in results:
+            stats = diameterStatistics(r['diameters'])
+            f.write('{}\t{:d}\t{:.3f}\t{:.3f}\t{:.3f}\t{:.3f}\t{:.3f}\n'.format(
+                r['filename'], len(r['diameters']), stats['mean'], stats['std'], stats['min'], stats['max'],
+                stats['ptp']))
+
+
+def _addCalibrationArguments(parser: argparse.ArgumentParser):
+    calibration = parser.add_mutually_exclusive_group(required=True)
+    calibration.add_argument('-p', '--pixelsize', type=float, help='Pixel size (nm)')
+    calibration.add_argument('-c', '--calibration', type=float, nargs=2, metavar=('LENGTH', 'PIXELS'),
+                             help='Calibrate the pixel size: LENGTH nm corresponds to PIXELS pixels')
+
+
+def _pixelSize(parser: argparse.ArgumentParser, args: argparse.Namespace) -> float:
+    if args.pixelsize is not None:
+        pixelsize = args.pixelsize
+    else:
+        pixelsize = args.calibration[0] / args.calibration[1]
+    if not pixelsize > 0:
+        parser.error('The pixel size must be positive')
+    return pixelsize
+
+
+def main(argv: Optional[Sequence[str]] = None) -> int:
+    parser = argparse.ArgumentParser(prog='tem_circlefind batch',
+                                     description='Find circles in TEM images without the graphical interface')
+    parser.add_argument('inputs', nargs='+', help='Image files or directories containing images')
+    _addCalibrationArguments(parser)
+    parser.add_argument('--min-diameter', type=float, required=True, help='Smallest particle diameter (nm)')
+    parser.add_argument('--max-diameter', type=float, required=True, help='Largest particle diameter (nm)')
+    parser.add_argument('--threshold', type=float, default=1.0, help='Detection threshold (default: %(default)s)')
+    parser.add_argument('--polarity', choices=['dark', 'bright', 'both'], default='both',
+                        help='Contrast of the particles with respect to the background (default: %(default)s)')
+    parser.add_argument('-o', '--output-dir', default=None,
+                        help='Directory for the results files (default: next to the images)')
+    parser.add_argument('-s', '--summary', default=None,
+                        help='Merged summary file (default: summary.txt in the output directory)')
+    parser.add_argument('-j', '--workers', type=int, default=None,
+                        help='Number of worker processes (default: number of CPUs)')
+    args = parser.parse_args(argv)
+
+    pixelsize = _pixelSize(parser, args)
+    if args.output_dir is not None:
+        os.makedirs(args.output_dir, exist_ok=True)
+    images = findImages(args.inputs)
+    if not images:
+        parser.error('No images found')
+
+    results = []
+    failed = 0
+    with ProcessPoolExecutor(max_workers=args.workers) as executor:
+        futures = [executor.submit(processImage, filename, pixelsize, args.min_diameter, args.max_diameter,
+                                   args.output_dir, args.threshold, args.polarity) for filename in images]
+        for filename, future in zip(images, futures):
+            try:
+                result = future.result()
+            except Exception as exc:
+                print('Error while processing {}: {}'.format(filename, exc))
+                failed += 1
+                continue
+            print('{}: {} circles -> {}'.format(filename, len(result['diameters']), result['resultsfile']))
+            results.append(result)
+    summary = args.summary
+    if summary is None:
+        summary = os.path.join(args.output_dir if args.output_dir is not None else os.getcwd(), 'summary.txt')
+    writeSummary(summary, results, pixelsize)
+    print('Summary written to {}'.format(summary))
+    return 1 if failed else 0
+
+
+def recalibrateMain(argv: Optional[Sequence[str]] = None) -> int:
+    parser = argparse.ArgumentParser(
+        prog='tem_circlefind recalibrate',
+        description='Recalculate the physical units in results files from the pixels with a new pixel size')
+    parser.add_argument('inputs', nargs='+', help='Results files (text or binary)')
+    _addCalibrationArguments(parser)
+    parser.add_argument('-o', '--output-dir', default=None,
+                        help='Directory for the recalibrated files (default: the files are overwritten)')
+    args = parser.parse_args(argv)
+
+    pixelsize = _pixelSize(parser, args)
+    if args.output_dir is not None:
+        os.makedirs(args.output_dir, exist_ok=True)
+    failed = 0
+    for filename in args.inputs:
+        outputfile = filename if args.output_dir is None else os.path.join(args.output_dir,
+                                                                            os.path.basename(filename))
+        try:
+            count = recalibrate(filename, pixelsize, outputfile)
+        except (OSError, ValueError) as exc:
+            print('Error while recalibrating {}: {}'.format(filename, exc))
+            failed += 1
+            continue
+        print('{}: {} circles -> {}'.format(filename, count, outputfile))
+    return 1 if failed else 0
@@ -0,0 +1,132 @@
+"""Automatic detection of circular particles by gradient-directed Hough voting
+
+Every strong edge pixel votes for the points lying at a distance r along (or against) its gradient direction, for
+all radii in the requested range. Circle centres show up as peaks in the accumulator, the radius belonging to a
+peak is the one which collected the most votes. Everything is done on whole arrays, without per-pixel loops.
+"""
+
+from typing import Iterator, Tuple
+
+import numpy as np
+from scipy import ndimage
+
+# upper limit of the number of votes handled in one go, to keep the memory footprint bounded
+_VOTECHUNK = 2 ** 23
+
+
+def edgePoints(data: np.ndarray, sigma: float = 1.0, edgefraction: float = 0.05, maxedges: int = 500000) -> Tuple[
+    np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """Find the strongest edge pixels of an image
+
+    Returns the column and row indices of the edge pixels and the unit vector of the gradient (x and y components).
+    """
+    img = np.asarray(data, dtype=np.float32)
+    if sigma > 0:
+        img = ndimage.gaussian_filter(img, sigma)
+    gx = ndimage.sobel(img, axis=1)
+    gy = ndimage.sobel(img, axis=0)
+    magnitude = np.hypot(gx, gy)
+    # the threshold is estimated from a strided subsample: it is accurate enough and much cheaper than a full sort
+    stride = max(1, int(np.sqrt(magnitude.size / 1e6)))
+    threshold = np.quantile(magnitude[::stride, ::stride], 1 - edgefraction)
+    ey, ex = np.nonzero(magnitude > max(threshold, 0))
+    strength = magnitude[ey, ex]
+    if len(ex) > maxedges:
+        strongest = np.argpartition(-strength, maxedges)[:maxedges]
+        ex, ey, strength = ex[strongest], ey[strongest], strength[strongest]
+    return ex, ey, gx[ey, ex] / strength, gy[ey, ex] / strength
+
+
+def _votes(ex: np.ndarray, ey: np.ndarray, ux: np.ndarray, uy: np.ndarray, radii: np.ndarray,
+           shape: Tuple[int, int], polarity: str) -> Iterator[Tuple[np.ndarray, np.ndarray]]:
+    """Generate the votes of the edge pixels in chunks
+
+    Yields pairs of arrays: the flat index of the accumulator cell voted for and the index of the radius.
+    """
+    if polarity == 'dark':
+        # dark particle on a bright background: the gradient points outwards
+        signs = [-1]
+    elif polarity == 'bright':
+        signs = [1]
+    elif polarity == 'both':
+        signs = [-1, 1]
+    else:
+        raise ValueError(f'Invalid polarity: {polarity}')
+    radiichunk = max(1, _VOTECHUNK // max(len(ex), 1))
+    for sign in signs:
+        for start in range(0, len(radii), radiichunk):
+            r = radii[start:start + radiichunk]
+            cx = np.rint(ex[:, np.newaxis] + sign * ux[:, np.newaxis] * r[np.newaxis, :]).astype(np.intp)
+            cy = np.rint(ey[:, np.newaxis] + sign * uy[:, np.newaxis] * r[np.newaxis, :]).astype(np.intp)
+            ridx = np.broadcast_to(np.arange(start, start + len(r)), cx.shape)
+            valid = (cx >= 0) & (cx < shape[1]) & (cy >= 0) & (cy < shape[0])
+            yield cy[valid] * shape[1] + cx[valid], ridx[valid]
+
+
+def findCircles(data: np.ndarray, mindiameter: float, maxdiameter: float, threshold: float = 1.0,
+                sigma: float = 1.0, edgefraction: float = 0.05, polarity: str = 'both',
+                maxedges: int = 500000) -> np.ndarray:
+    """Detect circles in an image
+
+    :param data: two-dimensional image
+    :param mindiameter: smallest diameter to look for (pixels)
+    :param maxdiameter: largest diameter to look for (pixels)
+    :param threshold: minimum number of votes per unit length of the circumference. As edges are a few pixels wide,
+        values around 1 are reasonable.
+    :param sigma: width of the Gaussian smoothing applied before computing the gradient (pixels)
+    :param edgefraction: fraction of the pixels considered as edge points
+    :param polarity: 'dark' (dark particles on bright background), 'bright' or 'both'
+    :param maxedges: upper limit of the number of edge points used in the voting
+    :return: array of shape (N, 3): x and y coordinates of the centres and the diameters, all in pixels. Rows are
+        sorted in decreasing order of the detection score.
+    """
+    data = np.asarray(data)
+    if data.ndim != 2:
+        raise ValueError('Circle detection needs a two-dimensional image')
+    if not (0 < mindiameter <= maxdiameter):
+        raise ValueError('Invalid diameter range')
+    shape = data.shape
+    radii = np.arange(max(mindiameter * 0.5, 1.0), maxdiameter * 0.5 + 1, 1.0)
+    ex, ey, ux, uy = edgePoints(data, sigma, edgefraction, maxedges)
+    if len(ex) == 0:
+        return np.empty((0, 3))
+
+    # first pass: locate the centres
+    accumulator = np.zeros(shape[0] * shape[1], dtype=np.float64)
+    for flat, ridx in _votes(ex, ey, ux, uy, radii, shape, polarity):
+        accumulator += np.bincount(flat, minlength=accumulator.size)
+    accumulator = accumulator.reshape(shape)
+    # rounding spreads the votes of a centre over its neighbourhood: gather them back
+    accumulator = ndimage.uniform_filter(accumulator, 3, mode='constant') * 9
+    minvotes = threshold * 2 * np.pi * radii[0]
+    peaks = (ndimage.maximum_filter(accumulator, size=max(3, int(radii[0])), mode='constant') == accumulator) & (
+            accumulator >= minvotes)
+    py, px = np.nonzero(peaks)
+    if len(px) == 0:
+        return np.empty((0, 3))
+
+    # second pass: histogram the radii of the votes falling on the peaks
+    labels = np.zeros(shape, dtype=np.intp)
+    labels[py, px] = np.arange(1, len(px) + 1)
+    labels = ndimage.grey_dilation(labels, size=3).ravel()
+    radiushist = np.zeros((len(px) + 1) * len(radii), dtype=np.float64)
+    for flat, ridx in _votes(ex, ey, ux, uy, radii, shape, polarity):
+        lab = labels[flat]
+        onpeak = lab > 0
+        radiushist += np.bincount(lab[onpeak] * len(radii) + ridx[onpeak], minlength=radiushist.size)
+    # votes of neighbouring radii belong to the same circle as well
+    radiushist = ndimage.uniform_filter1d(radiushist.reshape(len(px) + 1, len(radii))[1:], 3, axis=1,
+                                          mode='constant') * 3
+    best = radiushist.argmax(axis=1)
+    # sub-pixel radius from a parabola through the best radius bin and its neighbours
+    left = radiushist[np.arange(len(px)), np.clip(best - 1, 0, len(radii) - 1)]
+    centre = radiushist[np.arange(len(px)), best]
+    right = radiushist[np.arange(len(px)), np.clip(best + 1, 0, len(radii) - 1)]
+    denominator = left - 2 * centre + right
+    with np.errstate(divide='ignore', invalid='ignore'):
+        shift = np.where(denominator < 0, 0.5 * (left - right) / denominator, 0)
+    radius = radii[best] + np.clip(shift, -0.5, 0.5) * (radii[1] - radii[0] if len(radii) > 1 else 0)
+    score = centre / (2 * np.pi * radius)
+    accepted = score >= threshold
+    order = np.argsort(-score[accepted])
+    return np.column_stack([px[accepted], py[accepted], 2 * radius[accepted]])[order].astype(np.float64)
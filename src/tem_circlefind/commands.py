@@ -0,0 +1,158 @@
+"""Undoable changes of the results, the pending clicks and the pixel size
+
+The changes made in the GUI are pushed onto a QUndoStack as commands. Each command keeps only what it changes: the
+rows appended, or the indices and contents of the rows removed, never a copy of the whole list. Undoing an append
+removes the last rows, undoing a removal inserts the rows back at their original places. Rows are kept in pixels, as
+stored in the results model: commands are not affected by changes of the pixel size made in the meantime.
+
+Commands address rows by their indices, thus the models must not be changed behind the back of the undo stack: the
+stack has to be cleared when their contents are replaced (e.g. when switching images in a project). The exception are
+the pending clicks, which are dropped without the undo stack when another frame is shown: the click commands only act
+on the clicks of the frame they were made on, and do nothing on other frames.
+"""
+
+from typing import Iterable, Optional
+
+import numpy as np
+from PyQt5 import QtWidgets
+
+from .pendingclicksmodel import PendingClicksModel
+from .resultsfile import withFrames
+from .resultsmodel import ResultsModel
+
+
+class AppendResultsCommand(QtWidgets.QUndoCommand):
+    """Append rows of x, y, diameter (in pixels) and frame"""
+
+    def __init__(self, model: ResultsModel, rows: np.ndarray, text: str = 'Add circles',
+                 parent: Optional[QtWidgets.QUndoCommand] = None):
+        super().__init__(text, parent)
+        self.model = model
+        self.rows = np.array(withFrames(rows))
+        self._first = None
+
+    def redo(self):
+        self._first = self.model.rowCount()
+        self.model.extendPixels(self.rows)
+
+    def undo(self):
+        self.model.removeRowList(range(self._first, self._first + len(self.rows)))
+
+
+class RemoveResultsCommand(QtWidgets.QUndoCommand):
+    def __init__(self, model: ResultsModel, rows: Iterable[int], text: str = 'Remove circles',
+                 parent: Optional[QtWidgets.QUndoCommand] = None):
+        super().__init__(text, parent)
+        self.model = model
+        self.indices = np.unique(np.fromiter(rows, dtype=np.intp))
+        self.rows = None
+
+    def redo(self):
+        self.rows = self.model.getPixelData()[self.indices]
+        self.model.removeRowList(self.indices)
+
+    def undo(self):
+        self.model.insertRowList(self.indices, self.rows)
+
+
+class ClearResultsCommand(QtWidgets.QUndoCommand):
+    def __init__(self, model: ResultsModel, text: str = 'Clear results',
+                 parent: Optional[QtWidgets.QUndoCommand] = None):
+        super().__init__(text, parent)
+        self.model = model
+        self.rows = None
+
+    def redo(self):
+        self.rows = self.model.getPixelData().copy()
+        self.model.clear()
+
+    def undo(self):
+        self.model.extendPixels(self.rows)
+
+
+class SetPixelSizeCommand(QtWidgets.QUndoCommand):
+    """Change the pixel size. Consecutive `mergeable` changes (editing the value by hand) are a single undo step."""
+
+    ID = 1
+
+    def __init__(self, model: ResultsModel, pixelsize: float, text: str = 'Set pixel size',
+                 parent: Optional[QtWidgets.QUndoCommand] = None, mergeable: bool = False):
+        super().__init__(text, parent)
+        self.model = model
+        self.old = model.pixelSize
+        self.new = pixelsize
+        self.mergeable = mergeable
+
+    def id(self) -> int:
+        return self.ID if self.mergeable else -1
+
+    def mergeWith(self, other: QtWidgets.QUndoCommand) -> bool:
+        if not (isinstance(other, SetPixelSizeCommand) and other.mergeable):
+            return False
+        self.new = other.new
+        return True
+
+    def redo(self):
+        self.model.setPixelSize(self.new)
+
+    def undo(self):
+        self.model.setPixelSize(self.old)
+
+
+class AppendClickCommand(QtWidgets.QUndoCommand):
+    def __init__(self, model: PendingClicksModel, x: float, y: float, text: str = 'Click',
+                 parent: Optional[QtWidgets.QUndoCommand] = None):
+        super().__init__(text, parent)
+        self.model = model
+        self.point = (x, y)
+        self.frame = model.frame
+
+    def redo(self):
+        if self.model.frame == self.frame:
+            self.model.append(*self.point)
+
+    def undo(self):
+        if self.model.frame == self.frame and self.model.rowCount():
+            self.model.removeRow(self.model.rowCount() - 1)
+
+
+class PopClicksCommand(QtWidgets.QUndoCommand):
+    """Take the first `number` pending clicks. They are available in `points` after the command has been pushed."""
+
+    def __init__(self, model: PendingClicksModel, number: int, text: str = 'Use clicks',
+                 parent: Optional[QtWidgets.QUndoCommand] = None):
+        super().__init__(text, parent)
+        self.model = model
+        self.number = number
+        self.points = None
+        self.frame = model.frame
+
+    def redo(self):
+        if self.model.frame != self.frame:
+            self.points = []
+            return
+        self.points = self.model.pop(min(self.number, self.model.rowCount()))
+
+    def undo(self):
+        if self.model.frame == self.frame:
+            self.model.insertPoints(0, self.points)
+
+
+class ClearClicksCommand(QtWidgets.QUndoCommand):
+    def __init__(self, model: PendingClicksModel, text: str = 'Forget clicks',
+                 parent: Optional[QtWidgets.QUndoCommand] = None):
+        super().__init__(text, parent)
+        self.model = model
+        self.points = None
+        self.frame = model.frame
+
+    def redo(self):
+        if self.model.frame != self.frame:
+            self.points = []
+            return
+        self.points = self.model.getData()
+        self.model.clear()
+
+    def undo(self):
+        if self.model.frame == self.frame:
+            self.model.insertPoints(0, self.points)
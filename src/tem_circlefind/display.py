@@ -0,0 +1,187 @@
+"""Conversion of micrographs to 8-bit display data
+
+The pixel values are mapped to 0-255 once, tile by tile when first shown, and the results are kept for each pyramid
+level: the raw (16-bit integer or floating point) data are neither normalized again at each redraw, zoom and pan, nor
+kept in memory at their full size. The conversion is repeated only when the display settings change.
+
+The contrast mapping is determined from a strided subsample of the full resolution image (the coarser pyramid levels
+are averaged, thus less noisy, and would underestimate the spread of the pixel values). Modes:
+    'minmax': the full range of the pixel values
+    'percentile': from the `low` to the `high` percentile, values outside are saturated
+    'equalize': histogram equalization, i.e. the mapping follows the cumulative distribution of the pixel values
+
+Optionally, the slowly varying background (uneven illumination or thickness) is subtracted before the mapping
+(`flatten`: the width of the Gaussian giving the background, in pixels), and the image is smoothed with a Gaussian
+filter to suppress the noise (`denoise`: the width of the Gaussian, in pixels). Both widths are given in image
+pixels, and are scaled for the coarser pyramid levels.
+
+No Qt or matplotlib here.
+"""
+
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+
+from .imagesource import ImagePyramid
+from .profiling import timed
+
+CONTRAST_MODES = ('minmax', 'percentile', 'equalize')
+
+DEFAULT_SETTINGS = {'contrast': 'percentile', 'low': 0.5, 'high': 99.5, 'flatten': 0.0, 'denoise': 0.0}
+
+
+def _gaussian(data: np.ndarray, sigma: float) -> np.ndarray:
+    # scipy.ndimage takes long to import: not needed unless flattening or denoising is requested
+    import scipy.ndimage
+    return scipy.ndimage.gaussian_filter(data, sigma, mode='nearest')
+
+
+class DisplayPipeline:
+    def __init__(self, pyramid: ImagePyramid, maxsamples: int = 2 ** 16, **settings):
+        self.pyramid = pyramid
+        self.maxsamples = maxsamples
+        self._settings: Dict[str, Any] = {}
+        self.setSettings(**dict(DEFAULT_SETTINGS, **settings))
+
+    @property
+    def settings(self) -> Dict[str, Any]:
+        return dict(self._settings)
+
+    def setSettings(self, **settings) -> bool:
+        """Change some of the settings. Returns True if the display data have to be renewed."""
+        unknown = set(settings) - set(DEFAULT_SETTINGS)
+        if unknown:
+            raise TypeError('Unknown display setting(s): {}'.format(', '.join(sorted(unknown))))
+        newsettings = dict(self._settings, **settings)
+        if newsettings['contrast'] not in CONTRAST_MODES:
+            raise ValueError('Unknown contrast mode: {}'.format(newsettings['contrast']))
+        if newsettings == self._settings:
+            return False
+        self._settings = newsettings
+        # uint8 data of each level, and which of their tiles have already been converted
+        self._buffers: List[Optional[np.ndarray]] = [None] * self.pyramid.nlevels
+        self._converted: List[Optional[np.ndarray]] = [None] * self.pyramid.nlevels
+        self._background = None
+        self._mapping = None
+        self._lut = None
+        return True
+
+    def _backgroundMap(self) -> np.ndarray:
+        """The background at the resolution of the coarsest level"""
+        if self._background is None:
+            coarsest = self.pyramid.nlevels - 1
+            data = np.asarray(self.pyramid.level(coarsest), dtype=np.float32)
+            self._background = _gaussian(data, self._settings['flatten'] / 2 ** coarsest)
+        return self._background
+
+    def _backgroundGrid(self, level: int, rows: np.ndarray, columns: np.ndarray) -> np.ndarray:
+        """The background at a grid of pixels of a level, interpolated bilinearly from the coarsest level"""
+        background = self._backgroundMap()
+        scale = 2.0 ** (level - (self.pyramid.nlevels - 1))
+
+        def interpolation(indices: np.ndarray, size: int) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+            # pixel centres of this level in the pixel coordinates of the coarsest level
+            position = np.clip((indices + 0.5) * scale - 0.5, 0, size - 1)
+            lower = np.minimum(np.floor(position).astype(np.intp), max(size - 2, 0))
+            return lower, np.minimum(lower + 1, size - 1), (position - lower).astype(np.float32)
+
+        r0, r1, rw = interpolation(rows, background.shape[0])
+        c0, c1, cw = interpolation(columns, background.shape[1])
+        rows = background[r0] * (1 - rw[:, np.newaxis]) + background[r1] * rw[:, np.newaxis]
+        return rows[:, c0] * (1 - cw) + rows[:, c1] * cw
+
+    def _sample(self) -> np.ndarray:
+        """Pixel values (after background subtraction) from a strided subsample of the full resolution image"""
+        data = self.pyramid.level(0)
+        stride = max(1, int(np.ceil(np.sqrt(data.shape[0] * data.shape[1] / self.maxsamples))))
+        # only every stride-th row is read from a memory-mapped file
+        sample = np.asarray(data[::stride, ::stride], dtype=np.float32)
+        if self._settings['flatten'] > 0:
+            sample = sample - self._backgroundGrid(0, np.arange(0, data.shape[0], stride),
+                                                   np.arange(0, data.shape[1], stride))
+        sample = sample.ravel()
+        return sample[np.isfinite(sample)]
+
+    def mapping(self) -> Tuple[np.ndarray, np.ndarray]:
+        """Pixel values and the corresponding display values (0-255): the mapping is linear between these points"""
+        if self._mapping is None:
+            sample = self._sample()
+            contrast = self._settings['contrast']
+            if not len(sample):
+                values = np.array([0.0, 1.0])
+            elif contrast == 'minmax':
+                values = np.array([sample.min(), sample.max()], dtype=np.float64)
+            elif contrast == 'percentile':
+                values = np.percentile(sample, [self._settings['low'], self._settings['high']])
+            else:
+                values = np.percentile(sample, np.linspace(0, 100, 257))
+            if not values[-1] > values[0]:
+                # constant image
+                values = np.array([values[0] - 0.5, values[0] + 0.5])
+            self._mapping = (values, np.linspace(0, 255, len(values)))
+        return self._mapping
+
+    def _toUint8(self, values: np.ndarray) -> np.ndarray:
+        if values.dtype.kind in 'ui' and values.dtype.itemsize <= 2:
+            # raw 8- or 16-bit data (neither flattened nor denoised): a lookup table over all possible values
+            info = np.iinfo(values.dtype)
+            if self._lut is None or self._lut[0] != values.dtype:
+                xp, fp = self.mapping()
+                self._lut = (values.dtype, (np.interp(np.arange(info.min, info.max + 1), xp, fp) + 0.5).astype(
+                    np.uint8))
+            return self._lut[1].take(values.astype(np.intp) - info.min if info.min else values)
+        xp, fp = self.mapping()
+        # NaN pixels become black
+        with np.errstate(invalid='ignore'):
+            if len(xp) == 2:
+                # linear: faster than np.interp()
+                return np.clip((values - xp[0]) * (255 / (xp[1] - xp[0])) + 0.5, 0, 255.5).astype(np.uint8)
+            return (np.interp(values, xp, fp) + 0.5).astype(np.uint8)
+
+    def _convertTile(self, level: int, row0: int, row1: int, col0: int, col1: int) -> np.ndarray:
+        data = self.pyramid.level(level)
+        sigma = self._settings['denoise'] / 2 ** level
+        if sigma < 0.3:
+            # the filter would have no visible effect at this level
+            region = data[row0:row1, col0:col1]
+            if self._settings['flatten'] > 0:
+                region = np.asarray(region, dtype=np.float32) - self._backgroundGrid(
+                    level, np.arange(row0, row1), np.arange(col0, col1))
+            return self._toUint8(region)
+        # filter a padded region to avoid boundary effects at the tile edges
+        pad = int(np.ceil(4 * sigma)) + 1
+        prow0, pcol0 = max(row0 - pad, 0), max(col0 - pad, 0)
+        prow1, pcol1 = min(row1 + pad, data.shape[0]), min(col1 + pad, data.shape[1])
+        region = np.asarray(data[prow0:prow1, pcol0:pcol1], dtype=np.float32)
+        if self._settings['flatten'] > 0:
+            region = region - self._backgroundGrid(level, np.arange(prow0, prow1), np.arange(pcol0, pcol1))
+        region = _gaussian(region, sigma)[row0 - prow0:row1 - prow0, col0 - pcol0:col1 - pcol0]
+        return self._toUint8(region)
+
+    @timed()
+    def convert(self, level: int, row0: int, row1: int, col0: int, col1: int) -> np.ndarray:
+        """uint8 display data of a region of a level, converting the tiles not yet done"""
+        if self._buffers[level] is None:
+            shape = self.pyramid.level(level).shape
+            tile = self.pyramid.tilesize
+            # not initialized: pages of the memory are only allocated when the tiles are converted
+            self._buffers[level] = np.empty(shape, dtype=np.uint8)
+            self._converted[level] = np.zeros((-(-shape[0] // tile), -(-shape[1] // tile)), dtype=bool)
+        buffer, converted = self._buffers[level], self._converted[level]
+        tile = self.pyramid.tilesize
+        for trow in range(row0 // tile, -(-row1 // tile)):
+            for tcol in range(col0 // tile, -(-col1 // tile)):
+                if converted[trow, tcol]:
+                    continue
+                r0, r1 = trow * tile, min((trow + 1) * tile, buffer.shape[0])
+                c0, c1 = tcol * tile, min((tcol + 1) * tile, buffer.shape[1])
+                buffer[r0:r1, c0:c1] = self._convertTile(level, r0, r1, c0, c1)
+                converted[trow, tcol] = True
+        return buffer[row0:row1, col0:col1]
+
+    def view(self, level: int, xmin: float, xmax: float, ymin: float, ymax: float) -> Tuple[
+        np.ndarray, Tuple[float, float, float, float], Tuple[int, int, int, int, int]]:
+        """The same as ImagePyramid.view(), but with uint8 display data"""
+        data, extent, key = self.pyramid.view(level, xmin, xmax, ymin, ymax)
+        level, row0, row1, col0, col1 = key
+        return self.convert(level, row0, row1, col0, col1), extent, key
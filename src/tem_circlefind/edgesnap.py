@@ -0,0 +1,97 @@
+"""Sub-pixel refinement of clicks to nearby edges
+
+Gaussian gradient maps of the image are computed in tiles, when first needed, and cached: snapping a click only
+involves looking up a small window of the precomputed maps. The clicked point is moved to the nearest strong edge
+pixel in the window (local maximum of the gradient magnitude along the gradient direction), then refined along the
+gradient direction to the maximum of the gradient magnitude, found by fitting a parabola.
+"""
+
+from collections import OrderedDict
+from typing import Tuple
+
+import numpy as np
+import scipy.ndimage
+
+
+class EdgeSnapper:
+    def __init__(self, data: np.ndarray, sigma: float = 1.0, tilesize: int = 256, maxtiles: int = 64):
+        self.data = data
+        self.sigma = sigma
+        self.tilesize = tilesize
+        self.maxtiles = maxtiles
+        # (tile row, tile column) -> array of shape (3, rows, columns): x and y gradient, gradient magnitude
+        self._tiles: 'OrderedDict[Tuple[int, int], np.ndarray]' = OrderedDict()
+
+    def _tile(self, trow: int, tcol: int) -> np.ndarray:
+        key = (trow, tcol)
+        try:
+            self._tiles.move_to_end(key)
+            return self._tiles[key]
+        except KeyError:
+            pass
+        # compute on a padded region to avoid boundary effects of the filter at the tile edges
+        pad = int(np.ceil(4 * self.sigma)) + 1
+        row0, col0 = trow * self.tilesize, tcol * self.tilesize
+        row1, col1 = min(row0 + self.tilesize, self.data.shape[0]), min(col0 + self.tilesize, self.data.shape[1])
+        prow0, pcol0 = max(row0 - pad, 0), max(col0 - pad, 0)
+        region = np.asarray(self.data[prow0:min(row1 + pad, self.data.shape[0]),
+                            pcol0:min(col1 + pad, self.data.shape[1])], dtype=np.float32)
+        crop = (slice(row0 - prow0, row1 - prow0), slice(col0 - pcol0, col1 - pcol0))
+        gx = scipy.ndimage.gaussian_filter(region, self.sigma, order=(0, 1))[crop]
+        gy = scipy.ndimage.gaussian_filter(region, self.sigma, order=(1, 0))[crop]
+        tile = np.stack([gx, gy, np.hypot(gx, gy)])
+        self._tiles[key] = tile
+        while len(self._tiles) > self.maxtiles:
+            self._tiles.popitem(last=False)
+        return tile
+
+    def gradients(self, row0: int, row1: int, col0: int, col1: int) -> np.ndarray:
+        """x and y gradient and gradient magnitude in a region of the image: shape (3, row1-row0, col1-col0)"""
+        result = np.empty((3, row1 - row0, col1 - col0), dtype=np.float32)
+        ts = self.tilesize
+        for trow in range(row0 // ts, (row1 - 1) // ts + 1):
+            for tcol in range(col0 // ts, (col1 - 1) // ts + 1):
+                tile = self._tile(trow, tcol)
+                r0, r1 = max(row0, trow * ts), min(row1, (trow + 1) * ts)
+                c0, c1 = max(col0, tcol * ts), min(col1, (tcol + 1) * ts)
+                result[:, r0 - row0:r1 - row0, c0 - col0:c1 - col0] = \
+                    tile[:, r0 - trow * ts:r1 - trow * ts, c0 - tcol * ts:c1 - tcol * ts]
+        return result
+
+    def snap(self, x: float, y: float, window: int = 5, strength: float = 0.5) -> Tuple[float, float]:
+        """Move a point (x: column, y: row coordinate) to the nearest edge within `window` pixels
+
+        Edge pixels are those where the gradient magnitude is at least `strength` times its maximum in the window.
+        The point is returned unchanged if it is outside the image or there is no edge in the window.
+        """
+        col, row = int(round(x)), int(round(y))
+        height, width = self.data.shape
+        if not (0 <= row < height and 0 <= col < width):
+            return x, y
+        # one more pixel on each side, for the neighbours of the pixels at the border of the window
+        row0, row1 = max(row - window - 1, 0), min(row + window + 2, height)
+        col0, col1 = max(col - window - 1, 0), min(col + window + 2, width)
+        gx, gy, magnitude = self.gradients(row0, row1, col0, col1)
+        if not magnitude.max() > 0:
+            return x, y
+        # magnitudes one pixel before and after each pixel along the gradient direction
+        with np.errstate(invalid='ignore', divide='ignore'):
+            normalrow, normalcol = np.nan_to_num(gy / magnitude), np.nan_to_num(gx / magnitude)
+        rows, cols = np.indices(magnitude.shape)
+        before = scipy.ndimage.map_coordinates(magnitude, [rows - normalrow, cols - normalcol], order=1,
+                                               mode='nearest')
+        after = scipy.ndimage.map_coordinates(magnitude, [rows + normalrow, cols + normalcol], order=1,
+                                              mode='nearest')
+        # edge pixels: strong local maxima of the gradient magnitude along the gradient (non-maximum suppression)
+        edge = (magnitude >= strength * magnitude[1:-1, 1:-1].max()) & (magnitude >= before) & (magnitude >= after)
+        edge[[0, -1], :] = edge[:, [0, -1]] = False
+        if not edge.any():
+            return x, y
+        rows, cols = np.nonzero(edge)
+        nearest = np.argmin((rows + row0 - y) ** 2 + (cols + col0 - x) ** 2)
+        r, c = rows[nearest], cols[nearest]
+        # sub-pixel refinement: vertex of the parabola through the three magnitudes along the gradient
+        curvature = before[r, c] - 2 * magnitude[r, c] + after[r, c]
+        offset = 0.5 * (before[r, c] - after[r, c]) / curvature if curvature < 0 else 0.0
+        offset = float(np.clip(offset, -0.5, 0.5))
+        return float(c + col0 + offset * normalcol[r, c]), float(r + row0 + offset * normalrow[r, c])
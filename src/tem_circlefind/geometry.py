@@ -0,0 +1,116 @@
+"""Vectorized circle geometry
+
+All functions work on stacks of point sets: the last axis holds the (x, y) coordinates, the one before it enumerates
+the points belonging to the same circle, any leading axes are batch dimensions. Circles are returned as
+(x, y, diameter) triplets along the last axis, in the units of the input coordinates. Degenerate input (coincident or
+collinear points) gives NaN instead of raising an exception, so that one bad point set does not spoil a whole batch.
+
+For the least-squares fits, point sets of different size can be processed in the same call by padding the smaller
+ones with NaN points: non-finite points are ignored.
+"""
+
+import numpy as np
+
+# relative tolerance for detecting collinear / coincident points
+_DEGENERACYTOLERANCE = 1e-10
+# condition number above which a least-squares problem is considered degenerate
+_MAXCONDITION = 1e12
+
+
+def distances(points: np.ndarray) -> np.ndarray:
+    """Distance between two points: (..., 2, 2) -> (...)"""
+    points = np.asarray(points, dtype=np.float64)
+    return np.hypot(points[..., 0, 0] - points[..., 1, 0], points[..., 0, 1] - points[..., 1, 1])
+
+
+def twoPointCircles(points: np.ndarray) -> np.ndarray:
+    """Circles from the endpoints of their diameters: (..., 2, 2) -> (..., 3)"""
+    points = np.asarray(points, dtype=np.float64)
+    centre = points.mean(axis=-2)
+    diameter = distances(points)
+    return np.concatenate([centre, diameter[..., np.newaxis]], axis=-1)
+
+
+def threePointCircles(points: np.ndarray) -> np.ndarray:
+    """Circumscribed circles of triangles: (..., 3, 2) -> (..., 3). Collinear points give NaN."""
+    points = np.asarray(points, dtype=np.float64)
+    # work relative to the first point for better precision
+    b = points[..., 1, :] - points[..., 0, :]
+    c = points[..., 2, :] - points[..., 0, :]
+    d = 2 * (b[..., 0] * c[..., 1] - b[..., 1] * c[..., 0])
+    b2 = (b ** 2).sum(axis=-1)
+    c2 = (c ** 2).sum(axis=-1)
+    scale = np.maximum(np.maximum(b2, c2), ((b - c) ** 2).sum(axis=-1))
+    degenerate = np.abs(d) <= _DEGENERACYTOLERANCE * scale
+    with np.errstate(divide='ignore', invalid='ignore'):
+        d = np.where(degenerate, np.nan, d)
+        ux = (c[..., 1] * b2 - b[..., 1] * c2) / d
+        uy = (b[..., 0] * c2 - c[..., 0] * b2) / d
+    return np.stack([ux + points[..., 0, 0], uy + points[..., 0, 1], 2 * np.hypot(ux, uy)], axis=-1)
+
+
+def _validPoints(points: np.ndarray):
+    points = np.asarray(points, dtype=np.float64)
+    valid = np.isfinite(points).all(axis=-1)
+    points = np.where(valid[..., np.newaxis], points, 0.0)
+    return points, valid.astype(np.float64)
+
+
+def _solve(matrix: np.ndarray, vector: np.ndarray) -> np.ndarray:
+    """Solve a stack of small linear systems, giving NaN for the (nearly) singular ones"""
+    finite = np.isfinite(matrix).all(axis=(-2, -1)) & np.isfinite(vector).all(axis=-1)
+    matrix = np.where(finite[..., np.newaxis, np.newaxis], matrix, np.eye(matrix.shape[-1]))
+    degenerate = ~(finite & (np.linalg.cond(matrix) < _MAXCONDITION))
+    matrix = np.where(degenerate[..., np.newaxis, np.newaxis], np.eye(matrix.shape[-1]), matrix)
+    vector = np.where(degenerate[..., np.newaxis], 0.0, vector)
+    solution = np.linalg.solve(matrix, vector[..., np.newaxis])[..., 0]
+    return np.where(degenerate[..., np.newaxis], np.nan, solution)
+
+
+def fitCircleKasa(points: np.ndarray) -> np.ndarray:
+    """Algebraic (Kasa) least-squares circle fit: (..., N, 2) -> (..., 3), N >= 3
+
+    Minimizes sum((x^2 + y^2 + D*x + E*y + F)^2). Fast and non-iterative, but biased towards smaller circles when
+    the points cover only a short arc.
+    """
+    points, weight = _validPoints(points)
+    count = np.maximum(weight.sum(axis=-1), 1)
+    # centre the points for a well-conditioned problem
+    mean = (points * weight[..., np.newaxis]).sum(axis=-2) / count[..., np.newaxis]
+    x = (points[..., 0] - mean[..., 0, np.newaxis]) * weight
+    y = (points[..., 1] - mean[..., 1, np.newaxis]) * weight
+    z = x ** 2 + y ** 2
+    design = np.stack([x, y, weight], axis=-1)
+    normal = np.einsum('...ki,...kj->...ij', design, design)
+    rhs = -np.einsum('...ki,...k->...i', design, z)
+    d, e, f = np.moveaxis(_solve(normal, rhs), -1, 0)
+    with np.errstate(invalid='ignore'):
+        radius = np.sqrt(d ** 2 / 4 + e ** 2 / 4 - f)
+    return np.stack([mean[..., 0] - d / 2, mean[..., 1] - e / 2, 2 * radius], axis=-1)
+
+
+def fitCircleGeometric(points: np.ndarray, maxiter: int = 50, tolerance: float = 1e-10) -> np.ndarray:
+    """Geometric least-squares circle fit: (..., N, 2) -> (..., 3), N >= 3
+
+    Minimizes the sum of squared distances of the points from the circle by Gauss-Newton iterations, started from
+    the algebraic fit. All circles of the batch are iterated together.
+    """
+    start = fitCircleKasa(points)
+    points, weight = _validPoints(points)
+    params = np.stack([start[..., 0], start[..., 1], start[..., 2] / 2], axis=-1)
+    for iteration in range(maxiter):
+        dx = points[..., 0] - params[..., 0, np.newaxis]
+        dy = points[..., 1] - params[..., 1, np.newaxis]
+        dist = np.hypot(dx, dy)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            # a point exactly in the centre has no defined direction: leave it out of this step
+            inv = np.where(dist > 0, weight / dist, 0.0)
+        residual = (dist - params[..., 2, np.newaxis]) * weight
+        jacobian = np.stack([-dx * inv, -dy * inv, -weight], axis=-1)
+        normal = np.einsum('...ki,...kj->...ij', jacobian, jacobian)
+        rhs = -np.einsum('...ki,...k->...i', jacobian, residual)
+        step = _solve(normal, rhs)
+        params = params + step
+        if not (np.abs(step) > tolerance * np.maximum(np.abs(params[..., 2:3]), 1)).any():
+            break
+    return np.stack([params[..., 0], params[..., 1], 2 * np.abs(params[..., 2])], axis=-1)
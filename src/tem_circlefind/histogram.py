@@ -0,0 +1,70 @@
+"""Incrementally maintained histogram
+
+The bin edges are fixed as long as possible: adding or removing values only updates the counts of the affected
+bins. The edges are recalculated from the full data set only if the number of bins is changed, or if a new value falls
+outside the current range.
+"""
+
+from typing import Tuple
+
+import numpy as np
+
+
+class IncrementalHistogram:
+    def __init__(self, nbins: int = 10):
+        self.nbins = nbins
+        self.edges = np.linspace(0, 1, nbins + 1)
+        self.counts = np.zeros(nbins, dtype=np.int64)
+        self._valid = False
+
+    def setBins(self, nbins: int):
+        if nbins != self.nbins:
+            self.nbins = nbins
+            self.invalidate()
+
+    def invalidate(self):
+        """Recalculate the edges and the counts from the full data set on the next update()"""
+        self._valid = False
+
+    def _bincount(self, values: np.ndarray) -> np.ndarray:
+        # the same bin assignment must be used for adding and removing values, thus np.histogram() is not used
+        index = np.searchsorted(self.edges, values, side='right') - 1
+        # the last bin is closed from the right, as in np.histogram()
+        index[values == self.edges[-1]] = self.nbins - 1
+        return np.bincount(index, minlength=self.nbins)
+
+    def add(self, values: np.ndarray):
+        if not self._valid:
+            return
+        values = np.asarray(values, dtype=np.float64)
+        values = values[np.isfinite(values)]
+        if not len(values):
+            return
+        if values.min() < self.edges[0] or values.max() > self.edges[-1]:
+            self.invalidate()
+        else:
+            self.counts += self._bincount(values)
+
+    def remove(self, values: np.ndarray):
+        if not self._valid:
+            return
+        values = np.asarray(values, dtype=np.float64)
+        values = values[np.isfinite(values)]
+        if len(values):
+            self.counts -= self._bincount(values)
+
+    def update(self, data: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """Get the counts and the bin edges. `data` is the full data set, only used if recalculation is needed."""
+        if not self._valid:
+            data = np.asarray(data, dtype=np.float64)
+            data = data[np.isfinite(data)]
+            if not len(data):
+                lo, hi = 0.0, 1.0
+            else:
+                lo, hi = float(data.min()), float(data.max())
+                if lo == hi:
+                    lo, hi = lo - 0.5, hi + 0.5
+            self.edges = np.linspace(lo, hi, self.nbins + 1)
+            self.counts = self._bincount(data)
+            self._valid = True
+        return self.counts, self.edges
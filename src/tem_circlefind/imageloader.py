@@ -0,0 +1,179 @@
+"""Loading images in background threads, with prefetching and caching
+
+Images are opened (and their display pyramid prepared) in a thread pool, the result is delivered through a Qt
+signal. After each request the next few images in the same directory are loaded as well, into a least-recently-used
+cache with a memory budget, making stepping through a series of micrographs instant. Likewise, the neighbours of the
+frame shown from an image stack can be read in advance.
+
+Images dropped from the cache are closed (releasing their files), except the one delivered last, which may still be on
+display: it is closed when it is replaced by another one.
+"""
+
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+from PyQt5 import QtCore
+
+from .imagesource import ImageSource, siblingImages
+
+CacheKey = Tuple[str, int]
+
+
+def _openImage(filename: str) -> ImageSource:
+    source = ImageSource(filename)
+    # compute the coarse pyramid levels needed for the first display here, not in the GUI thread
+    source.pyramid.dataRange()
+    return source
+
+
+def _prepareFrame(source: ImageSource, frame: int):
+    source.frame(frame).dataRange()
+
+
+def _memoryFootprint(source: ImageSource) -> int:
+    # memory-mapped data is backed by the file and does not count
+    return sum(level.nbytes for pyramid in source.cachedPyramids() for level in pyramid.computedLevels()
+               if not isinstance(level, np.memmap))
+
+
+class ImageLoader(QtCore.QObject):
+    imageLoaded = QtCore.pyqtSignal(str, object)
+    loadFailed = QtCore.pyqtSignal(str, str)
+
+    def __init__(self, parent=None, prefetch: int = 2, memorybudget: int = 1024 ** 3, workers: int = 2):
+        super().__init__(parent)
+        self.prefetch = prefetch
+        self.memorybudget = memorybudget
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='imageloader')
+        self._lock = threading.Lock()
+        self._cache: 'OrderedDict[CacheKey, ImageSource]' = OrderedDict()
+        self._pending: Dict[CacheKey, Future] = {}
+        self._requested = None
+        # the image delivered last
+        self._shown: Optional[ImageSource] = None
+        self._closed = False
+
+    @staticmethod
+    def _key(filename: str) -> CacheKey:
+        filename = os.path.abspath(filename)
+        return filename, os.stat(filename).st_mtime_ns
+
+    def load(self, filename: str):
+        """Request an image. Either imageLoaded or loadFailed will be emitted with the same file name."""
+        try:
+            key = self._key(filename)
+        except OSError as exc:
+            self.loadFailed.emit(filename, str(exc))
+            return
+        submitted = []
+        with self._lock:
+            self._requested = (key, filename)
+            source = self._cache.get(key)
+            if source is not None:
+                self._cache.move_to_end(key)
+                self._setShown(source)
+            else:
+                submitted.append(self._submit(key))
+        if source is not None:
+            self.imageLoaded.emit(filename, source)
+        for sibling in siblingImages(filename, self.prefetch):
+            try:
+                siblingkey = self._key(sibling)
+            except OSError:
+                continue
+            with self._lock:
+                if siblingkey not in self._cache:
+                    submitted.append(self._submit(siblingkey))
+        self._watch(submitted)
+
+    def prefetchFrames(self, source: ImageSource, frames: Iterable[int]):
+        """Read frames of an image stack (and prepare them for display) in the background"""
+        for frame in frames:
+            if 0 <= frame < source.nframes:
+                self._executor.submit(_prepareFrame, source, frame)
+
+    def _submit(self, key: CacheKey) -> Optional[Tuple[CacheKey, Future]]:
+        # must be called with the lock held. The new future is returned for _watch(), None if already pending.
+        if key in self._pending:
+            return None
+        future = self._executor.submit(_openImage, key[0])
+        self._pending[key] = future
+        return key, future
+
+    def _watch(self, submitted: List[Optional[Tuple[CacheKey, Future]]]):
+        # must be called without the lock held: a future already done runs the callback (which takes the lock) at
+        # once, in this thread
+        for item in submitted:
+            if item is not None:
+                key, future = item
+                future.add_done_callback(lambda f, key=key: self._finished(key, f))
+
+    def _finished(self, key: CacheKey, future: Future):
+        # runs in the worker thread (or in the calling thread of _watch(), if the image was loaded already): signals
+        # are delivered to the GUI thread through a queued connection.
+        if future.cancelled():
+            return
+        exc = future.exception()
+        with self._lock:
+            del self._pending[key]
+            requested = self._requested if (self._requested is not None and self._requested[0] == key) else None
+            if exc is None:
+                if self._closed:
+                    future.result().close()
+                    return
+                self._cache[key] = future.result()
+                if requested is not None:
+                    self._setShown(future.result())
+                self._evict()
+        if requested is None:
+            return
+        if exc is None:
+            self.imageLoaded.emit(requested[1], future.result())
+        else:
+            self.loadFailed.emit(requested[1], str(exc))
+
+    def _evict(self):
+        # must be called with the lock held. The image requested last is never evicted.
+        footprints = {key: _memoryFootprint(source) for key, source in self._cache.items()}
+        total = sum(footprints.values())
+        for key in list(self._cache):
+            if total <= self.memorybudget:
+                break
+            if self._requested is not None and key == self._requested[0]:
+                continue
+            self._close(self._cache.pop(key))
+            total -= footprints[key]
+
+    def _setShown(self, source: ImageSource):
+        # must be called with the lock held
+        previous, self._shown = self._shown, source
+        if previous is not None and previous is not source and previous not in self._cache.values():
+            previous.close()
+
+    def _close(self, source: ImageSource):
+        # must be called with the lock held. The image delivered last may still be on display.
+        if source is not self._shown:
+            source.close()
+
+    def clearCache(self):
+        """Forget all cached images. Loads already in progress are not affected."""
+        with self._lock:
+            for source in self._cache.values():
+                self._close(source)
+            self._cache.clear()
+
+    def shutdown(self):
+        """Stop loading and close all images, including the one delivered last"""
+        self._executor.shutdown(wait=False, cancel_futures=True)
+        with self._lock:
+            self._closed = True
+            for source in self._cache.values():
+                source.close()
+            if self._shown is not None and self._shown not in self._cache.values():
+                self._shown.close()
+            self._cache.clear()
+            self._shown = None
@@ -0,0 +1,306 @@
+"""Access to image data with minimal memory footprint
+
+Uncompressed TIFF files and NumPy .npy files are memory-mapped instead of being decoded into RAM. Downsampled
+versions of the image (a resolution pyramid) are computed lazily, on the first request, and kept for later use.
+
+Image stacks (multi-page TIFF files and three-dimensional .npy arrays) are read frame by frame, when a frame is first
+requested, and the pyramids of the most recently used frames are kept in a small cache.
+
+No Qt or matplotlib here: this module is used by the batch processing workers, too.
+"""
+
+import os
+import threading
+from collections import OrderedDict
+from typing import TYPE_CHECKING, List, Optional, Tuple
+
+import numpy as np
+
+from .profiling import timed
+
+if TYPE_CHECKING:
+    import PIL.Image
+
+IMAGE_EXTENSIONS = ('.tif', '.tiff', '.png', '.jpg', '.jpeg', '.bmp', '.gif', '.npy')
+
+# NumPy data types corresponding to the raw modes of uncompressed images in PIL
+_RAWMODE_DTYPES = {
+    'L': np.dtype('u1'),
+    'I;16': np.dtype('<u2'),
+    'I;16L': np.dtype('<u2'),
+    'I;16B': np.dtype('>u2'),
+    'I;16N': np.dtype('=u2'),
+    'I;16S': np.dtype('<i2'),
+    'I;16BS': np.dtype('>i2'),
+    'I;32': np.dtype('<u4'),
+    'I;32B': np.dtype('>u4'),
+    'I;32S': np.dtype('<i4'),
+    'I;32BS': np.dtype('>i4'),
+    'F;32F': np.dtype('<f4'),
+    'F;32BF': np.dtype('>f4'),
+    'F;64F': np.dtype('<f8'),
+    'F;64BF': np.dtype('>f8'),
+    'RGB': np.dtype('u1'),
+}
+
+
+def siblingImages(filename: str, count: int) -> List[str]:
+    """The images following `filename` in its directory (in alphabetical order, wrapping around), then the one
+    preceding it, at most `count` + 1 in total."""
+    dirname, basename = os.path.split(os.path.abspath(filename))
+    try:
+        images = sorted(fn for fn in os.listdir(dirname) if os.path.splitext(fn)[1].lower() in IMAGE_EXTENSIONS)
+    except OSError:
+        return []
+    if basename not in images or len(images) < 2:
+        return []
+    index = images.index(basename)
+    siblings = []
+    for offset in list(range(1, count + 1)) + [-1]:
+        sibling = images[(index + offset) % len(images)]
+        if sibling != basename and sibling not in siblings:
+            siblings.append(sibling)
+    return [os.path.join(dirname, fn) for fn in siblings]
+
+
+def _memmapPILImage(filename: str, img: 'PIL.Image.Image') -> Optional[np.ndarray]:
+    """Memory-map the pixel data of an image opened by PIL, if it is stored uncompressed and contiguously.
+
+    Returns None if this is not possible.
+    """
+    tiles = img.tile
+    if not tiles or any(tile[0] != 'raw' for tile in tiles):
+        return None
+    rawmode, stride, orientation = (tuple(tiles[0][3]) + (0, 1))[:3]
+    if rawmode not in _RAWMODE_DTYPES or orientation != 1:
+        return None
+    if any((tuple(tile[3]) + (0, 1))[:3] != (rawmode, stride, orientation) for tile in tiles):
+        return None
+    dtype = _RAWMODE_DTYPES[rawmode]
+    width, height = img.size
+    channels = 3 if rawmode == 'RGB' else 1
+    rowbytes = width * channels * dtype.itemsize
+    if stride not in (0, rowbytes):
+        return None
+    # strips must cover whole rows and follow each other without gaps
+    offset = tiles[0][2]
+    for tile in tiles:
+        x0, y0, x1, y1 = tile[1]
+        if x0 != 0 or x1 != width or tile[2] != offset + y0 * rowbytes:
+            return None
+    if sum(tile[1][3] - tile[1][1] for tile in tiles) != height:
+        return None
+    shape = (height, width, channels) if channels > 1 else (height, width)
+    return np.memmap(filename, dtype=dtype, mode='r', offset=offset, shape=shape)
+
+
+def _isStack(data: np.ndarray) -> bool:
+    """A three-dimensional array is a stack of frames (along the first axis) unless it is an RGB(A) image"""
+    return data.ndim == 3 and data.shape[2] not in (3, 4)
+
+
+def _grayscale(data: np.ndarray) -> np.ndarray:
+    if data.ndim == 3:
+        # RGB(A) image: work on the mean of the colour channels
+        data = data[:, :, :3].mean(axis=2, dtype=np.float32)
+    if data.ndim != 2:
+        raise ValueError('Unsupported image shape: {}'.format(data.shape))
+    return data
+
+
+def _readPILImage(filename: str, img: 'PIL.Image.Image') -> np.ndarray:
+    """Pixel data of the current frame of an image opened by PIL"""
+    data = _memmapPILImage(filename, img)
+    if data is None:
+        data = np.array(img)
+    return _grayscale(data)
+
+
+def _seekFrame(img: 'PIL.Image.Image', frame: int):
+    try:
+        img.seek(frame)
+    except EOFError:
+        raise IndexError('Frame {} out of range'.format(frame))
+
+
+@timed()
+def loadImageData(filename: str, frame: int = 0) -> np.ndarray:
+    """Load a two-dimensional image (a frame of a stack), memory-mapped whenever possible. Colour images are converted
+    to grayscale."""
+    if os.path.splitext(filename)[1].lower() == '.npy':
+        data = np.load(filename, mmap_mode='r')
+        if _isStack(data):
+            return data[frame]
+        if frame != 0:
+            raise IndexError('Frame {} out of range'.format(frame))
+        return _grayscale(data)
+    # imported here: PIL is not needed until the first image is loaded (in a loader thread)
+    import PIL.Image
+    with PIL.Image.open(filename) as img:
+        if frame:
+            _seekFrame(img, frame)
+        return _readPILImage(filename, img)
+
+
+def frameCount(filename: str) -> int:
+    """Number of frames in an image file (1 for single images)"""
+    if os.path.splitext(filename)[1].lower() == '.npy':
+        data = np.load(filename, mmap_mode='r')
+        return len(data) if _isStack(data) else 1
+    import PIL.Image
+    with PIL.Image.open(filename) as img:
+        return getattr(img, 'n_frames', 1)
+
+
+@timed()
+def _downsample(data: np.ndarray, chunkrows: int = 1024) -> np.ndarray:
+    """Halve the resolution by averaging 2x2 blocks. Odd last rows/columns are dropped.
+
+    The input is processed in chunks of rows: a memory-mapped image is never read into memory at once.
+    """
+    height, width = data.shape[0] // 2 * 2, data.shape[1] // 2 * 2
+    result = np.empty((height // 2, width // 2), dtype=np.float32)
+    for row in range(0, height, chunkrows):
+        block = np.asarray(data[row:min(row + chunkrows, height), :width], dtype=np.float32)
+        result[row // 2:(row + len(block)) // 2] = block.reshape(len(block) // 2, 2, width // 2, 2).mean(axis=(1, 3))
+    return result
+
+
+class ImagePyramid:
+    """Multi-resolution representation of a two-dimensional image
+
+    Level 0 is the image itself, level k is downsampled by 2**k in both directions. Levels are computed when first
+    needed. Coordinates are always given in level 0 pixels.
+    """
+
+    def __init__(self, data: np.ndarray, tilesize: int = 512, minsize: int = 256):
+        self._levels: List[Optional[np.ndarray]] = [data]
+        self.tilesize = tilesize
+        self.nlevels = 1
+        while max(data.shape[0], data.shape[1]) // 2 ** self.nlevels >= minsize:
+            self.nlevels += 1
+        self._levels.extend([None] * (self.nlevels - 1))
+        self._range = None
+
+    @property
+    def shape(self) -> Tuple[int, int]:
+        return self._levels[0].shape
+
+    def computedLevels(self) -> List[np.ndarray]:
+        return [level for level in self._levels if level is not None]
+
+    def level(self, level: int) -> np.ndarray:
+        if self._levels[level] is None:
+            self._levels[level] = _downsample(self.level(level - 1))
+        return self._levels[level]
+
+    def chooseLevel(self, datapixelsperscreenpixel: float) -> int:
+        """The coarsest level which still has at least one pixel for each screen pixel"""
+        if datapixelsperscreenpixel <= 1:
+            return 0
+        return int(min(np.floor(np.log2(datapixelsperscreenpixel)), self.nlevels - 1))
+
+    def dataRange(self) -> Tuple[float, float]:
+        """Minimum and maximum pixel value, estimated from the coarsest level for large images"""
+        if self._range is None:
+            data = self.level(self.nlevels - 1)
+            self._range = (float(np.nanmin(data)), float(np.nanmax(data)))
+        return self._range
+
+    def view(self, level: int, xmin: float, xmax: float, ymin: float, ymax: float) -> Tuple[
+        np.ndarray, Tuple[float, float, float, float], Tuple[int, int, int, int, int]]:
+        """Get the part of a pyramid level covering the given region (in level 0 pixel coordinates)
+
+        The region is extended to tile boundaries, thus small changes of the view give the same result.
+        Returns the image data, its extent (left, right, bottom, top, in level 0 pixel coordinates, as expected by
+        imshow()) and a key identifying the tiles returned.
+        """
+        data = self.level(level)
+        factor = 2 ** level
+        tile = self.tilesize
+
+        def tilerange(low: float, high: float, size: int) -> Tuple[int, int]:
+            low, high = sorted([low, high])
+            first = int(np.floor((low + 0.5) / factor / tile)) * tile
+            last = int(np.ceil((high + 0.5) / factor / tile)) * tile
+            return max(0, min(first, size)), max(0, min(last, size))
+
+        col0, col1 = tilerange(xmin, xmax, data.shape[1])
+        row0, row1 = tilerange(ymin, ymax, data.shape[0])
+        extent = (col0 * factor - 0.5, col1 * factor - 0.5, row1 * factor - 0.5, row0 * factor - 0.5)
+        return data[row0:row1, col0:col1], extent, (level, row0, row1, col0, col1)
+
+
+class ImageSource:
+    """An image file opened for display and analysis
+
+    `data` and `pyramid` belong to the first frame. The frames of a stack are read by frame(), which is safe to call
+    from several threads.
+    """
+
+    def __init__(self, filename: str, framecache: int = 8):
+        self.filename = filename
+        self.framecache = framecache
+        self._lock = threading.Lock()
+        self._frames: 'OrderedDict[int, ImagePyramid]' = OrderedDict()
+        # kept open for seeking between the frames of a multi-page file, None for .npy files
+        self._image: Optional['PIL.Image.Image'] = None
+        self.nframes = 1
+        if os.path.splitext(filename)[1].lower() == '.npy':
+            stack = np.load(filename, mmap_mode='r')
+            if _isStack(stack):
+                self.nframes = len(stack)
+        else:
+            import PIL.Image
+            self._image = PIL.Image.open(filename)
+            self.nframes = getattr(self._image, 'n_frames', 1)
+        with self._lock:
+            self.data = self._readFrame(0)
+            if self.nframes == 1 and self._image is not None:
+                self._image.close()
+                self._image = None
+        self.pyramid = ImagePyramid(self.data)
+
+    def _readFrame(self, index: int) -> np.ndarray:
+        # must be called with the lock held
+        if self._image is None:
+            return loadImageData(self.filename, index)
+        _seekFrame(self._image, index)
+        return _readPILImage(self.filename, self._image)
+
+    @timed()
+    def frame(self, index: int) -> ImagePyramid:
+        """The pyramid of a frame, read when first requested and kept among the `framecache` most recently used. The
+        first frame is always kept."""
+        if not 0 <= index < self.nframes:
+            raise IndexError('Frame {} out of range'.format(index))
+        if index == 0:
+            return self.pyramid
+        with self._lock:
+            pyramid = self._frames.get(index)
+            if pyramid is None:
+                pyramid = self._frames[index] = ImagePyramid(self._readFrame(index))
+            self._frames.move_to_end(index)
+            while len(self._frames) > self.framecache:
+                self._frames.popitem(last=False)
+        return pyramid
+
+    def cachedPyramids(self) -> List[ImagePyramid]:
+        """The pyramids of the first frame and of the frames in the cache"""
+        with self._lock:
+            return [self.pyramid] + list(self._frames.values())
+
+    def clearFrameCache(self):
+        with self._lock:
+            self._frames.clear()
+
+    def close(self):
+        """Release the file: close the handle kept open for a multi-page file and drop the (possibly memory-mapped)
+        pixel data. The source must not be used afterwards."""
+        with self._lock:
+            if self._image is not None:
+                self._image.close()
+                self._image = None
+            self._frames.clear()
+            self.data = None
+            self.pyramid = None
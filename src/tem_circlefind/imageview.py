@@ -0,0 +1,90 @@
+"""Display of an image pyramid in matplotlib axes
+
+Only the pyramid level matching the current zoom and the tiles covering the visible region are handed to imshow().
+The view is updated whenever the axis limits change (zooming and panning with the navigation toolbar) or the canvas
+is resized. The tiles are converted to 8-bit display data by a DisplayPipeline, which keeps them until the display
+settings change.
+"""
+
+from typing import Optional
+
+import numpy as np
+from matplotlib.axes import Axes
+
+from .display import DEFAULT_SETTINGS, DisplayPipeline
+from .imagesource import ImagePyramid
+
+
+class PyramidImageView:
+    def __init__(self, axes: Axes, **imshowkwargs):
+        self.axes = axes
+        self.pyramid: Optional[ImagePyramid] = None
+        self.display: Optional[DisplayPipeline] = None
+        self._displaysettings = dict(DEFAULT_SETTINGS)
+        self._image = None
+        self._key = None
+        self._imshowkwargs = dict(imshowkwargs, vmin=0, vmax=255)
+        self._updating = False
+        axes.callbacks.connect('xlim_changed', self._onLimitsChanged)
+        axes.callbacks.connect('ylim_changed', self._onLimitsChanged)
+        axes.figure.canvas.mpl_connect('resize_event', self._onLimitsChanged)
+
+    def setPyramid(self, pyramid: ImagePyramid, keepview: bool = False):
+        """Show a new image and reset the view to cover it entirely. If `keepview` is True and the new image has
+        the same size as the previous one (e.g. another frame of a stack), the view is left as it is."""
+        samesize = self.pyramid is not None and self.pyramid.shape == pyramid.shape
+        self.pyramid = pyramid
+        if self.display is None or self.display.pyramid is not pyramid:
+            self.display = DisplayPipeline(pyramid, **self._displaysettings)
+        self._key = None
+        if keepview and samesize:
+            self.update()
+            return
+        height, width = pyramid.shape
+        self._updating = True
+        try:
+            self.axes.set_xlim(-0.5, width - 0.5)
+            self.axes.set_ylim(height - 0.5, -0.5)
+        finally:
+            self._updating = False
+        self.update()
+
+    def setDisplaySettings(self, **settings):
+        """Change the display settings (see DisplayPipeline) of this and the subsequent images"""
+        changed = self.display is not None and self.display.setSettings(**settings)
+        self._displaysettings.update(settings)
+        if changed:
+            self._key = None
+            self.update()
+
+    def _onLimitsChanged(self, *args):
+        if not self._updating:
+            self.update()
+
+    def update(self):
+        if self.pyramid is None:
+            return
+        xmin, xmax = self.axes.get_xlim()
+        ymin, ymax = self.axes.get_ylim()
+        screenwidth = max(self.axes.bbox.width, 1)
+        screenheight = max(self.axes.bbox.height, 1)
+        level = self.pyramid.chooseLevel(min(abs(xmax - xmin) / screenwidth, abs(ymax - ymin) / screenheight))
+        data, extent, key = self.display.view(level, xmin, xmax, ymin, ymax)
+        if key == self._key:
+            return
+        self._key = key
+        # matplotlib resamples single-channel float32 data the fastest: uint8 would be converted at every redraw, RGBA
+        # has four channels to be resampled
+        data = data.astype(np.float32)
+        self._updating = True
+        try:
+            if self._image is None:
+                self._image = self.axes.imshow(data, extent=extent, **self._imshowkwargs)
+            else:
+                self._image.set_data(data)
+                self._image.set_extent(extent)
+            # the image extent must not change the view
+            self.axes.set_xlim(xmin, xmax)
+            self.axes.set_ylim(ymin, ymax)
+        finally:
+            self._updating = False
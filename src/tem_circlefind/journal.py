@@ -0,0 +1,252 @@
+"""Write-ahead journal of the measurement session
+
+Every change of the results and of the pending clicks is appended to a journal file as a small fixed-size record.
+Records are handed over to a background thread, which writes them and flushes the file to the disk whenever it has
+nothing else to do: the GUI thread only pays for putting a tuple into a queue. When the journal grows too long, the
+writer thread replaces it with a compact snapshot of the current state.
+
+After a crash, replay() reconstructs the last state from the journal.
+
+If the journal cannot be written (e.g. the disk is full), the writer thread stops, the error is kept in `error` and
+reported through the `onerror` callback, and further changes are no longer queued.
+
+File layout: magic, version, length of the JSON header (with the image file name), the JSON header, then the
+records.
+"""
+
+import json
+import os
+import queue
+import struct
+import threading
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from .resultsfile import withFrames
+
+_MAGIC = b'TEMCFJNL'
+_VERSION = 3
+_FILEHEADER = struct.Struct('<8sII')
+# operation code, two integer arguments, four floating point arguments
+_RECORD = struct.Struct('<B7xqq4d')
+_RECORD_DTYPE = np.dtype([('op', 'u1'), ('pad', 'V7'), ('i0', '<i8'), ('i1', '<i8'), ('v', '<f8', (4,))])
+assert _RECORD_DTYPE.itemsize == _RECORD.size
+
+# results are recorded in pixels from version 3, in physical units before
+RESULTS_APPEND = 1  # v: x, y, diameter, frame (0 in journals written before image stacks were supported)
+RESULTS_REMOVE = 2  # i0, i1: first and last row
+RESULTS_CLEAR = 3
+CLICKS_APPEND = 4  # v: x, y
+CLICKS_REMOVE = 5  # i0, i1: first and last row
+CLICKS_CLEAR = 6
+PIXELSIZE = 7  # v: pixel size
+# insertions before existing rows (undoing a removal), from version 2
+RESULTS_INSERT = 8  # i0: row, v: x, y, diameter, frame
+CLICKS_INSERT = 9  # i0: row, v: x, y
+
+
+class _State:
+    """The session state as reconstructed from the records"""
+
+    def __init__(self, image: Optional[str] = None):
+        self.image = image
+        self.pixelsize = None
+        self.results: List[Tuple[float, float, float, float]] = []
+        self.clicks: List[Tuple[float, float]] = []
+
+    def apply(self, op: int, i0: int, i1: int, v: Sequence[float]):
+        if op == RESULTS_APPEND:
+            self.results.append((v[0], v[1], v[2], v[3]))
+        elif op == RESULTS_REMOVE:
+            del self.results[i0:i1 + 1]
+        elif op == RESULTS_CLEAR:
+            self.results = []
+        elif op == CLICKS_APPEND:
+            self.clicks.append((v[0], v[1]))
+        elif op == CLICKS_REMOVE:
+            del self.clicks[i0:i1 + 1]
+        elif op == CLICKS_CLEAR:
+            self.clicks = []
+        elif op == PIXELSIZE:
+            self.pixelsize = v[0]
+        elif op == RESULTS_INSERT:
+            self.results.insert(i0, (v[0], v[1], v[2], v[3]))
+        elif op == CLICKS_INSERT:
+            self.clicks.insert(i0, (v[0], v[1]))
+        else:
+            raise ValueError('Unknown journal record: {}'.format(op))
+
+    def records(self) -> List[bytes]:
+        records = []
+        if self.pixelsize is not None:
+            records.append(_RECORD.pack(PIXELSIZE, 0, 0, self.pixelsize, 0, 0, 0))
+        records.extend(_RECORD.pack(RESULTS_APPEND, 0, 0, *row) for row in self.results)
+        records.extend(_RECORD.pack(CLICKS_APPEND, 0, 0, x, y, 0, 0) for x, y in self.clicks)
+        return records
+
+
+def _fileHeader(image: Optional[str]) -> bytes:
+    block = json.dumps({'image': image}).encode('utf-8')
+    return _FILEHEADER.pack(_MAGIC, _VERSION, len(block)) + block
+
+
+def replay(filename: str) -> Optional[Dict]:
+    """Reconstruct the session state from a journal file
+
+    Returns None if the file does not exist or is not a journal, otherwise a dict with the keys 'image',
+    'pixelsize' (None if not recorded), 'results' (array of shape (N, 4): x, y, diameter in pixels and frame) and
+    'clicks' (array of shape (M, 2)). A partially written last record is ignored.
+    """
+    try:
+        with open(filename, 'rb') as f:
+            header = f.read(_FILEHEADER.size)
+            if len(header) < _FILEHEADER.size:
+                return None
+            magic, version, jsonlength = _FILEHEADER.unpack(header)
+            if magic != _MAGIC or version > _VERSION:
+                return None
+            metadata = json.loads(f.read(jsonlength).decode('utf-8'))
+            body = f.read()
+    except (OSError, ValueError):
+        return None
+    records = np.frombuffer(body, dtype=_RECORD_DTYPE, count=len(body) // _RECORD.size)
+    state = _State(metadata.get('image'))
+    for op, i0, i1, v in zip(records['op'].tolist(), records['i0'].tolist(), records['i1'].tolist(),
+                             records['v'].tolist()):
+        state.apply(op, i0, i1, v)
+    results = np.array(state.results, dtype=np.float64).reshape(-1, 4)
+    if version < 3 and state.pixelsize is not None and state.pixelsize > 0:
+        # physical units, valid with the last pixel size
+        results[:, :3] /= state.pixelsize
+    return {'image': state.image, 'pixelsize': state.pixelsize, 'results': results,
+            'clicks': np.array(state.clicks, dtype=np.float64).reshape(-1, 2)}
+
+
+class Journal:
+    """Journal writer. All methods are cheap and can be called from the GUI thread."""
+
+    def __init__(self, filename: str, compactafter: int = 100000,
+                 onerror: Optional[Callable[[OSError], None]] = None):
+        """`onerror` is called from the writer thread if writing the journal fails"""
+        self.filename = filename
+        self.compactafter = compactafter
+        self.onerror = onerror
+        self.error: Optional[OSError] = None
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._worker, name='journal', daemon=True)
+        self._thread.start()
+
+    def start(self, image: Optional[str], pixelsize: float, results: np.ndarray, clicks: np.ndarray):
+        """Begin a new journal with the given state (discarding the previous journal). The results are given in pixels.
+        """
+        state = _State(image)
+        state.pixelsize = float(pixelsize)
+        state.results = [tuple(row) for row in withFrames(results).tolist()]
+        state.clicks = [tuple(row) for row in np.asarray(clicks, dtype=np.float64).reshape(-1, 2).tolist()]
+        self._put('start', state)
+
+    @property
+    def failed(self) -> bool:
+        return self.error is not None
+
+    def _put(self, command: str, argument):
+        # the writer thread has stopped after a failure: nothing would be written
+        if self.error is None:
+            self._queue.put((command, argument))
+
+    def _record(self, op: int, i0: int = 0, i1: int = 0, v: Sequence[float] = ()):
+        v = list(v) + [0.0] * (4 - len(v))
+        self._put('records', [(op, i0, i1, v)])
+
+    def resultsAppended(self, rows: np.ndarray):
+        # bulk insertions are queued as a single item
+        self._put('records', [(RESULTS_APPEND, 0, 0, row) for row in withFrames(rows).tolist()])
+
+    def resultsInserted(self, first: int, rows: np.ndarray):
+        """Rows inserted before the row `first`"""
+        self._put('records', [(RESULTS_INSERT, first + i, 0, row) for i, row in enumerate(withFrames(rows).tolist())])
+
+    def resultsRemoved(self, first: int, last: int):
+        self._record(RESULTS_REMOVE, first, last)
+
+    def resultsCleared(self):
+        self._record(RESULTS_CLEAR)
+
+    def clicksAppended(self, points: np.ndarray):
+        self._put('records', [(CLICKS_APPEND, 0, 0, point + [0.0, 0.0])
+                              for point in np.asarray(points, dtype=np.float64).reshape(-1, 2).tolist()])
+
+    def clicksInserted(self, first: int, points: np.ndarray):
+        """Points inserted before the row `first`"""
+        points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+        self._put('records', [(CLICKS_INSERT, first + i, 0, point + [0.0, 0.0])
+                              for i, point in enumerate(points.tolist())])
+
+    def clicksRemoved(self, first: int, last: int):
+        self._record(CLICKS_REMOVE, first, last)
+
+    def clicksCleared(self):
+        self._record(CLICKS_CLEAR)
+
+    def pixelSizeChanged(self, pixelsize: float):
+        self._record(PIXELSIZE, v=(float(pixelsize),))
+
+    def close(self):
+        """Write out everything pending and stop the writer thread"""
+        self._queue.put(('stop', None))
+        self._thread.join()
+
+    # the rest runs in the writer thread
+
+    def _writeSnapshot(self, state: _State):
+        # write to a temporary file and rename it: the journal is never left in an incomplete state
+        tmpname = self.filename + '.tmp'
+        with open(tmpname, 'wb') as f:
+            f.write(_fileHeader(state.image))
+            f.write(b''.join(state.records()))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmpname, self.filename)
+
+    def _worker(self):
+        state = None
+        f = None
+        records = 0
+        try:
+            while True:
+                command, argument = self._queue.get()
+                if command == 'stop':
+                    break
+                elif command == 'start':
+                    if f is not None:
+                        f.close()
+                    state = argument
+                    self._writeSnapshot(state)
+                    f = open(self.filename, 'ab')
+                    records = 0
+                elif command == 'records' and f is not None:
+                    for op, i0, i1, v in argument:
+                        state.apply(op, i0, i1, v)
+                    f.write(b''.join([_RECORD.pack(op, i0, i1, *v) for op, i0, i1, v in argument]))
+                    records += len(argument)
+                if f is not None and self._queue.empty():
+                    # nothing more to do for now: make sure that everything reaches the disk
+                    f.flush()
+                    os.fsync(f.fileno())
+                    if records > self.compactafter and records > 2 * (len(state.results) + len(state.clicks)):
+                        f.close()
+                        self._writeSnapshot(state)
+                        f = open(self.filename, 'ab')
+                        records = 0
+        except OSError as exc:
+            # checked by _put() before queueing
+            self.error = exc
+            if self.onerror is not None:
+                self.onerror(exc)
+        finally:
+            if f is not None:
+                try:
+                    f.close()
+                except OSError:
+                    pass
@@ -0,0 +1,123 @@
+"""Incrementally rendered overlay of circles, click markers and crosshair on the image axes
+
+The image and the circles already present are rendered into the figure once per full redraw (zooming, panning,
+replotting). The resulting bitmap is cached, and adding circles, clicks or moving the crosshair is done by blitting:
+restoring the cached background and drawing only the changed artists on it. Thus the cost of a click does not
+depend on the number of circles shown.
+"""
+
+from typing import Sequence
+
+import numpy as np
+from matplotlib.axes import Axes
+from matplotlib.collections import EllipseCollection
+from matplotlib.lines import Line2D
+
+
+class CircleOverlay:
+    def __init__(self, axes: Axes, circlecolor: str = 'm', markercolor: str = 'r'):
+        self.axes = axes
+        self.canvas = axes.figure.canvas
+        self._background = None
+        self._crosshairenabled = False
+        # all circles, drawn only in full redraws, therefore part of the cached background
+        self._circles = self._createCollection(circlecolor, animated=False)
+        # circles added since the last background capture
+        self._fresh = self._createCollection(circlecolor, animated=True)
+        self._markers = Line2D([], [], color=markercolor, marker='o', linestyle='none', animated=True)
+        self._hline = Line2D([0, 1], [0, 0], color=markercolor, lw=1, transform=axes.get_yaxis_transform(),
+                             animated=True, visible=False)
+        self._vline = Line2D([0, 0], [0, 1], color=markercolor, lw=1, transform=axes.get_xaxis_transform(),
+                             animated=True, visible=False)
+        for artist in [self._markers, self._hline, self._vline]:
+            # add_artist() does not touch the data limits, unlike plot() or axhline()
+            axes.add_artist(artist)
+        self._cids = [self.canvas.mpl_connect('draw_event', self._onDraw),
+                      self.canvas.mpl_connect('motion_notify_event', self._onMotion),
+                      self.canvas.mpl_connect('axes_leave_event', self._onLeave)]
+
+    def _createCollection(self, color: str, animated: bool) -> EllipseCollection:
+        collection = EllipseCollection([], [], [], units='xy', offsets=np.empty((0, 2)),
+                                       offset_transform=self.axes.transData, facecolors='none', edgecolors=color,
+                                       animated=animated)
+        self.axes.add_collection(collection, autolim=False)
+        return collection
+
+    @staticmethod
+    def _setCollection(collection: EllipseCollection, x: np.ndarray, y: np.ndarray, diameter: np.ndarray):
+        collection.set_offsets(np.column_stack([x, y]))
+        collection.set_widths(diameter)
+        collection.set_heights(diameter)
+        collection.set_angles(np.zeros_like(diameter))
+
+    def _onDraw(self, event):
+        self._background = self.canvas.copy_from_bbox(self.axes.bbox)
+        self._drawAnimated()
+
+    def _drawAnimated(self):
+        for artist in [self._markers, self._hline, self._vline]:
+            if artist.get_visible():
+                self.axes.draw_artist(artist)
+
+    def _blit(self):
+        if self._background is None:
+            # not drawn yet: the next full redraw will take care of everything
+            self.canvas.draw_idle()
+            return
+        self.canvas.restore_region(self._background)
+        if len(self._fresh.get_offsets()):
+            # burn the new circles into the background, then forget them: from the next full redraw on they are
+            # rendered from the main collection.
+            self.axes.draw_artist(self._fresh)
+            self._background = self.canvas.copy_from_bbox(self.axes.bbox)
+            self._setCollection(self._fresh, np.empty(0), np.empty(0), np.empty(0))
+        self._drawAnimated()
+        self.canvas.blit(self.axes.bbox)
+
+    def setCircles(self, x: Sequence[float], y: Sequence[float], diameter: Sequence[float]):
+        """Replace all circles (pixel units). The change shows up at the next full redraw."""
+        self._setCollection(self._circles, np.asarray(x, dtype=np.float64), np.asarray(y, dtype=np.float64),
+                            np.asarray(diameter, dtype=np.float64))
+        self._setCollection(self._fresh, np.empty(0), np.empty(0), np.empty(0))
+
+    def addCircles(self, x: Sequence[float], y: Sequence[float], diameter: Sequence[float], blit: bool = True):
+        """Add new circles (pixel units) and show them without a full redraw"""
+        x = np.asarray(x, dtype=np.float64)
+        y = np.asarray(y, dtype=np.float64)
+        diameter = np.asarray(diameter, dtype=np.float64)
+        offsets = self._circles.get_offsets()
+        self._setCollection(self._circles, np.concatenate([offsets[:, 0], x]), np.concatenate([offsets[:, 1], y]),
+                            np.concatenate([self._circles.get_widths(), diameter]))
+        freshoffsets = self._fresh.get_offsets()
+        self._setCollection(self._fresh, np.concatenate([freshoffsets[:, 0], x]),
+                            np.concatenate([freshoffsets[:, 1], y]),
+                            np.concatenate([self._fresh.get_widths(), diameter]))
+        if blit:
+            self._blit()
+
+    def setMarkers(self, x: Sequence[float], y: Sequence[float]):
+        """Show markers at the given positions (pending clicks)"""
+        self._markers.set_data(np.asarray(x, dtype=np.float64), np.asarray(y, dtype=np.float64))
+        self._blit()
+
+    def setCrosshairEnabled(self, enabled: bool):
+        self._crosshairenabled = enabled
+        if not enabled and (self._hline.get_visible() or self._vline.get_visible()):
+            self._hline.set_visible(False)
+            self._vline.set_visible(False)
+            self._blit()
+
+    def _onMotion(self, event):
+        if (not self._crosshairenabled) or (event.inaxes is not self.axes):
+            return
+        self._hline.set_ydata([event.ydata, event.ydata])
+        self._vline.set_xdata([event.xdata, event.xdata])
+        self._hline.set_visible(True)
+        self._vline.set_visible(True)
+        self._blit()
+
+    def _onLeave(self, event):
+        if self._hline.get_visible() or self._vline.get_visible():
+            self._hline.set_visible(False)
+            self._vline.set_visible(False)
+            self._blit()
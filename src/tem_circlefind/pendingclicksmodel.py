@@ -1,9 +1,13 @@
 from PyQt5 import QtCore
 
+from .profiling import timed
+
 class PendingClicksModel(QtCore.QAbstractItemModel):
     def __init__(self, parent=None):
         super().__init__(parent)
         self._data=[]
+        # the frame of the image stack the clicks belong to
+        self.frame = 0
 
 
     def rowCount(self, parent: QtCore.QModelIndex = ...):
@@ -33,24 +37,41 @@ class PendingClicksModel(QtCore.QAbstractItemModel):
     def index(self, row: int, column: int, parent: QtCore.QModelIndex = ...):
         return self.createIndex(row, column, None)
 
+    @timed()
     def append(self, x:float, y:float):
         self.beginInsertRows(QtCore.QModelIndex(), len(self._data), len(self._data))
         self._data.append((x,y))
         self.endInsertRows()
 
+    def insertPoints(self, row: int, points):
+        """Insert points (x, y pairs) before `row`"""
+        points = [(x, y) for x, y in points]
+        if not points:
+            return
+        self.beginInsertRows(QtCore.QModelIndex(), row, row + len(points) - 1)
+        self._data[row:row] = points
+        self.endInsertRows()
+
     def removeRow(self, row: int, parent: QtCore.QModelIndex = ...):
         self.beginRemoveRows(QtCore.QModelIndex(), row, row)
         del self._data[row]
         self.endRemoveRows()
 
+    @timed()
     def clear(self):
         self.beginResetModel()
         self._data=[]
         self.endResetModel()
 
+    def setFrame(self, frame: int):
+        """Drop the clicks, which belong to another frame"""
+        self.clear()
+        self.frame = frame
+
     def getData(self):
         return self._data[:]
 
+    @timed()
     def pop(self, number=1):
         if len(self._data) <number:
             raise ValueError('Not enough clicks waiting')
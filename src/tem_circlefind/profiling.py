@@ -0,0 +1,146 @@
+"""Lightweight timing of the hot paths
+
+Functions decorated with @timed() and blocks in `with timing(name):` record their run time into a fixed-size ring
+buffer per name, from which percentiles can be calculated. Timing is off by default: then the cost of a decorated call
+is a single check of a global flag.
+
+Optionally, the GUI thread can be profiled with cProfile.
+
+No Qt here: timings can be recorded from any thread (e.g. image decoding in the loader threads).
+"""
+
+import cProfile
+import functools
+import pstats
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+_enabled = False
+_lock = threading.Lock()
+_recorders: Dict[str, 'LatencyRecorder'] = {}
+_profile: Optional[cProfile.Profile] = None
+
+PERCENTILES = (50, 90, 99)
+
+
+class LatencyRecorder:
+    """The last `capacity` durations (in seconds) of an operation, and the total number of calls"""
+
+    def __init__(self, capacity: int = 1000):
+        self._durations = np.zeros(capacity, dtype=np.float64)
+        self.calls = 0
+
+    def record(self, duration: float):
+        self._durations[self.calls % len(self._durations)] = duration
+        self.calls += 1
+
+    def durations(self) -> np.ndarray:
+        return self._durations[:min(self.calls, len(self._durations))]
+
+    def summary(self, percentiles: Sequence[float] = PERCENTILES) -> Dict[str, float]:
+        """Number of calls, mean, maximum and percentiles (keys 'p50' etc.) of the recorded durations"""
+        durations = self.durations()
+        if not len(durations):
+            return {'calls': self.calls, 'mean': np.nan, 'max': np.nan, **{f'p{p:g}': np.nan for p in percentiles}}
+        return {'calls': self.calls, 'mean': float(durations.mean()), 'max': float(durations.max()),
+                **{f'p{p:g}': float(v) for p, v in zip(percentiles, np.percentile(durations, percentiles))}}
+
+
+def isEnabled() -> bool:
+    return _enabled
+
+
+def setEnabled(enabled: bool):
+    global _enabled
+    _enabled = enabled
+
+
+def record(name: str, duration: float):
+    with _lock:
+        try:
+            recorder = _recorders[name]
+        except KeyError:
+            recorder = _recorders[name] = LatencyRecorder()
+        recorder.record(duration)
+
+
+def reset():
+    with _lock:
+        _recorders.clear()
+
+
+def summary() -> List[Tuple[str, Dict[str, float]]]:
+    """Summary of all recorded operations, sorted by name"""
+    with _lock:
+        return [(name, _recorders[name].summary()) for name in sorted(_recorders)]
+
+
+def formatSummary() -> str:
+    lines = ['{:<40s} {:>8s} {:>10s} {:>10s} {:>10s} {:>10s} {:>10s}'.format(
+        'Operation', 'Calls', 'Mean (ms)', *[f'p{p} (ms)' for p in PERCENTILES], 'Max (ms)')]
+    for name, stats in summary():
+        lines.append('{:<40s} {:>8d} {:>10.3f} {:>10.3f} {:>10.3f} {:>10.3f} {:>10.3f}'.format(
+            name, stats['calls'], stats['mean'] * 1000, *[stats[f'p{p}'] * 1000 for p in PERCENTILES],
+            stats['max'] * 1000))
+    return '\n'.join(lines)
+
+
+def timed(name: Optional[str] = None) -> Callable:
+    """Decorator recording the run time of each call (if timing is enabled) under `name` (default: the qualified
+    name of the function)"""
+
+    def decorator(func: Callable) -> Callable:
+        label = name if name is not None else func.__qualname__
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return func(*args, **kwargs)
+            t0 = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                record(label, time.perf_counter() - t0)
+
+        return wrapper
+
+    return decorator
+
+
+@contextmanager
+def timing(name: str):
+    """Record the run time of a block (if timing is enabled)"""
+    if not _enabled:
+        yield
+        return
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(name, time.perf_counter() - t0)
+
+
+def isProfiling() -> bool:
+    return _profile is not None
+
+
+def startProfiling():
+    """Start profiling the calling thread with cProfile"""
+    global _profile
+    if _profile is None:
+        _profile = cProfile.Profile()
+        _profile.enable()
+
+
+def stopProfiling() -> Optional[pstats.Stats]:
+    global _profile
+    if _profile is None:
+        return None
+    _profile.disable()
+    stats = pstats.Stats(_profile)
+    _profile = None
+    return stats
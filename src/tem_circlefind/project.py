@@ -0,0 +1,129 @@
+"""Projects: several images measured together
+
+A project holds the file name, the pixel size and the results (x, y, diameter in nm, frame) of each image, but no pixel
+data: images are opened only when they become active. Statistics of the whole project are calculated from the
+concatenated results.
+
+Projects are saved as a single NumPy .npz archive (with the extension PROJECT_EXTENSION), containing the results
+of all images as concatenated columns.
+"""
+
+import os
+from typing import Dict, List, Optional
+
+import numpy as np
+
+from .resultsfile import COLUMNS, diameterStatistics, withFrames
+
+PROJECT_EXTENSION = '.tcproj'
+_VERSION = 1
+
+
+class Project:
+    def __init__(self):
+        self.filenames: List[str] = []
+        self.pixelsizes: List[float] = []
+        self.results: List[np.ndarray] = []
+        self.active: Optional[int] = None
+        # concatenated diameters of the inactive images
+        self._inactivediameters = None
+
+    def __len__(self) -> int:
+        return len(self.filenames)
+
+    def index(self, filename: str) -> Optional[int]:
+        filename = os.path.abspath(filename)
+        try:
+            return self.filenames.index(filename)
+        except ValueError:
+            return None
+
+    def addImage(self, filename: str, pixelsize: float, results: Optional[np.ndarray] = None) -> int:
+        """Add an image (if not yet in the project) and return its index"""
+        index = self.index(filename)
+        if index is None:
+            self.filenames.append(os.path.abspath(filename))
+            self.pixelsizes.append(float(pixelsize))
+            self.results.append(np.empty((0, len(COLUMNS)), dtype=np.float64))
+            index = len(self.filenames) - 1
+        if results is not None:
+            self.storeResults(index, results, pixelsize)
+        self._inactivediameters = None
+        return index
+
+    def removeImage(self, index: int):
+        del self.filenames[index]
+        del self.pixelsizes[index]
+        del self.results[index]
+        if self.active is not None:
+            if self.active == index:
+                self.active = None
+            elif self.active > index:
+                self.active -= 1
+        self._inactivediameters = None
+
+    def storeResults(self, index: int, results: np.ndarray, pixelsize: float):
+        self.results[index] = np.array(withFrames(results))
+        self.pixelsizes[index] = float(pixelsize)
+        if index != self.active:
+            self._inactivediameters = None
+
+    def setActive(self, index: Optional[int]):
+        if index != self.active:
+            self.active = index
+            self._inactivediameters = None
+
+    def diameters(self, activeresults: Optional[np.ndarray] = None) -> np.ndarray:
+        """Diameters of all circles in the project
+
+        If `activeresults` is given, it replaces the stored results of the active image (e.g. when these are being
+        edited).
+        """
+        if activeresults is None or self.active is None:
+            return np.concatenate([r[:, 2] for r in self.results] + [np.empty(0)])
+        if self._inactivediameters is None:
+            self._inactivediameters = np.concatenate(
+                [r[:, 2] for i, r in enumerate(self.results) if i != self.active] + [np.empty(0)])
+        return np.concatenate([self._inactivediameters, np.asarray(activeresults)[:, 2]])
+
+    def statistics(self, activeresults: Optional[np.ndarray] = None) -> Dict[str, float]:
+        return diameterStatistics(self.diameters(activeresults))
+
+    def save(self, filename: str):
+        # file names are stored relative to the project file, if possible: projects can be moved with the images
+        dirname = os.path.dirname(os.path.abspath(filename))
+        filenames = []
+        for fn in self.filenames:
+            try:
+                filenames.append(os.path.relpath(fn, dirname))
+            except ValueError:
+                # on a different drive
+                filenames.append(fn)
+        columns = np.concatenate(self.results + [np.empty((0, len(COLUMNS)))])
+        with open(filename, 'wb') as f:
+            # a file object is given: np.savez() would append '.npz' to a file name
+            np.savez(f, version=_VERSION, filenames=np.array(filenames, dtype=str),
+                     pixelsizes=np.array(self.pixelsizes, dtype=np.float64),
+                     counts=np.array([len(r) for r in self.results], dtype=np.int64),
+                     x=columns[:, 0], y=columns[:, 1], diameter=columns[:, 2], frame=columns[:, 3],
+                     active=-1 if self.active is None else self.active)
+
+    @classmethod
+    def load(cls, filename: str) -> 'Project':
+        dirname = os.path.dirname(os.path.abspath(filename))
+        with np.load(filename, allow_pickle=False) as data:
+            if int(data['version']) > _VERSION:
+                raise ValueError('Unsupported project file version: {}'.format(int(data['version'])))
+            # projects saved before image stacks were supported have no frame column
+            frames = data['frame'] if 'frame' in data.files else np.zeros(len(data['x']))
+            columns = np.stack([data['x'], data['y'], data['diameter'], frames], axis=1)
+            counts = data['counts']
+            if counts.sum() != len(columns) or len(counts) != len(data['filenames']):
+                raise ValueError('Inconsistent project file')
+            project = cls()
+            project.filenames = [os.path.normpath(os.path.join(dirname, fn)) for fn in data['filenames'].tolist()]
+            project.pixelsizes = data['pixelsizes'].tolist()
+            project.results = np.split(columns, np.cumsum(counts)[:-1]) if len(counts) else []
+            active = int(data['active'])
+            project.active = active if 0 <= active < len(project.filenames) else None
+        return project
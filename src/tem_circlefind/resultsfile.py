@@ -0,0 +1,298 @@
+"""Reading and writing circle measurement results
+
+Two formats are supported:
+
+- text: a commented header with the statistics and the pixel size, followed by x, y, diameter (nm), frame and x, y,
+  diameter (pixels) columns. Meant for exporting the results.
+- binary: a fixed-size header (row count, pixel size, statistics), a JSON block with the static metadata (source
+  image, column names) and the rows as little-endian float64 numbers, in the same columns as the text format. New
+  rows can be appended without rewriting what is already in the file, and the data can be memory-mapped when reading.
+
+The frame column is the index of the frame of an image stack the circle was found on (0 for single images). Files
+written before stacks were supported have no frame column: their circles are assigned to frame 0 on reading.
+
+Both units are saved, thus the results can be recalibrated (the physical units recalculated from the pixels with a new
+pixel size, see recalibrate()) without the GUI. Older files have physical units only: their pixel values are
+calculated from the pixel size in the header.
+
+This module must not depend on Qt or matplotlib: it is also used by the headless batch processing workers.
+"""
+
+import json
+import os
+import struct
+from typing import BinaryIO, Dict, Optional, Tuple
+
+import numpy as np
+
+BINARY_EXTENSION = '.tcr'
+COLUMNS = ('x', 'y', 'diameter', 'frame')
+# columns of the files: the physical units followed by the pixels
+PIXEL_COLUMNS = ('xpixel', 'ypixel', 'diameterpixel')
+FILE_COLUMNS = COLUMNS + PIXEL_COLUMNS
+
+_MAGIC = b'TEMCFRES'
+_VERSION = 3
+# magic, version, number of columns, number of rows, pixel size, mean, std, min, max and ptp of the diameters,
+# length of the JSON block, offset of the data
+_HEADER = struct.Struct('<8sIIQd5dII')
+_STATISTICS = ('mean', 'std', 'min', 'max', 'ptp')
+
+
+def diameterStatistics(diameters: np.ndarray) -> Dict[str, float]:
+    diameters = np.asarray(diameters, dtype=np.float64)
+    if not len(diameters):
+        return {'mean': np.nan, 'std': np.nan, 'min': np.nan, 'max': np.nan, 'ptp': np.nan}
+    return {'mean': float(np.mean(diameters)),
+            'std': float(np.std(diameters)),
+            'min': float(np.min(diameters)),
+            'max': float(np.max(diameters)),
+            'ptp': float(np.ptp(diameters))}
+
+
+def withFrames(data: np.ndarray, frame: int = 0) -> np.ndarray:
+    """Rows of x, y, diameter and frame. Rows of only x, y and diameter are assigned to `frame`."""
+    data = np.asarray(data, dtype=np.float64)
+    data = data.reshape(-1, data.shape[-1] if data.size else len(COLUMNS))
+    if data.shape[1] == len(COLUMNS) - 1:
+        data = np.column_stack([data, np.full(len(data), frame, dtype=np.float64)])
+    elif data.shape[1] != len(COLUMNS):
+        raise ValueError('Results must have 3 or 4 columns, not {}'.format(data.shape[1]))
+    return data
+
+
+def toPixels(data: np.ndarray, pixelsize: float) -> np.ndarray:
+    """Rows of x, y, diameter (and frame) in physical units converted to pixels"""
+    data = np.array(withFrames(data))
+    data[:, :3] /= pixelsize
+    return data
+
+
+def toPhysical(pixels: np.ndarray, pixelsize: float) -> np.ndarray:
+    """Rows of x, y, diameter (and frame) in pixels converted to physical units"""
+    pixels = np.array(withFrames(pixels))
+    pixels[:, :3] *= pixelsize
+    return pixels
+
+
+def _fileRows(pixels: np.ndarray, pixelsize: float) -> np.ndarray:
+    """Rows of the files (see FILE_COLUMNS) from rows in pixels"""
+    pixels = withFrames(pixels)
+    return np.column_stack([toPhysical(pixels, pixelsize), pixels[:, :3]])
+
+
+def _splitUnits(rows: np.ndarray, pixelsize: Optional[float]) -> Tuple[np.ndarray, Optional[np.ndarray]]:
+    """Rows of the physical units and of the pixels (None if unknown) from the rows read from a file"""
+    if rows.shape[1] == len(FILE_COLUMNS):
+        return np.asarray(rows[:, :len(COLUMNS)]), np.asarray(rows[:, [4, 5, 6, 3]])
+    data = withFrames(rows)
+    if pixelsize is None or not pixelsize > 0:
+        return data, None
+    return data, toPixels(data, pixelsize)
+
+
+def saveText(filename: str, pixels: np.ndarray, pixelsize: float):
+    """Save results (rows in pixels) in the text format: a commented header with statistics followed by x, y,
+    diameter, frame and x, y, diameter in pixels columns"""
+    rows = _fileRows(pixels, pixelsize)
+    stats = diameterStatistics(rows[:, 2])
+    with open(filename, 'wt', encoding='utf-8') as f:
+        f.write(
+            '# Mean diameter: {:.3f}\n# STD diameter: {:.3f}\n# Min diameter: {:.3f}\n# Max diameter: {:.3f}\n'
+            '# P-P diameter: {:.3f}\n'.format(stats['mean'], stats['std'], stats['min'], stats['max'], stats['ptp']))
+        # not rounded: the pixel size of a calibration is needed exactly when the results are loaded again
+        f.write('# Pixel size: {!r}\n'.format(float(pixelsize)))
+        f.write('# Columns: x, y, diameter (nm), frame, x, y, diameter (pixels)\n')
+        np.savetxt(f, rows, fmt=['%12.6f'] * 3 + ['%6d'] + ['%12.6f'] * 3, delimiter='\t')
+
+
+def _loadTextRows(filename: str) -> np.ndarray:
+    try:
+        data = np.loadtxt(filename, ndmin=2)
+    except ValueError:
+        raise ValueError('Malformed file: {}'.format(filename))
+    if data.size == 0:
+        return np.empty((0, len(COLUMNS)))
+    if data.shape[1] not in (3, 4, len(FILE_COLUMNS)):
+        raise ValueError('File {} does not have three, four or seven columns.'.format(filename))
+    return data
+
+
+def readTextPixelSize(filename: str) -> Optional[float]:
+    """The pixel size from the header of a text results file, None if not found"""
+    with open(filename, 'rt', encoding='utf-8', errors='replace') as f:
+        for line in f:
+            if not line.startswith('#'):
+                break
+            if line.startswith('# Pixel size:'):
+                try:
+                    return float(line.split(':', 1)[1])
+                except ValueError:
+                    return None
+    return None
+
+
+def loadText(filename: str) -> np.ndarray:
+    """Load a text results file. Returns rows of x, y, diameter (in physical units) and frame."""
+    return withFrames(_loadTextRows(filename)[:, :len(COLUMNS)])
+
+
+def isBinaryResultsFile(filename: str) -> bool:
+    try:
+        with open(filename, 'rb') as f:
+            return f.read(len(_MAGIC)) == _MAGIC
+    except OSError:
+        return False
+
+
+def _packHeader(ncolumns: int, nrows: int, pixelsize: float, statistics: Dict[str, float], jsonlength: int,
+                dataoffset: int) -> bytes:
+    return _HEADER.pack(_MAGIC, _VERSION, ncolumns, nrows, pixelsize, *[statistics[s] for s in _STATISTICS],
+                        jsonlength, dataoffset)
+
+
+def _metadataBlock(image: Optional[str]) -> Tuple[bytes, int]:
+    block = json.dumps({'image': image, 'columns': list(FILE_COLUMNS)}).encode('utf-8')
+    # the data starts at an offset aligned to 8 bytes
+    dataoffset = (_HEADER.size + len(block) + 7) // 8 * 8
+    return block, dataoffset
+
+
+def writeBinary(f: BinaryIO, pixels: np.ndarray, pixelsize: float, image: Optional[str] = None):
+    """Write results (rows in pixels) in the binary format into an open file object"""
+    data = np.ascontiguousarray(_fileRows(pixels, pixelsize), dtype='<f8')
+    block, dataoffset = _metadataBlock(image)
+    f.write(_packHeader(len(FILE_COLUMNS), len(data), pixelsize, diameterStatistics(data[:, 2]), len(block),
+                        dataoffset))
+    f.write(block)
+    f.write(b'\0' * (dataoffset - _HEADER.size - len(block)))
+    f.write(data.tobytes())
+
+
+def saveBinary(filename: str, pixels: np.ndarray, pixelsize: float, image: Optional[str] = None):
+    with open(filename, 'wb') as f:
+        writeBinary(f, pixels, pixelsize, image)
+
+
+def readBinaryHeader(f: BinaryIO) -> Dict:
+    header = f.read(_HEADER.size)
+    if len(header) < _HEADER.size:
+        raise ValueError('Truncated results file')
+    magic, version, ncolumns, nrows, pixelsize, *statistics, jsonlength, dataoffset = _HEADER.unpack(header)
+    if magic != _MAGIC:
+        raise ValueError('Not a binary results file')
+    if version > _VERSION:
+        raise ValueError('Unsupported results file version: {}'.format(version))
+    metadata = json.loads(f.read(jsonlength).decode('utf-8'))
+    metadata.update({'rows': nrows, 'ncolumns': ncolumns, 'pixelsize': pixelsize, 'dataoffset': dataoffset,
+                     'statistics': dict(zip(_STATISTICS, statistics))})
+    return metadata
+
+
+def loadBinary(filename: str, mmap: bool = True) -> Tuple[np.ndarray, Dict]:
+    """Load a binary results file. The rows are memory-mapped (read-only) unless `mmap` is False.
+
+    The rows are as in FILE_COLUMNS. Files of version 1 have x, y, diameter columns only, files of version 2 x, y,
+    diameter and frame (see withFrames() and readResults()).
+    """
+    with open(filename, 'rb') as f:
+        metadata = readBinaryHeader(f)
+    rowbytes = 8 * metadata['ncolumns']
+    # rows not yet covered by the header (interrupted append) are ignored, as are partial rows
+    nrows = min(metadata['rows'], (os.path.getsize(filename) - metadata['dataoffset']) // rowbytes)
+    if nrows <= 0:
+        return np.empty((0, metadata['ncolumns'])), metadata
+    if mmap:
+        data = np.memmap(filename, dtype='<f8', mode='r', offset=metadata['dataoffset'],
+                         shape=(nrows, metadata['ncolumns']))
+    else:
+        with open(filename, 'rb') as f:
+            f.seek(metadata['dataoffset'])
+            data = np.fromfile(f, dtype='<f8', count=nrows * metadata['ncolumns']).reshape(nrows, -1)
+    return data, metadata
+
+
+def readResults(filename: str) -> Dict:
+    """Read a text or binary results file
+
+    Returns a dict with the keys 'data' (rows of x, y, diameter in physical units and frame), 'pixels' (the same rows
+    in pixels, None if the file records neither these nor the pixel size), 'pixelsize' (None if not recorded) and
+    'image' (the source image, None if not recorded).
+    """
+    if isBinaryResultsFile(filename):
+        rows, metadata = loadBinary(filename)
+        pixelsize, image = metadata['pixelsize'], metadata.get('image')
+    else:
+        rows = _loadTextRows(filename)
+        pixelsize, image = readTextPixelSize(filename), None
+    data, pixels = _splitUnits(rows, pixelsize)
+    return {'data': data, 'pixels': pixels, 'pixelsize': pixelsize, 'image': image}
+
+
+def recalibrate(filename: str, pixelsize: float, outputfile: Optional[str] = None) -> int:
+    """Recalculate the physical units in a results file from the pixels with a new pixel size
+
+    The file is rewritten, or written into `outputfile`, in its own format. Returns the number of circles.
+    """
+    if not pixelsize > 0:
+        raise ValueError('The pixel size must be positive')
+    results = readResults(filename)
+    if results['pixels'] is None:
+        raise ValueError('File {} records neither the pixels nor the pixel size'.format(filename))
+    # the rows may be memory-mapped from the file to be overwritten
+    pixels, image = np.array(results['pixels']), results['image']
+    binary = isBinaryResultsFile(filename)
+    if outputfile is None:
+        outputfile = filename
+    del results
+    if binary:
+        saveBinary(outputfile, pixels, pixelsize, image)
+    else:
+        saveText(outputfile, pixels, pixelsize)
+    return len(pixels)
+
+
+class BinaryResultsWriter:
+    """Keeps a binary results file up to date with append-only writes
+
+    Appending rows writes only the new rows and the fixed-size header. The rows are written (and flushed) before the
+    header, so an interrupted append leaves a readable file.
+    """
+
+    def __init__(self, filename: str, pixels: np.ndarray, pixelsize: float, image: Optional[str] = None):
+        self.filename = filename
+        self._file = None
+        self.rewrite(pixels, pixelsize, image)
+
+    def rewrite(self, pixels: np.ndarray, pixelsize: float, image: Optional[str] = None):
+        """Write the whole file anew (needed after removing rows)"""
+        self.close()
+        pixels = withFrames(pixels)
+        self.image = image
+        block, self._dataoffset = _metadataBlock(image)
+        self._jsonlength = len(block)
+        with open(self.filename, 'wb') as f:
+            writeBinary(f, pixels, pixelsize, image)
+        self._rows = len(pixels)
+        self._file = open(self.filename, 'r+b')
+
+    def append(self, rows: np.ndarray, pixelsize: float, statistics: Dict[str, float]):
+        """Append new rows (in pixels). `statistics` are those of all rows (in physical units), including the new
+        ones."""
+        rows = np.ascontiguousarray(_fileRows(rows, pixelsize), dtype='<f8')
+        self._file.seek(self._dataoffset + self._rows * 8 * len(FILE_COLUMNS))
+        self._file.write(rows.tobytes())
+        self._file.flush()
+        self._rows += len(rows)
+        self.updateHeader(pixelsize, statistics)
+
+    def updateHeader(self, pixelsize: float, statistics: Dict[str, float]):
+        self._file.seek(0)
+        self._file.write(_packHeader(len(FILE_COLUMNS), self._rows, pixelsize, statistics, self._jsonlength,
+                                     self._dataoffset))
+        self._file.flush()
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
@@ -1,17 +1,66 @@
+from typing import Iterable, Optional
+
 from PyQt5 import QtCore
 import numpy as np
 
+from .profiling import timed
+from .resultsfile import COLUMNS, toPixels, withFrames
+
+
 class ResultsModel(QtCore.QAbstractItemModel):
-    def __init__(self, parent=None):
+    # Rows are stored in pixel units in a preallocated NumPy array (columns: x, y, diameter, frame), which grows
+    # geometrically when full. The frame is the index of the frame of an image stack the circle belongs to (0 for
+    # single images). The same rows in physical units (nm) are kept in a second array, derived from the pixels by a
+    # single vectorized multiplication whenever the pixel size changes: recalibration does not move the circles on the
+    # image, only their physical sizes change.
+    # Running sums of the diameters (in pixels) are updated on each insertion and removal, making the mean and the
+    # standard deviation O(1). Minimum and maximum are tracked as well, and only recomputed when an extremal value is
+    # removed. All of these scale with the pixel size.
+    _initialcapacity = 64
+
+    pixelSizeChanged = QtCore.pyqtSignal(float)
+
+    def __init__(self, parent=None, pixelsize: float = 1.0):
         super().__init__(parent)
-        self._data=[]
+        self._data = np.empty((self._initialcapacity, len(COLUMNS)), dtype=np.float64)
+        self._physical = np.empty_like(self._data)
+        self._count = 0
+        self._pixelsize = float(pixelsize)
+        self._resetStatistics()
 
+    def _resetStatistics(self):
+        # sums are taken of the deviations from a shift value (the first diameter inserted) to avoid the loss of
+        # precision in sum(d**2) - sum(d)**2/n
+        self._shift = None
+        self._sum = 0.0
+        self._sumsq = 0.0
+        self._min = np.inf
+        self._max = -np.inf
+        self._minmaxvalid = True
+
+    @property
+    def pixelSize(self) -> float:
+        return self._pixelsize
+
+    @timed()
+    def setPixelSize(self, pixelsize: float):
+        """Change the pixel size: the physical units of all rows are recalculated from the pixels"""
+        pixelsize = float(pixelsize)
+        if not pixelsize > 0:
+            raise ValueError('The pixel size must be positive')
+        if pixelsize == self._pixelsize:
+            return
+        self._pixelsize = pixelsize
+        np.multiply(self._data[:self._count, :3], pixelsize, out=self._physical[:self._count, :3])
+        if self._count:
+            self.dataChanged.emit(self.index(0, 0), self.index(self._count - 1, 2), [QtCore.Qt.DisplayRole])
+        self.pixelSizeChanged.emit(pixelsize)
 
     def rowCount(self, parent: QtCore.QModelIndex = ...):
-        return len(self._data)
+        return self._count
 
     def columnCount(self, parent: QtCore.QModelIndex = ...):
-        return 3
+        return len(COLUMNS)
 
     def flags(self, index: QtCore.QModelIndex):
         return QtCore.Qt.ItemIsSelectable | QtCore.Qt.ItemNeverHasChildren | QtCore.Qt.ItemIsEnabled
@@ -21,48 +70,193 @@ class ResultsModel(QtCore.QAbstractItemModel):
 
     def data(self, index: QtCore.QModelIndex, role: int = ...):
         if role == QtCore.Qt.DisplayRole:
-            return '{:.3f}'.format(self._data[index.row()][index.column()])
+            if index.column() == 3:
+                return str(int(self._data[index.row(), 3]))
+            return '{:.3f}'.format(self._physical[index.row(), index.column()])
         else:
             return None
 
     def headerData(self, section: int, orientation: QtCore.Qt.Orientation, role: int = ...):
         if orientation == QtCore.Qt.Horizontal and role == QtCore.Qt.DisplayRole:
-            return ['X coordinate','Y coordinate', 'Diameter'][section]
+            return ['X coordinate','Y coordinate', 'Diameter', 'Frame'][section]
         else:
             return None
 
     def index(self, row: int, column: int, parent: QtCore.QModelIndex = ...):
         return self.createIndex(row, column, None)
 
-    def append(self, x:float, y:float, diameter:float):
-        self.beginInsertRows(QtCore.QModelIndex(), len(self._data), len(self._data))
-        self._data.append((x,y,diameter))
+    @timed()
+    def append(self, x:float, y:float, diameter:float, frame: int = 0):
+        """Append a circle given in physical units"""
+        self.extend([(x, y, diameter, frame)])
+
+    def _reserve(self, count: int):
+        """Make room for `count` more rows"""
+        if self._count + count > len(self._data):
+            capacity = max(2 * len(self._data), self._count + count)
+            newdata = np.empty((capacity, len(COLUMNS)), dtype=np.float64)
+            newdata[:self._count] = self._data[:self._count]
+            self._data = newdata
+            newphysical = np.empty_like(newdata)
+            newphysical[:self._count] = self._physical[:self._count]
+            self._physical = newphysical
+
+    def _store(self, first: int, rows: np.ndarray):
+        """Write rows in pixels at the given place, and their physical units"""
+        self._data[first:first + len(rows)] = rows
+        np.multiply(rows[:, :3], self._pixelsize, out=self._physical[first:first + len(rows), :3])
+        self._physical[first:first + len(rows), 3] = rows[:, 3]
+
+    def _shiftRows(self, source: int, destination: int):
+        """Move the rows from `source` to the end to `destination`"""
+        count = self._count - source
+        self._data[destination:destination + count] = self._data[source:self._count]
+        self._physical[destination:destination + count] = self._physical[source:self._count]
+
+    def _addStatistics(self, diameters: np.ndarray):
+        if self._shift is None:
+            self._shift = float(diameters[0])
+        self._sum += float(np.sum(diameters - self._shift))
+        self._sumsq += float(np.sum((diameters - self._shift) ** 2))
+        if self._minmaxvalid:
+            self._min = min(self._min, float(diameters.min()))
+            self._max = max(self._max, float(diameters.max()))
+
+    @timed()
+    def extend(self, rows):
+        """Append rows of x, y, diameter (in physical units) and frame. Rows without a frame are assigned to frame 0.
+        """
+        self.extendPixels(toPixels(rows, self._pixelsize))
+
+    @timed()
+    def extendPixels(self, rows):
+        """Append rows of x, y, diameter (in pixels) and frame. Rows without a frame are assigned to frame 0."""
+        rows = withFrames(rows)
+        if not len(rows):
+            return
+        self._reserve(len(rows))
+        self.beginInsertRows(QtCore.QModelIndex(), self._count, self._count + len(rows) - 1)
+        self._store(self._count, rows)
+        self._count += len(rows)
+        self._addStatistics(rows[:, 2])
         self.endInsertRows()
 
+    @timed()
+    def insertRowList(self, rows: Iterable[int], data):
+        """Insert rows (given in pixels, as in extendPixels()) so that they get the given indices: the inverse of
+        removeRowList(). There is one beginInsertRows()/endInsertRows() pair per contiguous range."""
+        rows = np.fromiter(rows, dtype=np.intp)
+        data = withFrames(data)
+        if len(rows) != len(data):
+            raise ValueError('The number of indices and of rows differ')
+        if not len(rows):
+            return
+        order = np.argsort(rows, kind='stable')
+        rows, data = rows[order], data[order]
+        if rows[0] < 0 or rows[-1] >= self._count + len(rows) or (np.diff(rows) == 0).any():
+            raise IndexError('Row index out of range')
+        self._reserve(len(rows))
+        # going forwards, the rows inserted before are already at their final place
+        for rng in np.split(np.arange(len(rows)), np.nonzero(np.diff(rows) != 1)[0] + 1):
+            first, count = int(rows[rng[0]]), len(rng)
+            self.beginInsertRows(QtCore.QModelIndex(), first, first + count - 1)
+            self._shiftRows(first, first + count)
+            self._store(first, data[rng])
+            self._count += count
+            self._addStatistics(data[rng, 2])
+            self.endInsertRows()
+
     def removeRow(self, row: int, parent: QtCore.QModelIndex = ...):
-        self.beginRemoveRows(QtCore.QModelIndex(), row, row)
-        del self._data[row]
-        self.endRemoveRows()
+        self.removeRowList([row])
+
+    @timed()
+    def removeRowList(self, rows: Iterable[int]):
+        """Remove several rows, with one beginRemoveRows()/endRemoveRows() pair per contiguous range"""
+        rows = np.unique(np.fromiter(rows, dtype=np.intp))
+        if not len(rows):
+            return
+        if rows[0] < 0 or rows[-1] >= self._count:
+            raise IndexError('Row index out of range')
+        ranges = np.split(rows, np.nonzero(np.diff(rows) != 1)[0] + 1)
+        # going backwards, the indices of the ranges not yet removed remain valid
+        for rng in reversed(ranges):
+            first, last = int(rng[0]), int(rng[-1])
+            self.beginRemoveRows(QtCore.QModelIndex(), first, last)
+            removed = self._data[first:last + 1, 2]
+            self._sum -= float(np.sum(removed - self._shift))
+            self._sumsq -= float(np.sum((removed - self._shift) ** 2))
+            if self._minmaxvalid and ((removed.min() <= self._min) or (removed.max() >= self._max)):
+                self._minmaxvalid = False
+            self._shiftRows(last + 1, first)
+            self._count -= last - first + 1
+            if not self._count:
+                self._resetStatistics()
+            self.endRemoveRows()
 
+    @timed()
     def clear(self):
         self.beginResetModel()
-        self._data=[]
+        self._data = np.empty((self._initialcapacity, len(COLUMNS)), dtype=np.float64)
+        self._physical = np.empty_like(self._data)
+        self._count = 0
+        self._resetStatistics()
         self.endResetModel()
 
-    def getData(self):
-        return self._data[:]
+    def getData(self) -> np.ndarray:
+        """Read-only view of the rows (x, y, diameter in physical units, frame). Valid until the next modification of
+        the model or of the pixel size."""
+        view = self._physical[:self._count]
+        view.flags.writeable = False
+        return view
+
+    def getPixelData(self) -> np.ndarray:
+        """Read-only view of the rows (x, y, diameter in pixels, frame). Valid until the next modification of the
+        model."""
+        view = self._data[:self._count]
+        view.flags.writeable = False
+        return view
+
+    def getDiameters(self, frame: Optional[int] = None) -> np.ndarray:
+        """Diameters (in physical units) of all circles, or of those on a given frame"""
+        data = self.getData()
+        if frame is None:
+            return data[:, 2]
+        return data[data[:, 3] == frame, 2]
+
+    def getFrames(self) -> np.ndarray:
+        return self.getData()[:, 3]
+
+    def _updateMinMax(self):
+        if not self._minmaxvalid:
+            diameters = self._data[:self._count, 2]
+            self._min = float(diameters.min()) if self._count else np.inf
+            self._max = float(diameters.max()) if self._count else -np.inf
+            self._minmaxvalid = True
 
     def getMeanDiameter(self) -> float:
-        return np.mean([d[2] for d in self._data])
+        if not self._count:
+            return np.nan
+        return (self._shift + self._sum / self._count) * self._pixelsize
 
     def getStdDiameter(self) -> float:
-        return np.std([d[2] for d in self._data])
+        if not self._count:
+            return np.nan
+        return np.sqrt(max(self._sumsq / self._count - (self._sum / self._count) ** 2, 0.0)) * self._pixelsize
 
     def getMinDiameter(self) -> float:
-        return np.min([d[2] for d in self._data])
+        if not self._count:
+            return np.nan
+        self._updateMinMax()
+        return self._min * self._pixelsize
 
     def getMaxDiameter(self) -> float:
-        return np.max([d[2] for d in self._data])
+        if not self._count:
+            return np.nan
+        self._updateMinMax()
+        return self._max * self._pixelsize
 
     def getPtPDiameter(self) -> float:
-        return np.ptp([d[2] for d in self._data])
\ No newline at end of file
+        if not self._count:
+            return np.nan
+        self._updateMinMax()
+        return (self._max - self._min) * self._pixelsize
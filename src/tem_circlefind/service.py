@@ -0,0 +1,553 @@
+"""Local HTTP/JSON measurement service
+
+Usage: python -m tem_circlefind serve [--port PORT] [--workers N]
+
+Lets other programs (e.g. an acquisition pipeline) measure images without a person at the GUI. The server listens on
+the loopback interface only. Measurements use the same code as the GUI: the circle geometry for clicks, edge snapping,
+automatic detection, the circle index for skipping duplicates, and the results files. The results of each image are
+kept in pixels, as in the results model, and converted to physical units with the pixel size of the session.
+
+Requests (the bodies are JSON objects, and so are the responses unless noted):
+
+    GET    /sessions                        the open sessions
+    POST   /sessions                        open an image: {"image": file name, "pixelsize": nm, "frame": 0}
+    GET    /sessions/<id>                   the session (image, frame, number of frames, pixel size, circle count)
+    DELETE /sessions/<id>                   close the session
+    POST   /sessions/<id>/frame             show another frame of a stack: {"frame": index}
+    PUT    /sessions/<id>/pixelsize         recalibrate: {"pixelsize": nm}. The circles keep their pixel values.
+    POST   /sessions/<id>/clicks            add circles from clicked points (pixel coordinates):
+                                            {"points": [[x, y], ...], "mode": "diameter" | "threepoints" | "fit",
+                                            "snap": window in pixels (optional)}. "diameter" takes the points in
+                                            pairs (endpoints of the diameters), "threepoints" in triplets
+                                            (circumscribed circles), "fit" fits a single circle to all of them.
+    POST   /sessions/<id>/detect            automatic detection on the current frame: {"mindiameter": nm,
+                                            "maxdiameter": nm, "threshold": 1.0, "polarity": "both"}
+    GET    /sessions/<id>/results           the circles (in physical units and in pixels) and their statistics
+    GET    /sessions/<id>/results.tcr       the results in the binary results file format (application/octet-stream)
+    GET    /sessions/<id>/statistics        statistics of the diameters, optionally of a single frame (?frame=index)
+
+Errors are reported with the HTTP status code and a JSON object {"error": message}.
+
+Connections are served concurrently. The requests of a session are queued and carried out in the order of arrival,
+while those of different sessions run in parallel: image loading, detection, snapping and fitting run in a thread pool
+(NumPy and SciPy release the GIL in the heavy parts), not in the event loop.
+
+No Qt or matplotlib here.
+"""
+
+import argparse
+import asyncio
+import http.client
+import io
+import itertools
+import json
+import threading
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+from http import HTTPStatus
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from . import profiling
+from .geometry import fitCircleGeometric, threePointCircles, twoPointCircles
+from .imagesource import frameCount, loadImageData
+from .resultsfile import COLUMNS, diameterStatistics, toPhysical, withFrames, writeBinary
+from .spatialindex import CircleIndex
+
+LOCALHOST = '127.0.0.1'
+DEFAULT_PORT = 8765
+CLICK_MODES = {'diameter': 2, 'threepoints': 3, 'fit': 3}
+
+_MAXBODY = 64 * 1024 * 1024
+_MAXHEADERS = 100
+
+
+class ServiceError(Exception):
+    """An error with the HTTP status code to report it with (raised by the client as well)"""
+
+    def __init__(self, status: int, message: str):
+        super().__init__(message)
+        self.status = status
+
+
+def _finite(values: Dict[str, float]) -> Dict[str, Optional[float]]:
+    # NaN is not valid JSON
+    return {k: (v if np.isfinite(v) else None) for k, v in values.items()}
+
+
+def _parameter(body: Dict, name: str, convert: Callable = float, default: Any = None) -> Any:
+    if name not in body:
+        if default is None:
+            raise ServiceError(400, 'Missing parameter: {}'.format(name))
+        return default
+    try:
+        return convert(body[name])
+    except (TypeError, ValueError):
+        raise ServiceError(400, 'Invalid value of parameter {}: {!r}'.format(name, body[name]))
+
+
+def _pixelSize(body: Dict) -> float:
+    pixelsize = _parameter(body, 'pixelsize')
+    if not pixelsize > 0:
+        raise ServiceError(400, 'The pixel size must be positive')
+    return pixelsize
+
+
+class Session:
+    """An image being measured, with its results (rows of x, y, diameter in pixels and frame)
+
+    Not thread safe: the service runs the operations of a session one at a time.
+    """
+
+    def __init__(self, id: str, filename: str, pixelsize: float):
+        self.id = id
+        self.filename = filename
+        self.pixelsize = pixelsize
+        self.nframes = 1
+        self.frame = 0
+        self.data = None
+        self.results = np.empty((0, len(COLUMNS)), dtype=np.float64)
+        self.circleIndex = CircleIndex()
+        self._edgeSnapper = None
+        # the requests of the session, carried out one at a time in the order of arrival
+        self.lock = asyncio.Lock()
+
+    def info(self) -> Dict:
+        return {'id': self.id, 'image': self.filename, 'frame': self.frame, 'nframes': self.nframes,
+                'shape': list(self.data.shape), 'pixelsize': self.pixelsize, 'circles': len(self.results)}
+
+    @profiling.timed('service: load frame')
+    def load(self, frame: int):
+        if self.data is None:
+            self.nframes = frameCount(self.filename)
+        if not 0 <= frame < self.nframes:
+            raise ServiceError(400, 'Frame {} out of range'.format(frame))
+        self.data = loadImageData(self.filename, frame)
+        self.frame = frame
+        self._edgeSnapper = None
+
+    def _append(self, circles: np.ndarray) -> List[int]:
+        rows = list(range(len(self.results), len(self.results) + len(circles)))
+        self.results = np.concatenate([self.results, circles])
+        self.circleIndex.append(circles)
+        return rows
+
+    @profiling.timed('service: clicks')
+    def addClicks(self, points: np.ndarray, mode: str, snap: Optional[int]) -> Dict:
+        if mode not in CLICK_MODES:
+            raise ServiceError(400, 'Unknown mode: {}'.format(mode))
+        if points.ndim != 2 or points.shape[1] != 2 or len(points) < CLICK_MODES[mode]:
+            raise ServiceError(400, 'At least {} points (x, y pairs) are needed'.format(CLICK_MODES[mode]))
+        if mode != 'fit' and len(points) % CLICK_MODES[mode]:
+            raise ServiceError(400, 'The number of points must be a multiple of {}'.format(CLICK_MODES[mode]))
+        if snap is not None:
+            if self._edgeSnapper is None:
+                # imported when first needed: scipy.ndimage takes long to import
+                from .edgesnap import EdgeSnapper
+                self._edgeSnapper = EdgeSnapper(self.data)
+            points = np.array([self._edgeSnapper.snap(x, y, snap) for x, y in points.tolist()])
+        if mode == 'diameter':
+            circles = twoPointCircles(points.reshape(-1, 2, 2))
+        elif mode == 'threepoints':
+            circles = threePointCircles(points.reshape(-1, 3, 2))
+        else:
+            circles = fitCircleGeometric(points)[np.newaxis, :]
+        # collinear or coincident points are not added, as in the GUI
+        valid = np.isfinite(circles).all(axis=1)
+        circles = withFrames(circles[valid], self.frame)
+        # overlapping circles are added, but reported
+        overlaps = self.circleIndex.overlaps(circles)
+        rows = self._append(circles)
+        return {'rows': rows, 'circles': toPhysical(circles, self.pixelsize)[:, :3].tolist(),
+                'overlaps': [int(o) if o >= 0 else None for o in overlaps], 'degenerate': int((~valid).sum())}
+
+    @profiling.timed('service: detect')
+    def detect(self, mindiameter: float, maxdiameter: float, threshold: float, polarity: str) -> Dict:
+        from .circledetection import findCircles
+        circles = findCircles(self.data, mindiameter / self.pixelsize, maxdiameter / self.pixelsize,
+                              threshold=threshold, polarity=polarity)
+        circles = withFrames(circles, self.frame)
+        # particles already measured are not added again
+        circles = circles[self.circleIndex.overlaps(circles) < 0]
+        rows = self._append(circles)
+        return {'rows': rows, 'found': len(rows)}
+
+    def statistics(self, frame: Optional[int] = None) -> Dict:
+        diameters = self.results[:, 2] if frame is None else self.results[self.results[:, 3] == frame, 2]
+        return dict(_finite(diameterStatistics(diameters * self.pixelsize)), count=len(diameters))
+
+    def resultsJSON(self) -> Dict:
+        return {'image': self.filename, 'pixelsize': self.pixelsize, 'columns': list(COLUMNS),
+                'data': toPhysical(self.results, self.pixelsize).tolist(), 'pixels': self.results.tolist(),
+                'statistics': self.statistics()}
+
+    @profiling.timed('service: binary results')
+    def resultsBinary(self) -> bytes:
+        f = io.BytesIO()
+        writeBinary(f, self.results, self.pixelsize, self.filename)
+        return f.getvalue()
+
+
+class MeasurementService:
+    def __init__(self, workers: Optional[int] = None):
+        self.sessions: Dict[str, Session] = {}
+        self._ids = itertools.count(1)
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='service')
+        self._server: Optional[asyncio.AbstractServer] = None
+        # method, path pattern (split at the slashes, None matches the session id), handler
+        self._routes = [
+            ('GET', ('sessions',), self._listSessions),
+            ('POST', ('sessions',), self._openSession),
+            ('GET', ('sessions', None), self._getSession),
+            ('DELETE', ('sessions', None), self._closeSession),
+            ('POST', ('sessions', None, 'frame'), self._setFrame),
+            ('PUT', ('sessions', None, 'pixelsize'), self._setPixelSize),
+            ('POST', ('sessions', None, 'clicks'), self._addClicks),
+            ('POST', ('sessions', None, 'detect'), self._detect),
+            ('GET', ('sessions', None, 'results'), self._results),
+            ('GET', ('sessions', None, 'results.tcr'), self._resultsBinary),
+            ('GET', ('sessions', None, 'statistics'), self._statistics),
+        ]
+
+    async def start(self, port: int = DEFAULT_PORT) -> int:
+        """Start listening. Returns the port (useful if `port` is 0, i.e. chosen by the system)."""
+        self._server = await asyncio.start_server(self._handleConnection, LOCALHOST, port)
+        return self._server.sockets[0].getsockname()[1]
+
+    async def serveForever(self):
+        await self._server.serve_forever()
+
+    async def close(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+        self._executor.shutdown(wait=False)
+
+    async def _run(self, func: Callable, *args) -> Any:
+        """Run a function in the thread pool"""
+        return await asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+
+    async def _handleConnection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while True:
+                try:
+                    request = await _readRequest(reader)
+                except ServiceError as exc:
+                    writer.write(_response(exc.status, _jsonBody({'error': str(exc)}), keepalive=False))
+                    await writer.drain()
+                    break
+                if request is None:
+                    break
+                method, target, headers, body = request
+                with profiling.timing('service: {} request'.format(method)):
+                    status, payload = await self._dispatch(method, target, body)
+                keepalive = headers.get('connection', '').lower() != 'close'
+                writer.write(_response(status, payload, keepalive))
+                await writer.drain()
+                if not keepalive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def _dispatch(self, method: str, target: str, body: bytes) -> Tuple[int, Tuple[str, bytes]]:
+        url = urllib.parse.urlsplit(target)
+        parts = tuple(p for p in url.path.split('/') if p)
+        query = {k: v[-1] for k, v in urllib.parse.parse_qs(url.query).items()}
+        allowed = False
+        for routemethod, pattern, handler in self._routes:
+            if len(pattern) != len(parts) or any(p is not None and p != q for p, q in zip(pattern, parts)):
+                continue
+            allowed = True
+            if routemethod != method:
+                continue
+            try:
+                if body:
+                    try:
+                        body = json.loads(body.decode('utf-8'))
+                    except ValueError:
+                        raise ServiceError(400, 'Malformed JSON')
+                    if not isinstance(body, dict):
+                        raise ServiceError(400, 'The request body must be a JSON object')
+                else:
+                    body = {}
+                sessionid = parts[1] if len(parts) > 1 else None
+                return 200, await handler(sessionid, body, query)
+            except ServiceError as exc:
+                return exc.status, _jsonBody({'error': str(exc)})
+            except (OSError, ValueError, IndexError) as exc:
+                return 400, _jsonBody({'error': str(exc)})
+            except Exception as exc:
+                return 500, _jsonBody({'error': '{}: {}'.format(type(exc).__name__, exc)})
+        if allowed:
+            return 405, _jsonBody({'error': 'Method not allowed: {}'.format(method)})
+        return 404, _jsonBody({'error': 'Not found: {}'.format(url.path)})
+
+    def _session(self, sessionid: str) -> Session:
+        try:
+            return self.sessions[sessionid]
+        except KeyError:
+            raise ServiceError(404, 'No such session: {}'.format(sessionid))
+
+    async def _listSessions(self, sessionid, body, query):
+        return _jsonBody([session.info() for session in self.sessions.values()])
+
+    async def _openSession(self, sessionid, body, query):
+        session = Session(str(next(self._ids)), _parameter(body, 'image', str), _pixelSize(body))
+        await self._run(session.load, _parameter(body, 'frame', int, 0))
+        self.sessions[session.id] = session
+        return _jsonBody(session.info())
+
+    async def _getSession(self, sessionid, body, query):
+        return _jsonBody(self._session(sessionid).info())
+
+    async def _closeSession(self, sessionid, body, query):
+        session = self._session(sessionid)
+        async with session.lock:
+            # another request may have closed the session while this one was waiting
+            if self.sessions.pop(sessionid, None) is None:
+                raise ServiceError(404, 'No such session: {}'.format(sessionid))
+        return _jsonBody({})
+
+    async def _setFrame(self, sessionid, body, query):
+        session = self._session(sessionid)
+        frame = _parameter(body, 'frame', int)
+        async with session.lock:
+            await self._run(session.load, frame)
+            return _jsonBody(session.info())
+
+    async def _setPixelSize(self, sessionid, body, query):
+        session = self._session(sessionid)
+        pixelsize = _pixelSize(body)
+        async with session.lock:
+            session.pixelsize = pixelsize
+            return _jsonBody(session.info())
+
+    async def _addClicks(self, sessionid, body, query):
+        session = self._session(sessionid)
+        try:
+            points = np.array(body.get('points', []), dtype=np.float64)
+        except (TypeError, ValueError):
+            raise ServiceError(400, 'Invalid points')
+        mode = _parameter(body, 'mode', str, 'diameter')
+        snap = _parameter(body, 'snap', int) if body.get('snap') is not None else None
+        async with session.lock:
+            return _jsonBody(await self._run(session.addClicks, points, mode, snap))
+
+    async def _detect(self, sessionid, body, query):
+        session = self._session(sessionid)
+        mindiameter = _parameter(body, 'mindiameter')
+        maxdiameter = _parameter(body, 'maxdiameter')
+        threshold = _parameter(body, 'threshold', float, 1.0)
+        polarity = _parameter(body, 'polarity', str, 'both')
+        async with session.lock:
+            return _jsonBody(await self._run(session.detect, mindiameter, maxdiameter, threshold, polarity))
+
+    async def _results(self, sessionid, body, query):
+        session = self._session(sessionid)
+        async with session.lock:
+            # large result sets take a while to encode
+            return await self._run(lambda: _jsonBody(session.resultsJSON()))
+
+    async def _resultsBinary(self, sessionid, body, query):
+        session = self._session(sessionid)
+        async with session.lock:
+            return 'application/octet-stream', await self._run(session.resultsBinary)
+
+    async def _statistics(self, sessionid, body, query):
+        session = self._session(sessionid)
+        frame = _parameter(query, 'frame', int) if 'frame' in query else None
+        async with session.lock:
+            return _jsonBody(session.statistics(frame))
+
+
+def _jsonBody(value: Any) -> Tuple[str, bytes]:
+    return 'application/json', json.dumps(value).encode('utf-8')
+
+
+async def _readRequest(reader: asyncio.StreamReader) -> Optional[Tuple[str, str, Dict[str, str], bytes]]:
+    """Read an HTTP/1.1 request: method, target, headers (lower case names) and body. None at the end of the stream."""
+    line = await reader.readline()
+    if not line.strip():
+        return None
+    try:
+        method, target, version = line.decode('latin-1').split()
+    except ValueError:
+        raise ServiceError(400, 'Malformed request line')
+    headers = {}
+    for i in itertools.count():
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            break
+        if i >= _MAXHEADERS:
+            raise ServiceError(431, 'Too many header fields')
+        name, _, value = line.decode('latin-1').partition(':')
+        headers[name.strip().lower()] = value.strip()
+    try:
+        length = int(headers.get('content-length', 0))
+    except ValueError:
+        raise ServiceError(400, 'Invalid Content-Length')
+    if length > _MAXBODY:
+        raise ServiceError(413, 'Request body too large')
+    body = await reader.readexactly(length) if length > 0 else b''
+    return method.upper(), target, headers, body
+
+
+def _response(status: int, payload: Tuple[str, bytes], keepalive: bool = True) -> bytes:
+    contenttype, body = payload
+    head = 'HTTP/1.1 {} {}\r\nContent-Type: {}\r\nContent-Length: {}\r\nConnection: {}\r\n\r\n'.format(
+        status, HTTPStatus(status).phrase, contenttype, len(body), 'keep-alive' if keepalive else 'close')
+    return head.encode('latin-1') + body
+
+
+class ServiceClient:
+    """Blocking client of the service, e.g. for scripts and tests. Raises ServiceError on errors."""
+
+    def __init__(self, port: int = DEFAULT_PORT, host: str = LOCALHOST, timeout: float = 300.0):
+        self._connection = http.client.HTTPConnection(host, port, timeout=timeout)
+
+    def close(self):
+        self._connection.close()
+
+    def __enter__(self) -> 'ServiceClient':
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def request(self, method: str, path: str, body: Optional[Dict] = None) -> Any:
+        """Send a request. Returns the decoded JSON response, or the bytes of a binary one."""
+        payload = json.dumps(body).encode('utf-8') if body is not None else None
+        headers = {'Content-Type': 'application/json'} if payload is not None else {}
+        self._connection.request(method, path, body=payload, headers=headers)
+        response = self._connection.getresponse()
+        data = response.read()
+        if response.getheader('Content-Type') == 'application/json':
+            data = json.loads(data.decode('utf-8'))
+        if response.status != 200:
+            raise ServiceError(response.status, data['error'] if isinstance(data, dict) else str(data))
+        return data
+
+    def openImage(self, image: str, pixelsize: float, frame: int = 0) -> Dict:
+        """Open a session for an image. The session id is in the 'id' key of the result."""
+        return self.request('POST', '/sessions', {'image': image, 'pixelsize': pixelsize, 'frame': frame})
+
+    def closeSession(self, session: str):
+        self.request('DELETE', '/sessions/{}'.format(session))
+
+    def setFrame(self, session: str, frame: int) -> Dict:
+        return self.request('POST', '/sessions/{}/frame'.format(session), {'frame': frame})
+
+    def setPixelSize(self, session: str, pixelsize: float) -> Dict:
+        return self.request('PUT', '/sessions/{}/pixelsize'.format(session), {'pixelsize': pixelsize})
+
+    def addClicks(self, session: str, points: Sequence[Sequence[float]], mode: str = 'diameter',
+                  snap: Optional[int] = None) -> Dict:
+        return self.request('POST', '/sessions/{}/clicks'.format(session),
+                            {'points': np.asarray(points, dtype=np.float64).tolist(), 'mode': mode, 'snap': snap})
+
+    def detect(self, session: str, mindiameter: float, maxdiameter: float, threshold: float = 1.0,
+               polarity: str = 'both') -> Dict:
+        return self.request('POST', '/sessions/{}/detect'.format(session),
+                            {'mindiameter': mindiameter, 'maxdiameter': maxdiameter, 'threshold': threshold,
+                             'polarity': polarity})
+
+    def results(self, session: str) -> Dict:
+        """The results, with the rows ('data' in physical units and 'pixels') as NumPy arrays"""
+        results = self.request('GET', '/sessions/{}/results'.format(session))
+        for key in ('data', 'pixels'):
+            results[key] = np.array(results[key], dtype=np.float64).reshape(-1, len(COLUMNS))
+        return results
+
+    def resultsBinary(self, session: str) -> bytes:
+        """The results in the binary results file format"""
+        return self.request('GET', '/sessions/{}/results.tcr'.format(session))
+
+    def statistics(self, session: str, frame: Optional[int] = None) -> Dict:
+        query = '' if frame is None else '?frame={:d}'.format(frame)
+        return self.request('GET', '/sessions/{}/statistics{}'.format(session, query))
+
+
+class BackgroundService:
+    """The service running in a thread with its own event loop, e.g. for tests:
+
+        with BackgroundService() as service, ServiceClient(service.port) as client:
+            ...
+    """
+
+    def __init__(self, port: int = 0, workers: Optional[int] = None):
+        self.port = port
+        self.workers = workers
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._stop: Optional[asyncio.Event] = None
+        self._started = threading.Event()
+        self._error: Optional[BaseException] = None
+        self._thread = threading.Thread(target=self._main, name='service', daemon=True)
+
+    def _main(self):
+        asyncio.run(self._serve())
+
+    async def _serve(self):
+        service = MeasurementService(self.workers)
+        try:
+            self.port = await service.start(self.port)
+        except BaseException as exc:
+            self._error = exc
+            self._started.set()
+            return
+        self._loop = asyncio.get_running_loop()
+        self._stop = asyncio.Event()
+        self._started.set()
+        await self._stop.wait()
+        await service.close()
+
+    def __enter__(self) -> 'BackgroundService':
+        self._thread.start()
+        self._started.wait()
+        if self._error is not None:
+            raise self._error
+        return self
+
+    def __exit__(self, *args):
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._stop.set)
+        self._thread.join()
+
+
+def main(argv: Optional[Sequence[str]] = None) -> int:
+    parser = argparse.ArgumentParser(prog='tem_circlefind serve',
+                                     description='Measure images through a local HTTP/JSON service')
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT, help='Port on {} (default: %(default)s)'.format(
+        LOCALHOST))
+    parser.add_argument('-j', '--workers', type=int, default=None,
+                        help='Number of worker threads for the heavy computations (default: chosen by Python)')
+    parser.add_argument('--profile', action='store_true',
+                        help='Time the requests and print the latency statistics at exit')
+    args = parser.parse_args(argv)
+
+    if args.profile:
+        profiling.setEnabled(True)
+
+    async def serve():
+        service = MeasurementService(args.workers)
+        port = await service.start(args.port)
+        print('Serving on http://{}:{}/'.format(LOCALHOST, port), flush=True)
+        try:
+            await service.serveForever()
+        finally:
+            await service.close()
+
+    try:
+        asyncio.run(serve())
+    except KeyboardInterrupt:
+        pass
+    except OSError as exc:
+        print('Cannot start the service: {}'.format(exc))
+        return 1
+    finally:
+        if args.profile:
+            print(profiling.formatSummary())
+    return 0
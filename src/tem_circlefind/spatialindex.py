@@ -0,0 +1,137 @@
+"""Spatial index over circle centres
+
+A k-d tree (scipy.spatial.cKDTree) is built over the circles. Circles appended afterwards are kept in a short tail,
+which is searched by brute force, and merged into the tree when the tail grows too long. Removing circles only
+invalidates the tree: it is rebuilt at the next query.
+
+Circles are identified by their row indices, i.e. the index must be kept in sync with the list of circles (the
+results model). Two circles are considered duplicates (measurements of the same particle) if they are on the same
+frame of the image and the distance of their centres is less than `tolerance` times the sum of their radii.
+"""
+
+from typing import TYPE_CHECKING, List, Optional
+
+import numpy as np
+
+from .resultsfile import COLUMNS, withFrames
+
+if TYPE_CHECKING:
+    from scipy.spatial import cKDTree
+
+DUPLICATE_TOLERANCE = 0.5
+
+
+class CircleIndex:
+    def __init__(self, maxtail: int = 256):
+        self.maxtail = maxtail
+        self._circles = np.empty((64, len(COLUMNS)), dtype=np.float64)
+        self._count = 0
+        self._tree: Optional['cKDTree'] = None
+        # the tree covers the first _ntree circles, the rest is the tail
+        self._ntree = 0
+        # upper bound of the diameters, for limiting the search radius
+        self._maxdiameter = 0.0
+
+    def __len__(self) -> int:
+        return self._count
+
+    def reset(self, circles: np.ndarray):
+        """Replace all circles (rows of x, y, diameter and optionally the frame)"""
+        self._count = 0
+        self._tree = None
+        self._ntree = 0
+        self._maxdiameter = 0.0
+        self.append(circles)
+
+    def append(self, circles: np.ndarray):
+        circles = withFrames(circles)
+        if self._count + len(circles) > len(self._circles):
+            newcircles = np.empty((max(2 * len(self._circles), self._count + len(circles)), len(COLUMNS)),
+                                  dtype=np.float64)
+            newcircles[:self._count] = self._circles[:self._count]
+            self._circles = newcircles
+        self._circles[self._count:self._count + len(circles)] = circles
+        self._count += len(circles)
+        if len(circles):
+            self._maxdiameter = max(self._maxdiameter, float(np.nanmax(circles[:, 2], initial=0)))
+
+    def remove(self, first: int, last: int):
+        """Remove the rows from `first` to `last` (inclusive)"""
+        self._circles[first:self._count - (last - first + 1)] = self._circles[last + 1:self._count]
+        self._count -= last - first + 1
+        self._tree = None
+        self._ntree = 0
+
+    def _update(self, nqueries: int = 1, force: bool = False):
+        # merge the tail into the tree if searching it by brute force became too expensive
+        tail = self._count - self._ntree
+        if (force and tail) or tail > self.maxtail or tail * nqueries > self.maxtail * 1024:
+            # imported only when first needed: scipy.spatial takes long to import
+            from scipy.spatial import cKDTree
+            self._ntree = self._count
+            self._tree = cKDTree(self._circles[:self._ntree, :2]) if self._ntree else None
+            self._maxdiameter = float(np.nanmax(self._circles[:self._count, 2], initial=0))
+
+    def _neighbours(self, points: np.ndarray, radii: np.ndarray) -> List[np.ndarray]:
+        """Indices of the circles with centres not farther than `radii` from each point"""
+        self._update(len(points))
+        if self._tree is not None:
+            found = self._tree.query_ball_point(points, radii)
+        else:
+            found = [[]] * len(points)
+        tail = self._circles[self._ntree:self._count, :2]
+        distances = np.hypot(points[:, np.newaxis, 0] - tail[np.newaxis, :, 0],
+                             points[:, np.newaxis, 1] - tail[np.newaxis, :, 1])
+        tailhits = distances <= radii[:, np.newaxis]
+        return [np.concatenate([np.asarray(f, dtype=np.intp), self._ntree + np.flatnonzero(t)])
+                for f, t in zip(found, tailhits)]
+
+    def circleAt(self, x: float, y: float, frame: int = 0) -> Optional[int]:
+        """The circle of a frame containing the point (the one with the nearest centre if there are more), or None"""
+        if not self._count:
+            return None
+        candidates = self._neighbours(np.array([[x, y]]), np.array([self._maxdiameter / 2]))[0]
+        circles = self._circles[candidates]
+        distances = np.hypot(circles[:, 0] - x, circles[:, 1] - y)
+        inside = (distances <= circles[:, 2] / 2) & (circles[:, 3] == frame)
+        if not inside.any():
+            return None
+        return int(candidates[inside][np.argmin(distances[inside])])
+
+    def overlaps(self, circles: np.ndarray, tolerance: float = DUPLICATE_TOLERANCE) -> np.ndarray:
+        """For each circle, the index of an indexed circle duplicating it (the first one), or -1"""
+        circles = withFrames(circles)
+        result = np.full(len(circles), -1, dtype=np.intp)
+        if not self._count or not len(circles):
+            return result
+        radii = tolerance * (circles[:, 2] + self._maxdiameter) / 2
+        for i, (circle, candidates) in enumerate(zip(circles, self._neighbours(circles[:, :2], radii))):
+            others = self._circles[candidates]
+            duplicate = (np.hypot(others[:, 0] - circle[0], others[:, 1] - circle[1]) < tolerance * (
+                    others[:, 2] + circle[2]) / 2) & (others[:, 3] == circle[3])
+            if duplicate.any():
+                result[i] = candidates[duplicate].min()
+        return result
+
+    def duplicates(self, tolerance: float = DUPLICATE_TOLERANCE) -> List[int]:
+        """Rows to be removed so that no two remaining circles are duplicates. The first of the duplicates is kept."""
+        self._update(force=True)
+        if self._tree is None:
+            return []
+        pairs = self._tree.query_pairs(tolerance * self._maxdiameter, output_type='ndarray')
+        if not len(pairs):
+            return []
+        pairs.sort(axis=1)
+        first, second = self._circles[pairs[:, 0]], self._circles[pairs[:, 1]]
+        duplicate = (np.hypot(first[:, 0] - second[:, 0], first[:, 1] - second[:, 1]) < tolerance * (
+                first[:, 2] + second[:, 2]) / 2) & (first[:, 3] == second[:, 3])
+        pairs = pairs[duplicate]
+        # go through the pairs in the order of the circles: a circle is removed if it duplicates an earlier one
+        # which is itself kept
+        pairs = pairs[np.lexsort((pairs[:, 0], pairs[:, 1]))]
+        removed = set()
+        for i, j in pairs.tolist():
+            if i not in removed:
+                removed.add(j)
+        return sorted(removed)
+
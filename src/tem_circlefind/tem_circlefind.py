@@ -1,28 +1,60 @@
+import importlib.metadata
+import importlib.resources
 import os
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Optional
 
 import numpy as np
 from PyQt5 import QtGui, QtCore, QtWidgets
-from PyQt5.uic import loadUiType
-import PIL.Image
 from matplotlib.backends.backend_qt5agg import FigureCanvasQTAgg, NavigationToolbar2QT
 from matplotlib.figure import Figure
-from matplotlib.widgets import MultiCursor
-from pkg_resources import get_distribution, resource_filename
 
+from .commands import AppendClickCommand, AppendResultsCommand, ClearClicksCommand, ClearResultsCommand, \
+    PopClicksCommand, RemoveResultsCommand, SetPixelSizeCommand
+from .display import CONTRAST_MODES
+from .geometry import distances, fitCircleGeometric, threePointCircles, twoPointCircles
+from .histogram import IncrementalHistogram
+from .imageloader import ImageLoader
+from .imagesource import siblingImages
+from .imageview import PyramidImageView
+from .journal import Journal, replay
+from .overlay import CircleOverlay
 from .pendingclicksmodel import PendingClicksModel
+from . import profiling
+from .project import PROJECT_EXTENSION, Project
+from .resultsfile import BINARY_EXTENSION, BinaryResultsWriter, diameterStatistics, readResults, saveText, \
+    toPixels, withFrames
 from .resultsmodel import ResultsModel
+from .spatialindex import CircleIndex
 
-# try to load the pre-compiled UI
-try:
-    from .tem_circlefind_ui import Ui_TEMCircleFind
+# Modules needed only for some operations (circle detection and edge snapping, which import scipy.ndimage) are imported
+# when first used, to keep the startup fast.
 
-    raise ImportError
-except ImportError:
-    Ui_TEMCircleFind, baseclass = loadUiType(resource_filename('tem_circlefind', 'tem_circlefind.ui'))
+
+def _uiClass() -> type:
+    """The UI class pre-compiled by setup.py, or if it is missing or older than the .ui file, the one parsed from it"""
+    with importlib.resources.as_file(importlib.resources.files('tem_circlefind') / 'tem_circlefind.ui') as uifile:
+        try:
+            from . import tem_circlefind_ui
+            if os.path.getmtime(tem_circlefind_ui.__file__) >= os.path.getmtime(uifile):
+                return tem_circlefind_ui.Ui_TEMCircleFind
+        except (ImportError, OSError):
+            pass
+        from PyQt5.uic import loadUiType
+        uiclass, baseclass = loadUiType(str(uifile))
     assert baseclass == QtWidgets.QWidget
+    return uiclass
+
+
+Ui_TEMCircleFind = _uiClass()
 
 
 class TEMCircleFind(QtWidgets.QWidget, Ui_TEMCircleFind):
+    # emitted from the writer thread of the journal: delivered to the GUI thread through a queued connection
+    journalFailed = QtCore.pyqtSignal(str)
+    # emitted from the circle detection thread with the image and frame searched, and the future of the result
+    detectionFinished = QtCore.pyqtSignal(object, object)
+
     def __init__(self):
         super().__init__()
         self.setupUi(self)
@@ -42,29 +74,41 @@ class TEMCircleFind(QtWidgets.QWidget, Ui_TEMCircleFind):
         #        self.ysliceaxes.xaxis.set_visible(False)
         #        self.axes_horizsection = self.fig.add_subplot()
         self.fig.tight_layout()
+        self.imageview = PyramidImageView(self.axes, cmap='gray', interpolation='nearest')
+        self.contrastComboBox.currentIndexChanged.connect(self.displaySettingsChanged)
+        for spinbox in [self.lowPercentileSpinBox, self.highPercentileSpinBox, self.flattenSpinBox,
+                        self.denoiseSpinBox]:
+            spinbox.valueChanged.connect(self.displaySettingsChanged)
+        self.flattenCheckBox.toggled.connect(self.displaySettingsChanged)
+        self.denoiseCheckBox.toggled.connect(self.displaySettingsChanged)
+        self.displaySettingsChanged()
+        self.overlay = CircleOverlay(self.axes)
         self.canvas.draw()
         self.canvas.mpl_connect('button_press_event', self.canvasButtonPress)
         assert isinstance(self.figLayout, QtWidgets.QVBoxLayout)
         self.figLayout.addWidget(self.canvas, stretch=1)
         self.figLayout.addWidget(self.toolbar)
-        self.fighistogram = Figure()
-        self.canvashistogram = FigureCanvasQTAgg(self.fighistogram)
-        self.toolbarhistogram = NavigationToolbar2QT(self.canvashistogram, self)
-        self.axeshistogram = self.fighistogram.add_subplot(1, 1, 1)
-        self.axeshistogram.set_xlabel('Diameter (nm)')
-        self.fighistogram.tight_layout()
-        self.histogramVerticalLayout.addWidget(self.canvashistogram)
-        self.histogramVerticalLayout.addWidget(self.toolbarhistogram)
+        self.histogram = IncrementalHistogram(self.nHistogramBinsSpinBox.value())
+        # the histogram figure is created when the histogram tab is first shown
+        self.canvashistogram = None
+        self.tabWidget.currentChanged.connect(self.tabChanged)
         assert isinstance(self.browseInputButton, QtWidgets.QPushButton)
         self.browseInputButton.clicked.connect(self.browseInputFile)
         assert isinstance(self.inputLineEdit, QtWidgets.QLineEdit)
         self.inputLineEdit.returnPressed.connect(self.loadImage)
+        self.nextImageButton.clicked.connect(self.nextImage)
+        self.previousImageButton.clicked.connect(self.previousImage)
+        self.imageLoader = ImageLoader(self)
+        self.imageLoader.imageLoaded.connect(self.onImageLoaded)
+        self.imageLoader.loadFailed.connect(self.onImageLoadFailed)
         assert isinstance(self.circlediameterRadioButton, QtWidgets.QRadioButton)
         assert isinstance(self.threepointsRadioButton, QtWidgets.QRadioButton)
         assert isinstance(self.calibrationRadioButton, QtWidgets.QRadioButton)
         self.circlediameterRadioButton.toggled.connect(self.radioButtonToggled)
         self.threepointsRadioButton.toggled.connect(self.radioButtonToggled)
         self.calibrationRadioButton.toggled.connect(self.radioButtonToggled)
+        self.npointRadioButton.toggled.connect(self.radioButtonToggled)
+        self.fitCirclePushButton.clicked.connect(self.fitCircle)
         assert isinstance(self.forgetPushButton, QtWidgets.QPushButton)
         self.forgetPushButton.clicked.connect(self.forgetPendingClicks)
         assert isinstance(self.clearresultsPushButton, QtWidgets.QPushButton)
@@ -74,31 +118,210 @@ class TEMCircleFind(QtWidgets.QWidget, Ui_TEMCircleFind):
         assert isinstance(self.clicktargetoperationBox, QtWidgets.QGroupBox)
         self.clicktargetoperationBox.toggled.connect(self.collectclicksToggled)
         self.removeselectedPushButton.clicked.connect(self.removeSelected)
-        self.replotPushButton.clicked.connect(self.replotImage)
+        # not connected directly: the decorated method would get the 'checked' argument of the signal
+        self.replotPushButton.clicked.connect(lambda: self.replotImage())
         self.loadResultsPushButton.clicked.connect(self.loadResults)
+        self.detectPushButton.clicked.connect(self.detectCircles)
+        # queued even if the detection has finished before its callback is added, in the GUI thread
+        self.detectionFinished.connect(self.onDetectionFinished, QtCore.Qt.QueuedConnection)
+        # the Hough transform takes seconds on large images: not in the GUI thread
+        self._detectionExecutor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='detection')
+        self.removeDuplicatesPushButton.clicked.connect(self.removeDuplicates)
+        self.project = None
+        self.newProjectPushButton.clicked.connect(self.newProject)
+        self.openProjectPushButton.clicked.connect(self.openProject)
+        self.saveProjectPushButton.clicked.connect(self.saveProject)
+        self.addProjectImagesPushButton.clicked.connect(self.addProjectImages)
+        self.removeProjectImagesPushButton.clicked.connect(self.removeProjectImages)
+        self.projectTreeWidget.itemDoubleClicked.connect(self.projectItemDoubleClicked)
+        self.projectHistogramCheckBox.toggled.connect(self.projectHistogramToggled)
+        self.timingCheckBox.setChecked(profiling.isEnabled())
+        self.timingCheckBox.toggled.connect(self.timingToggled)
+        self.resetTimingsPushButton.clicked.connect(self.resetTimings)
+        self.cProfileCheckBox.setChecked(profiling.isProfiling())
+        self.cProfileCheckBox.toggled.connect(self.cProfileToggled)
+        self._performanceTimer = QtCore.QTimer(self)
+        self._performanceTimer.setInterval(1000)
+        self._performanceTimer.timeout.connect(self.refreshPerformanceView)
+        if profiling.isEnabled():
+            self._performanceTimer.start()
         self.filename = None
-        self._point_markers = []
+        self.edgeSnapper = None
+        # the frame of an image stack shown (0 for single images)
+        self.frame = 0
+        self.frameWidget.hide()
+        self.frameSlider.valueChanged.connect(self.frameSpinBox.setValue)
+        self.frameSpinBox.valueChanged.connect(self.frameSlider.setValue)
+        # when scrubbing through a stack faster than the frames can be shown, only the last one requested is shown
+        self._frameTimer = QtCore.QTimer(self)
+        self._frameTimer.setSingleShot(True)
+        self._frameTimer.setInterval(0)
+        self._frameTimer.timeout.connect(self.showFrame)
+        # not connected directly: the value would be taken for the interval of the timer
+        self.frameSpinBox.valueChanged.connect(lambda: self._frameTimer.start())
+        self.frameStatisticsCheckBox.toggled.connect(self.frameStatisticsToggled)
         self._active_toolbuttons = []
-        self.resultsModel = ResultsModel()
+        # the results are stored in pixels, their physical units follow the pixel size
+        self.resultsModel = ResultsModel(pixelsize=self.pixelsizeSpinBox.value())
+        # the exact pixel size is that of the model, the spin box shows it rounded to its decimals. Typed values are
+        # taken when the editing is finished, not at every keystroke.
+        self.pixelsizeSpinBox.setKeyboardTracking(False)
+        self.pixelsizeSpinBox.valueChanged.connect(self.pixelSizeEdited)
+        self.resultsModel.pixelSizeChanged.connect(self.showPixelSize)
         self.resultsTreeView.setModel(self.resultsModel)
+        self.resultsModel.rowsInserted.connect(self.onResultsInserted)
+        self.resultsModel.rowsRemoved.connect(self.onResultsChanged)
+        self.resultsModel.modelReset.connect(self.onResultsChanged)
+        # histogram and statistics are refreshed at most once in every 50 ms, bursts of changes cost a single repaint
+        self._statisticsTimer = QtCore.QTimer(self)
+        self._statisticsTimer.setSingleShot(True)
+        self._statisticsTimer.setInterval(50)
+        self._statisticsTimer.timeout.connect(self.updateStatistics)
+        self.resultsModel.rowsInserted.connect(self.histogramInserted)
+        self.resultsModel.rowsAboutToBeRemoved.connect(self.histogramAboutToBeRemoved)
+        self.resultsModel.rowsRemoved.connect(self.scheduleStatisticsUpdate)
+        self.resultsModel.modelReset.connect(self.histogram.invalidate)
+        self.resultsModel.modelReset.connect(self.scheduleStatisticsUpdate)
+        self.resultsModel.pixelSizeChanged.connect(self.onPixelSizeChanged)
+        self.circleIndex = CircleIndex()
+        self.resultsModel.rowsInserted.connect(self.circleIndexInserted)
+        self.resultsModel.rowsRemoved.connect(self.circleIndexRemoved)
+        self.resultsModel.modelReset.connect(self.circleIndexReset)
+        self._resultsWriter = None
+        self.resultsModel.rowsInserted.connect(self.autosaveInserted)
+        self.resultsModel.rowsRemoved.connect(self.autosaveRewrite)
+        self.resultsModel.modelReset.connect(self.autosaveRewrite)
+        # the physical units of all rows change with the pixel size
+        self.resultsModel.pixelSizeChanged.connect(self.autosaveRewrite)
         self.pendingClicksModel = PendingClicksModel()
         self.clicksTreeView.setModel(self.pendingClicksModel)
+        self.pendingClicksModel.rowsInserted.connect(self.onPendingClicksChanged)
+        self.pendingClicksModel.rowsRemoved.connect(self.onPendingClicksChanged)
+        self.pendingClicksModel.modelReset.connect(self.onPendingClicksChanged)
+        # changes of the results, the pending clicks and the calibration made in the GUI go through the undo stack
+        self.undoStack = QtWidgets.QUndoStack(self)
+        self.undoAction = self.undoStack.createUndoAction(self, 'Undo')
+        self.undoAction.setShortcut(QtGui.QKeySequence.Undo)
+        self.undoAction.setIcon(QtGui.QIcon.fromTheme(
+            'edit-undo', self.style().standardIcon(QtWidgets.QStyle.SP_ArrowBack)))
+        self.redoAction = self.undoStack.createRedoAction(self, 'Redo')
+        self.redoAction.setShortcut(QtGui.QKeySequence.Redo)
+        self.redoAction.setIcon(QtGui.QIcon.fromTheme(
+            'edit-redo', self.style().standardIcon(QtWidgets.QStyle.SP_ArrowForward)))
+        self.addActions([self.undoAction, self.redoAction])
+        self.undoToolButton.setDefaultAction(self.undoAction)
+        self.redoToolButton.setDefaultAction(self.redoAction)
         self.clicktargetoperationBox.setChecked(False)
-        self.nHistogramBinsSpinBox.valueChanged.connect(self.drawHistogram)
-        self.setWindowTitle('TEM Circle Finder v{}'.format(get_distribution('tem_circlefind').version))
+        self.nHistogramBinsSpinBox.valueChanged.connect(self.histogramBinsChanged)
+        self.journal = None
+        self.restoreSession()
+        self.setWindowTitle('TEM Circle Finder v{}'.format(importlib.metadata.version('tem_circlefind')))
         self.show()
 
+    def statisticsFrame(self) -> Optional[int]:
+        """The frame the statistics of the results are restricted to, or None for all frames"""
+        return self.frame if self.frameStatisticsCheckBox.isChecked() else None
+
+    def projectHistogramShown(self) -> bool:
+        return self.project is not None and self.projectHistogramCheckBox.isChecked()
+
+    def histogramData(self) -> np.ndarray:
+        if self.projectHistogramShown():
+            return self.project.diameters(self.resultsModel.getData())
+        return self.resultsModel.getDiameters(self.statisticsFrame())
+
+    def histogramRows(self, first: int, last: int) -> np.ndarray:
+        """Diameters in the given rows of the results which are counted in the histogram"""
+        rows = self.resultsModel.getData()[first:last + 1]
+        if self.statisticsFrame() is not None and not self.projectHistogramShown():
+            rows = rows[rows[:, 3] == self.frame]
+        return rows[:, 2]
+
+    def tabChanged(self, index: int):
+        if index == self.tabWidget.indexOf(self.tab) and self.canvashistogram is None:
+            self.setupHistogramFigure()
+            self.drawHistogram()
+
+    def setupHistogramFigure(self):
+        if self.canvashistogram is not None:
+            return
+        self.fighistogram = Figure()
+        self.canvashistogram = FigureCanvasQTAgg(self.fighistogram)
+        self.toolbarhistogram = NavigationToolbar2QT(self.canvashistogram, self)
+        self.axeshistogram = self.fighistogram.add_subplot(1, 1, 1)
+        self.axeshistogram.set_xlabel('Diameter (nm)')
+        counts, edges = self.histogram.update(self.histogramData())
+        # a single, persistent artist: only its data is updated afterwards
+        self.histogramArtist = self.axeshistogram.stairs(counts, edges, fill=True)
+        self.fighistogram.tight_layout()
+        self.histogramVerticalLayout.addWidget(self.canvashistogram)
+        self.histogramVerticalLayout.addWidget(self.toolbarhistogram)
+
+    @profiling.timed()
     def drawHistogram(self):
-        self.axeshistogram.clear()
-        self.axeshistogram.hist([d[2] for d in self.resultsModel.getData()], self.nHistogramBinsSpinBox.value())
-        self.canvashistogram.draw()
+        if self.canvashistogram is None:
+            # not shown yet
+            return
+        counts, edges = self.histogram.update(self.histogramData())
+        self.histogramArtist.set_data(counts, edges)
+        self.axeshistogram.set_xlim(edges[0], edges[-1])
+        self.axeshistogram.set_ylim(0, max(counts.max(), 1) * 1.05)
+        self.canvashistogram.draw_idle()
+
+    def histogramBinsChanged(self, nbins: int):
+        self.histogram.setBins(nbins)
+        self.scheduleStatisticsUpdate()
+
+    def projectHistogramToggled(self):
+        self.histogram.invalidate()
+        self.scheduleStatisticsUpdate()
+
+    def frameStatisticsToggled(self):
+        self.histogram.invalidate()
+        self.scheduleStatisticsUpdate()
+
+    def histogramInserted(self, parent: QtCore.QModelIndex, first: int, last: int):
+        self.histogram.add(self.histogramRows(first, last))
+        self.scheduleStatisticsUpdate()
+
+    def histogramAboutToBeRemoved(self, parent: QtCore.QModelIndex, first: int, last: int):
+        self.histogram.remove(self.histogramRows(first, last))
+
+    def onPixelSizeChanged(self):
+        # the circles stay in place on the image (they are drawn in pixels), all diameters are rescaled: the histogram
+        # and the statistics are refreshed together, once
+        self.histogram.invalidate()
+        self.scheduleStatisticsUpdate()
+
+    def scheduleStatisticsUpdate(self):
+        # not restarted if already running: continuous changes still update the display regularly
+        if not self._statisticsTimer.isActive():
+            self._statisticsTimer.start()
+
+    def circleIndexInserted(self, parent: QtCore.QModelIndex, first: int, last: int):
+        if last == self.resultsModel.rowCount() - 1:
+            self.circleIndex.append(self.resultsModel.getPixelData()[first:last + 1])
+        else:
+            # inserted before existing rows (undoing a removal): the row indices have changed
+            self.circleIndex.reset(self.resultsModel.getPixelData())
+
+    def circleIndexRemoved(self, parent: QtCore.QModelIndex, first: int, last: int):
+        self.circleIndex.remove(first, last)
+
+    def circleIndexReset(self):
+        self.circleIndex.reset(self.resultsModel.getPixelData())
+
+    def removeDuplicates(self):
+        rows = self.circleIndex.duplicates()
+        if rows:
+            self.undoStack.push(RemoveResultsCommand(self.resultsModel, rows, 'Remove duplicates'))
+        QtWidgets.QMessageBox.information(self, 'Duplicates removed', f'{len(rows)} duplicate circle(s) removed.')
 
     def removeSelected(self):
         lis = self.resultsTreeView.selectionModel().selectedRows()
-        rows = reversed(sorted({it.row() for it in lis}))
-        for row in rows:
-            self.resultsModel.removeRow(row)
-        self.drawHistogram()
+        if lis:
+            self.undoStack.push(RemoveResultsCommand(self.resultsModel, [it.row() for it in lis],
+                                                     'Remove selected circles'))
 
     def collectclicksToggled(self, newstate: bool):
         if newstate:
@@ -112,29 +335,13 @@ class TEMCircleFind(QtWidgets.QWidget, Ui_TEMCircleFind):
             for c in self._active_toolbuttons:
                 c.click()
             self.toolbar.setEnabled(False)
-            try:
-                self.mpl_cursor.clear(None)
-                self.mpl_cursor.visible = False
-                self.mpl_cursor.set_active(False)
-                del self.mpl_cursor
-            except AttributeError:
-                pass
-            self.mpl_cursor = MultiCursor(self.canvas, axes=[self.axes], horizOn=True, vertOn=True, useblit=True,
-                                          color='r')
-            self.mpl_cursor.clear(None)
+            self.overlay.setCrosshairEnabled(True)
         else:
             for c in self._active_toolbuttons:
                 c.click()
             self._active_toolbuttons = []
             self.toolbar.setEnabled(True)
-            try:
-                self.mpl_cursor.visible = False
-                self.mpl_cursor.clear(None)
-                self.mpl_cursor.set_active(True)
-                del self.mpl_cursor
-                self.canvas.draw()
-            except AttributeError:
-                pass
+            self.overlay.setCrosshairEnabled(False)
 
     def radioButtonToggled(self, newstate: bool):
         if not newstate:
@@ -143,34 +350,310 @@ class TEMCircleFind(QtWidgets.QWidget, Ui_TEMCircleFind):
         self.forgetPendingClicks()
 
     def forgetPendingClicks(self):
-        self.pendingClicksModel.clear()
-        for pm in self._point_markers:
-            try:
-                pm.remove()
-            except ValueError:
-                continue
-        self._point_markers = []
-        self.canvas.draw()
+        if self.pendingClicksModel.rowCount():
+            self.undoStack.push(ClearClicksCommand(self.pendingClicksModel))
+
+    def onPendingClicksChanged(self):
+        points = np.array(self.pendingClicksModel.getData(), dtype=np.float64).reshape(-1, 2)
+        self.overlay.setMarkers(points[:, 0], points[:, 1])
+        self.fitCirclePushButton.setEnabled(self.npointRadioButton.isChecked() and len(points) >= 3)
+
+    def frameCircles(self, rows: np.ndarray) -> np.ndarray:
+        """The circles of the current frame among rows of the results (in pixels)"""
+        return rows[rows[:, 3] == self.frame, :3]
+
+    def onResultsInserted(self, parent: QtCore.QModelIndex, first: int, last: int):
+        circles = self.frameCircles(self.resultsModel.getPixelData()[first:last + 1])
+        if not len(circles):
+            # all on other frames
+            return
+        # blitting is only worth it for a few new circles, bulk insertions need a full redraw anyway
+        blit = len(circles) <= 100
+        self.overlay.addCircles(circles[:, 0], circles[:, 1], circles[:, 2], blit=blit)
+        if not blit:
+            self.canvas.draw_idle()
+
+    def onResultsChanged(self):
+        circles = self.frameCircles(self.resultsModel.getPixelData())
+        self.overlay.setCircles(circles[:, 0], circles[:, 1], circles[:, 2])
+        self.canvas.draw_idle()
+
+    def resultsStatistics(self):
+        return {'mean': self.resultsModel.getMeanDiameter(),
+                'std': self.resultsModel.getStdDiameter(),
+                'min': self.resultsModel.getMinDiameter(),
+                'max': self.resultsModel.getMaxDiameter(),
+                'ptp': self.resultsModel.getPtPDiameter()}
+
+    def pixelSizeEdited(self, pixelsize: float):
+        if pixelsize != self.resultsModel.pixelSize:
+            self.undoStack.push(SetPixelSizeCommand(self.resultsModel, pixelsize, mergeable=True))
+
+    def showPixelSize(self, pixelsize: float):
+        # not fed back: the rounded value of the spin box would replace the exact one
+        self.pixelsizeSpinBox.blockSignals(True)
+        try:
+            self.pixelsizeSpinBox.setValue(pixelsize)
+        finally:
+            self.pixelsizeSpinBox.blockSignals(False)
+
+    def autosaveInserted(self, parent: QtCore.QModelIndex, first: int, last: int):
+        # binary results files are kept up to date after they have been saved: only the new rows are written
+        if self._resultsWriter is None:
+            return
+        if last != self.resultsModel.rowCount() - 1:
+            # inserted before existing rows (undoing a removal)
+            self.autosaveRewrite()
+            return
+        try:
+            self._resultsWriter.append(self.resultsModel.getPixelData()[first:last + 1], self.resultsModel.pixelSize,
+                                       self.resultsStatistics())
+        except Exception as exc:
+            self.autosaveFailed(exc)
+
+    def autosaveRewrite(self):
+        if self._resultsWriter is None:
+            return
+        try:
+            self._resultsWriter.rewrite(self.resultsModel.getPixelData(), self.resultsModel.pixelSize,
+                                        self._resultsWriter.image)
+        except Exception as exc:
+            self.autosaveFailed(exc)
+
+    def autosaveFailed(self, exc: Exception):
+        filename = self._resultsWriter.filename
+        self._resultsWriter.close()
+        self._resultsWriter = None
+        QtWidgets.QMessageBox.critical(self, 'Error', f'Error while updating results file {filename}: {exc}. '
+                                                      f'Automatic saving has been disabled.')
+
+    def journalFileName(self) -> str:
+        dirname = QtCore.QStandardPaths.writableLocation(QtCore.QStandardPaths.AppLocalDataLocation)
+        os.makedirs(dirname, exist_ok=True)
+        return os.path.join(dirname, 'session.journal')
+
+    def restoreSession(self):
+        """Restore the state of the previous session from the journal and start journaling this one"""
+        try:
+            filename = self.journalFileName()
+        except OSError:
+            return
+        self._journalLock = QtCore.QLockFile(filename + '.lock')
+        if not self._journalLock.tryLock(0):
+            # another instance is running: do not touch its journal
+            return
+        state = replay(filename)
+        if state is not None:
+            if state['pixelsize'] is not None and state['pixelsize'] > 0:
+                self.resultsModel.setPixelSize(state['pixelsize'])
+            self.resultsModel.extendPixels(state['results'])
+            for x, y in state['clicks'].tolist():
+                self.pendingClicksModel.append(x, y)
+        self.journal = Journal(filename, onerror=lambda exc: self.journalFailed.emit(str(exc)))
+        self.journalFailed.connect(self.onJournalFailed)
+        self.journal.start(state['image'] if state is not None else None, self.resultsModel.pixelSize,
+                           self.resultsModel.getPixelData(), self.pendingClicksModel.getData())
+        self.resultsModel.rowsInserted.connect(self.journalResultsInserted)
+        self.resultsModel.rowsRemoved.connect(self.journalResultsRemoved)
+        self.resultsModel.modelReset.connect(self.journal.resultsCleared)
+        self.pendingClicksModel.rowsInserted.connect(self.journalClicksInserted)
+        self.pendingClicksModel.rowsRemoved.connect(self.journalClicksRemoved)
+        self.pendingClicksModel.modelReset.connect(self.journal.clicksCleared)
+        self.resultsModel.pixelSizeChanged.connect(self.journal.pixelSizeChanged)
+        if state is not None:
+            if state['image'] is not None and os.path.exists(state['image']):
+                self.loadImage(state['image'])
+
+    def onJournalFailed(self, message: str):
+        QtWidgets.QMessageBox.warning(self, 'Error', f'Error while writing the session journal '
+                                                     f'{self.journal.filename}: {message}. Journaling has been '
+                                                     f'disabled: the session will not be restored after a crash.')
+
+    def journalResultsInserted(self, parent: QtCore.QModelIndex, first: int, last: int):
+        if last == self.resultsModel.rowCount() - 1:
+            self.journal.resultsAppended(self.resultsModel.getPixelData()[first:last + 1])
+        else:
+            self.journal.resultsInserted(first, self.resultsModel.getPixelData()[first:last + 1])
+
+    def journalResultsRemoved(self, parent: QtCore.QModelIndex, first: int, last: int):
+        self.journal.resultsRemoved(first, last)
+
+    def journalClicksInserted(self, parent: QtCore.QModelIndex, first: int, last: int):
+        if last == self.pendingClicksModel.rowCount() - 1:
+            self.journal.clicksAppended(self.pendingClicksModel.getData()[first:last + 1])
+        else:
+            self.journal.clicksInserted(first, self.pendingClicksModel.getData()[first:last + 1])
+
+    def journalClicksRemoved(self, parent: QtCore.QModelIndex, first: int, last: int):
+        self.journal.clicksRemoved(first, last)
+
+    def timingToggled(self, enabled: bool):
+        profiling.setEnabled(enabled)
+        if enabled:
+            self._performanceTimer.start()
+        else:
+            self._performanceTimer.stop()
+        self.refreshPerformanceView()
+
+    def resetTimings(self):
+        profiling.reset()
+        self.refreshPerformanceView()
+
+    def refreshPerformanceView(self):
+        assert isinstance(self.performanceTreeWidget, QtWidgets.QTreeWidget)
+        self.performanceTreeWidget.setSortingEnabled(False)
+        self.performanceTreeWidget.clear()
+        for name, stats in profiling.summary():
+            item = QtWidgets.QTreeWidgetItem()
+            item.setText(0, name)
+            item.setData(1, QtCore.Qt.DisplayRole, stats['calls'])
+            for column, key in enumerate(['mean'] + [f'p{p}' for p in profiling.PERCENTILES] + ['max'], start=2):
+                item.setData(column, QtCore.Qt.DisplayRole, round(stats[key] * 1000, 3))
+            self.performanceTreeWidget.addTopLevelItem(item)
+        self.performanceTreeWidget.setSortingEnabled(True)
+        for column in range(self.performanceTreeWidget.columnCount()):
+            self.performanceTreeWidget.resizeColumnToContents(column)
+
+    def cProfileToggled(self, enabled: bool):
+        if enabled:
+            profiling.startProfiling()
+            return
+        stats = profiling.stopProfiling()
+        if stats is None:
+            return
+        filename, filter_ = QtWidgets.QFileDialog.getSaveFileName(
+            self, 'Save profile data to...', '', 'cProfile statistics (*.prof);;All files (*)')
+        if not filename:
+            return
+        try:
+            stats.dump_stats(filename)
+        except OSError as exc:
+            QtWidgets.QMessageBox.critical(self, 'Error while saving profile data', str(exc))
 
     def closeEvent(self, e: QtGui.QCloseEvent):
+        self.imageLoader.shutdown()
+        self._detectionExecutor.shutdown(wait=False, cancel_futures=True)
+        if self._resultsWriter is not None:
+            self._resultsWriter.close()
+        if self.journal is not None:
+            self.journal.close()
+            self.journal = None
+            self._journalLock.unlock()
         e.accept()
         QtCore.QCoreApplication.instance().quit()
 
+    @profiling.timed()
     def loadImage(self, filename=None):
         assert isinstance(self.inputLineEdit, QtWidgets.QLineEdit)
         if filename is not None:
             self.inputLineEdit.setText(filename)
         self.filename = self.inputLineEdit.text()
+        # decoding happens in a background thread, see onImageLoaded() and onImageLoadFailed()
+        self.imageLoader.load(self.filename)
+
+    @profiling.timed()
+    def onImageLoaded(self, filename: str, source):
+        if filename != self.filename:
+            # the user has already requested another image
+            return
+        self.source = source
+        self.data = self.source.data
+        self.frame = 0
+        if self.pendingClicksModel.frame != 0:
+            # clicked on another frame, as in showFrame()
+            self.pendingClicksModel.setFrame(0)
+        # the controls are reset before the first frame is shown: showFrame() has nothing to do then
+        self.frameSpinBox.setMaximum(source.nframes - 1)
+        self.frameSlider.setMaximum(source.nframes - 1)
+        self.frameSpinBox.setValue(0)
+        self.frameCountLabel.setText('({} frames)'.format(source.nframes))
+        self.frameWidget.setVisible(source.nframes > 1)
+        self.resultsTreeView.setColumnHidden(3, source.nframes == 1)
+        if source.nframes == 1:
+            self.frameStatisticsCheckBox.setChecked(False)
+        self.frameStatisticsCheckBox.setEnabled(source.nframes > 1)
+        if self.statisticsFrame() is not None:
+            self.frameStatisticsToggled()
+        if self.project is not None:
+            self.activateProjectImage(filename)
+        # gradient maps are computed on demand and cached for the current image only
+        from .edgesnap import EdgeSnapper
+        self.edgeSnapper = EdgeSnapper(self.data)
+        if self.journal is not None:
+            # a new journal for the new image, starting from the current state
+            self.journal.start(os.path.abspath(filename), self.resultsModel.pixelSize,
+                               self.resultsModel.getPixelData(), self.pendingClicksModel.getData())
         try:
-            self.data = np.array(PIL.Image.open(self.filename))
             self.replotImage()
         except Exception as exc:
-            mb = QtWidgets.QMessageBox(self)
-            mb.setIcon(QtWidgets.QMessageBox.Critical)
-            mb.setText(f'Error while loading image file: {exc}')
-            mb.setWindowTitle('Error')
-            mb.setWindowModality(True)
-            mb.show()
+            self.onImageLoadFailed(filename, str(exc))
+        self.imageLoader.prefetchFrames(source, [1])
+
+    @profiling.timed()
+    def showFrame(self):
+        """Show the frame of the image stack selected by the frame controls, keeping the zoom"""
+        try:
+            source = self.source
+        except AttributeError:
+            return
+        frame = self.frameSpinBox.value()
+        if frame == self.frame:
+            return
+        try:
+            pyramid = source.frame(frame)
+        except Exception as exc:
+            QtWidgets.QMessageBox.critical(self, 'Error', f'Error while reading frame {frame}: {exc}')
+            return
+        self.frame = frame
+        self.data = pyramid.level(0)
+        from .edgesnap import EdgeSnapper
+        self.edgeSnapper = EdgeSnapper(self.data)
+        # points clicked on another frame do not belong to the particles on this one. Not undoable: changing the frame
+        # is not an edit, and would discard the redo history.
+        self.pendingClicksModel.setFrame(frame)
+        self.imageview.setPyramid(pyramid, keepview=True)
+        circles = self.frameCircles(self.resultsModel.getPixelData())
+        self.overlay.setCircles(circles[:, 0], circles[:, 1], circles[:, 2])
+        self.canvas.draw_idle()
+        if self.statisticsFrame() is not None:
+            self.histogram.invalidate()
+            self.scheduleStatisticsUpdate()
+        # the neighbours are likely to be shown next
+        self.imageLoader.prefetchFrames(source, [frame + 1, frame - 1])
+
+    def onImageLoadFailed(self, filename: str, message: str):
+        if filename != self.filename:
+            return
+        mb = QtWidgets.QMessageBox(self)
+        mb.setIcon(QtWidgets.QMessageBox.Critical)
+        mb.setText(f'Error while loading image file: {message}')
+        mb.setWindowTitle('Error')
+        mb.setWindowModality(True)
+        mb.show()
+
+    def nextImage(self):
+        if self.project is not None and len(self.project):
+            self.stepProjectImage(1)
+        elif self.filename:
+            siblings = siblingImages(self.filename, 1)
+            if siblings:
+                self.loadImage(siblings[0])
+
+    def previousImage(self):
+        if self.project is not None and len(self.project):
+            self.stepProjectImage(-1)
+        elif self.filename:
+            siblings = siblingImages(self.filename, 1)
+            if siblings:
+                self.loadImage(siblings[-1])
+
+    def stepProjectImage(self, step: int):
+        """Show the next (`step` = 1) or previous (-1) image of the project, wrapping around"""
+        index = self.project.index(self.filename) if self.filename else None
+        if index is None:
+            index = self.project.active
+        index = 0 if index is None else (index + step) % len(self.project)
+        self.loadImage(self.project.filenames[index])
 
     def browseInputFile(self):
         filename = QtWidgets.QFileDialog.getOpenFileName(self, 'Open image file')[0]
@@ -183,35 +666,105 @@ class TEMCircleFind(QtWidgets.QWidget, Ui_TEMCircleFind):
         self.loadImage()
 
     def loadResults(self):
-        filename = QtWidgets.QFileDialog.getOpenFileName(self, 'Load previously saved circle data')[0]
+        filename = QtWidgets.QFileDialog.getOpenFileName(
+            self, 'Load previously saved circle data', '',
+            f'Results files (*.txt *{BINARY_EXTENSION});;Text files (*.txt);;Binary results files '
+            f'(*{BINARY_EXTENSION});;All files (*)')[0]
         if not filename:
             return
         else:
             try:
-                data = np.loadtxt(filename)
-            except:
-                QtWidgets.QMessageBox.critical(self, 'Error loading file', 'Malformed file: {}'.format(filename))
+                results = readResults(filename)
+            except (OSError, ValueError) as exc:
+                QtWidgets.QMessageBox.critical(self, 'Error loading file', str(exc))
                 return
-        if data.shape[1] != 3:
-            QtWidgets.QMessageBox.critical(self, 'Error loading file',
-                                           'File {} does not have three columns.'.format(filename))
+        # the circles are placed where they were measured on the image
+        pixels = results['pixels']
+        if pixels is None:
+            # neither the pixels nor the pixel size are known
+            pixels = toPixels(results['data'], self.resultsModel.pixelSize)
+        # circles already measured are not added again
+        duplicates = self.circleIndex.overlaps(pixels) >= 0
+        command = QtWidgets.QUndoCommand('Load results')
+        if not self.resultsModel.rowCount() and results['pixelsize'] is not None and results['pixelsize'] > 0:
+            SetPixelSizeCommand(self.resultsModel, results['pixelsize'], parent=command)
+        if not duplicates.all():
+            # a single bulk insertion
+            AppendResultsCommand(self.resultsModel, pixels[~duplicates], parent=command)
+        if command.childCount():
+            self.undoStack.push(command)
+        if duplicates.any():
+            QtWidgets.QMessageBox.information(
+                self, 'Duplicates skipped', f'{duplicates.sum()} circle(s) duplicating existing ones were not added.')
+
+    def detectCircles(self):
+        try:
+            data = self.data
+        except AttributeError:
             return
-        for i in range(data.shape[0]):
-            self.resultsModel.append(data[i, 0], data[i, 1], data[i, 2])
-        self.replotImage()
-        self.drawHistogram()
-        self.updateStatistics()
+        pixelsize = self.resultsModel.pixelSize
+        from .circledetection import findCircles
+        future = self._detectionExecutor.submit(findCircles, data, self.detectMinDiameterSpinBox.value() / pixelsize,
+                                                self.detectMaxDiameterSpinBox.value() / pixelsize)
+        # enabled again by onDetectionFinished()
+        self.detectPushButton.setEnabled(False)
+        target = (getattr(self, 'source', None), self.frame)
+        future.add_done_callback(lambda f: self.detectionFinished.emit(target, f))
+
+    def onDetectionFinished(self, target: tuple, future: Future):
+        self.detectPushButton.setEnabled(True)
+        if future.cancelled() or target != (getattr(self, 'source', None), self.frame):
+            # another image or frame is shown by now: the circles do not belong to it
+            return
+        try:
+            circles = future.result()
+        except Exception as exc:
+            QtWidgets.QMessageBox.critical(self, 'Error', f'Error while detecting circles: {exc}')
+            return
+        if not len(circles):
+            QtWidgets.QMessageBox.information(self, 'No circles found', 'No circles have been found in this image.')
+            return
+        circles = withFrames(circles, self.frame)
+        # do not add particles already measured
+        circles = circles[self.circleIndex.overlaps(circles) < 0]
+        if not len(circles):
+            QtWidgets.QMessageBox.information(self, 'No new circles', 'All circles found have been measured already.')
+            return
+        self.undoStack.push(AppendResultsCommand(self.resultsModel, circles, 'Detect circles'))
 
+    def displaySettingsChanged(self):
+        contrast = CONTRAST_MODES[self.contrastComboBox.currentIndex()]
+        self.lowPercentileSpinBox.setEnabled(contrast == 'percentile')
+        self.highPercentileSpinBox.setEnabled(contrast == 'percentile')
+        self.flattenSpinBox.setEnabled(self.flattenCheckBox.isChecked())
+        self.denoiseSpinBox.setEnabled(self.denoiseCheckBox.isChecked())
+        self.imageview.setDisplaySettings(
+            contrast=contrast, low=self.lowPercentileSpinBox.value(), high=self.highPercentileSpinBox.value(),
+            flatten=self.flattenSpinBox.value() if self.flattenCheckBox.isChecked() else 0.0,
+            denoise=self.denoiseSpinBox.value() if self.denoiseCheckBox.isChecked() else 0.0)
+        self.canvas.draw_idle()
+
+    @profiling.timed()
     def replotImage(self):
-        self.axes.clear()
-        self.axes.imshow(self.data, cmap='gray', interpolation='nearest')
-        for x, y, diameter in self.resultsModel.getData():
-            self.drawcircle(x, y, diameter * 0.5, silent=True)
-        self.canvas.draw()
+        try:
+            source = self.source
+        except AttributeError:
+            return
+        # the image artist is reused instead of clearing the axes: the overlay artists stay in place
+        with profiling.timing('replotImage: imshow'):
+            self.imageview.setPyramid(source.frame(self.frame))
+        circles = self.frameCircles(self.resultsModel.getPixelData())
+        self.overlay.setCircles(circles[:, 0], circles[:, 1], circles[:, 2])
+        with profiling.timing('replotImage: canvas.draw'):
+            self.canvas.draw()
 
+    @profiling.timed()
     def canvasButtonPress(self, event):
         if not self.clicktargetoperationBox.isChecked():
-            print('Not collecting this click')
+            if event.inaxes == self.axes and not self.toolbar.mode:
+                self.circleClicked(event)
+            else:
+                print('Not collecting this click')
             return
         if event.inaxes != self.axes:
             print('Not in this axes')
@@ -221,128 +774,272 @@ class TEMCircleFind(QtWidgets.QWidget, Ui_TEMCircleFind):
             return
         x = event.xdata
         y = event.ydata
-        self.pendingClicksModel.append(x, y)
-        self._point_markers.extend(self.axes.plot(event.xdata, event.ydata, 'ro', scalex=False, scaley=False))
-        self.canvas.draw()
-        self.processWaitingClicks()
+        if self.snapCheckBox.isChecked() and self.edgeSnapper is not None:
+            x, y = self.edgeSnapper.snap(x, y, self.snapWindowSpinBox.value())
+        # a click and the circle or calibration it completes are undone together
+        self.undoStack.beginMacro('Click')
+        try:
+            self.undoStack.push(AppendClickCommand(self.pendingClicksModel, x, y))
+            self.processWaitingClicks()
+        finally:
+            self.undoStack.endMacro()
+
+    def circleClicked(self, event):
+        """Select (left button) or delete (right button) the circle under the cursor"""
+        row = self.circleIndex.circleAt(event.xdata, event.ydata, self.frame)
+        if row is None:
+            return
+        if event.button == 1:
+            index = self.resultsModel.index(row, 0, QtCore.QModelIndex())
+            self.resultsTreeView.selectionModel().select(
+                index, QtCore.QItemSelectionModel.ClearAndSelect | QtCore.QItemSelectionModel.Rows)
+            self.resultsTreeView.scrollTo(index)
+        elif event.button == 3:
+            self.undoStack.push(RemoveResultsCommand(self.resultsModel, [row], 'Remove circle'))
+
+    def popClicks(self, number: int) -> list:
+        """Take the first `number` pending clicks (undoably). Raises ValueError if there are not enough."""
+        if self.pendingClicksModel.rowCount() < number:
+            raise ValueError('Not enough clicks waiting')
+        command = PopClicksCommand(self.pendingClicksModel, number)
+        self.undoStack.push(command)
+        return command.points
 
+    @profiling.timed()
     def processWaitingClicks(self):
-        radius = xcen = ycen = None
+        circle = None
         if self.calibrationRadioButton.isChecked():
             try:
-                points = self.pendingClicksModel.pop(2)
+                points = self.popClicks(2)
             except ValueError:
                 return
-            pixsize = float(self.calibrationSpinBox.value()) / (
-                    (points[0][0] - points[1][0]) ** 2 + (
-                    points[0][1] - points[1][1]) ** 2) ** 0.5
-            assert isinstance(self.pixelsizeSpinBox, QtWidgets.QDoubleSpinBox)
-            self.pixelsizeSpinBox.setValue(pixsize)
-            for i in range(2):
-                try:
-                    self._point_markers.pop(0).remove()
-                except ValueError:
-                    pass
-            self._point_markers = self._point_markers[2:]
-            self.canvas.draw()
+            distance = distances(np.array(points))
+            if not (np.isfinite(distance) and distance > 0):
+                # the clicks are dropped, as those of a degenerate circle
+                QtWidgets.QMessageBox.warning(self, 'Degenerate calibration',
+                                              'Cannot calibrate the pixel size from coincident points.')
+                return
+            pixsize = float(self.calibrationSpinBox.value()) / distance
+            self.undoStack.push(SetPixelSizeCommand(self.resultsModel, pixsize, 'Calibrate pixel size'))
         elif self.circlediameterRadioButton.isChecked():
             try:
-                points = self.pendingClicksModel.pop(2)
+                points = self.popClicks(2)
             except ValueError:
                 return
-            xcen = 0.5 * (points[0][0] + points[1][0]) * self.pixelsizeSpinBox.value()
-            ycen = 0.5 * (points[0][1] + points[1][1]) * self.pixelsizeSpinBox.value()
-            radius = self.pixelsizeSpinBox.value() * 0.5 * (
-                    (points[0][0] - points[1][0]) ** 2 + (points[0][1] - points[1][1]) ** 2) ** 0.5
-            for i in range(2):
-                try:
-                    self._point_markers.pop(0).remove()
-                except ValueError:
-                    pass
-            self._point_markers = self._point_markers[2:]
-            self.canvas.draw()
+            circle = twoPointCircles(np.array(points))
         elif self.threepointsRadioButton.isChecked():
-            # the center of the circumscribed circle.
+            # the circumscribed circle.
             try:
-                points = self.pendingClicksModel.pop(3)
+                points = self.popClicks(3)
             except ValueError:
                 return
-            ax = points[0][0]
-            ay = points[0][1]
-            bx = points[1][0]
-            by = points[1][1]
-            cx = points[2][0]
-            cy = points[2][1]
-            d = 2 * (ax * (by - cy) + bx * (cy - ay) + cx * (ay - by))
-            xcen = ((ay ** 2 + ax ** 2) * (by - cy) + (by ** 2 + bx ** 2) * (cy - ay) + (cy ** 2 + cx ** 2) * (
-                    ay - by)) / d
-            ycen = ((ay ** 2 + ax ** 2) * (cx - bx) + (by ** 2 + bx ** 2) * (ax - cx) + (cy ** 2 + cx ** 2) * (
-                    bx - ax)) / d
-            a = ((by - cy) ** 2 + (bx - cx) ** 2) ** 0.5
-            b = ((cy - ay) ** 2 + (cx - ax) ** 2) ** 0.5
-            c = ((by - ay) ** 2 + (bx - ax) ** 2) ** 0.5
-            s = (a + b + c) * 0.5
-            radius = 0.25 * a * b * c / (s * (s - a) * (s - b) * (s - c)) ** 0.5
-            xcen *= self.pixelsizeSpinBox.value()
-            ycen *= self.pixelsizeSpinBox.value()
-            radius *= self.pixelsizeSpinBox.value()
-            for i in range(3):
-                try:
-                    self._point_markers.pop(0).remove()
-                except ValueError:
-                    continue
-            self._point_markers = self._point_markers[3:]
-            self.canvas.draw()
+            circle = threePointCircles(np.array(points))
         else:
-            # do nothing
+            # N-point fit is triggered by fitCircle()
             pass
-        if radius is not None:
-            assert (xcen is not None) and (ycen is not None)
-            self.resultsModel.append(xcen, ycen, 2 * radius)
-            self.drawcircle(xcen, ycen, radius)
-            self.drawHistogram()
-            self.updateStatistics()
+        if circle is not None:
+            self.addCircle(circle)
+
+    def fitCircle(self):
+        if self.pendingClicksModel.rowCount() < 3:
+            return
+        self.undoStack.beginMacro('Fit circle')
+        try:
+            points = self.popClicks(self.pendingClicksModel.rowCount())
+            self.addCircle(fitCircleGeometric(np.array(points)))
+        finally:
+            self.undoStack.endMacro()
+
+    def addCircle(self, circle: np.ndarray):
+        """Add a circle given in pixel units to the results"""
+        if not np.isfinite(circle).all():
+            QtWidgets.QMessageBox.warning(self, 'Degenerate circle',
+                                          'Cannot determine a circle from collinear or coincident points.')
+            return
+        xcen, ycen, diameter = circle
+        duplicate = self.circleIndex.overlaps(np.array([xcen, ycen, diameter, self.frame]))[0]
+        if duplicate >= 0:
+            self.overlapWarningLabel.setText(f'Warning: the new circle overlaps circle #{duplicate + 1}')
+        else:
+            self.overlapWarningLabel.clear()
+        self.undoStack.push(AppendResultsCommand(self.resultsModel, [(xcen, ycen, diameter, self.frame)],
+                                                 'Add circle'))
 
+    @profiling.timed()
     def updateStatistics(self):
-        self.meanDiameterLabel.setText('{:.3f}'.format(self.resultsModel.getMeanDiameter()))
-        self.stdDiameterLabel.setText('{:.3f}'.format(self.resultsModel.getStdDiameter()))
-        self.minDiameterLabel.setText('{:.3f}'.format(self.resultsModel.getMinDiameter()))
-        self.maxDiameterLabel.setText('{:.3f}'.format(self.resultsModel.getMaxDiameter()))
-        self.ptpDiameterLabel.setText('{:.3f}'.format(self.resultsModel.getPtPDiameter()))
-
-    def drawcircle(self, xcen, ycen, radius, silent=False):
-        x = (xcen + np.cos(np.linspace(0, 2 * np.pi, 361)) * radius) / float(self.pixelsizeSpinBox.value())
-        y = (ycen + np.sin(np.linspace(0, 2 * np.pi, 361)) * radius) / float(self.pixelsizeSpinBox.value())
-        self.axes.plot(x, y, 'm-', scalex=False, scaley=False)
-        if not silent:
-            self.canvas.draw()
+        if self.statisticsFrame() is None:
+            stats = self.resultsStatistics()
+        else:
+            stats = diameterStatistics(self.resultsModel.getDiameters(self.statisticsFrame()))
+        self.meanDiameterLabel.setText('{:.3f}'.format(stats['mean']))
+        self.stdDiameterLabel.setText('{:.3f}'.format(stats['std']))
+        self.minDiameterLabel.setText('{:.3f}'.format(stats['min']))
+        self.maxDiameterLabel.setText('{:.3f}'.format(stats['max']))
+        self.ptpDiameterLabel.setText('{:.3f}'.format(stats['ptp']))
+        self.updateProjectStatistics()
+        self.drawHistogram()
 
-    def clearResults(self):
+    def newProject(self):
+        """Start a new project, with the current image and its results"""
+        self.project = Project()
+        if getattr(self, 'source', None) is not None:
+            self.project.setActive(self.project.addImage(self.source.filename, self.resultsModel.pixelSize))
+        self.updateProjectView()
+
+    def openProject(self):
+        filename = QtWidgets.QFileDialog.getOpenFileName(
+            self, 'Open project', '', f'Project files (*{PROJECT_EXTENSION});;All files (*)')[0]
+        if not filename:
+            return
+        try:
+            project = Project.load(filename)
+        except (OSError, ValueError, KeyError) as exc:
+            QtWidgets.QMessageBox.critical(self, 'Error loading project', str(exc))
+            return
+        self.project = project
         self.resultsModel.clear()
-        self.drawHistogram()
+        self.undoStack.clear()
+        active = project.active if project.active is not None else (0 if len(project) else None)
+        project.setActive(None)
+        self.updateProjectView()
+        if active is not None:
+            self.loadImage(project.filenames[active])
+
+    def saveProject(self):
+        if self.project is None:
+            return
+        if self.project.active is not None:
+            self.project.storeResults(self.project.active, self.resultsModel.getData(), self.resultsModel.pixelSize)
+        filename = QtWidgets.QFileDialog.getSaveFileName(
+            self, 'Save project', '', f'Project files (*{PROJECT_EXTENSION});;All files (*)')[0]
+        if not filename:
+            return
+        if not os.path.splitext(filename)[1]:
+            filename += PROJECT_EXTENSION
+        try:
+            self.project.save(filename)
+        except OSError as exc:
+            QtWidgets.QMessageBox.critical(self, 'Error', f'Error while saving project to file {filename}: {exc}')
+
+    def addProjectImages(self):
+        if self.project is None:
+            self.newProject()
+        filenames = QtWidgets.QFileDialog.getOpenFileNames(self, 'Add images to the project')[0]
+        for filename in filenames:
+            self.project.addImage(filename, self.resultsModel.pixelSize)
+        self.updateProjectView()
+
+    def removeProjectImages(self):
+        if self.project is None:
+            return
+        rows = sorted({self.projectTreeWidget.indexOfTopLevelItem(item)
+                       for item in self.projectTreeWidget.selectedItems()}, reverse=True)
+        for row in rows:
+            if row == self.project.active:
+                # the results on display belong to the image being removed
+                self.resultsModel.clear()
+                self.undoStack.clear()
+            self.project.removeImage(row)
+        self.histogram.invalidate()
+        self.updateProjectView()
+        self.scheduleStatisticsUpdate()
+
+    def projectItemDoubleClicked(self, item: QtWidgets.QTreeWidgetItem, column: int):
+        self.loadImage(self.project.filenames[self.projectTreeWidget.indexOfTopLevelItem(item)])
+
+    def activateProjectImage(self, filename: str):
+        """Make an image the active one in the project, showing its results
+
+        Images are only added to the project by newProject() and addProjectImages(): an image outside the project is
+        shown without results of the project.
+        """
+        index = self.project.index(filename)
+        if index == self.project.active:
+            return
+        if self.project.active is not None:
+            self.project.storeResults(self.project.active, self.resultsModel.getData(), self.resultsModel.pixelSize)
+        if self._resultsWriter is not None:
+            # the results file being updated belongs to the previous image
+            self._resultsWriter.close()
+            self._resultsWriter = None
+        self.project.setActive(index)
+        if index is not None:
+            # the pixel size must be set first: it is needed for drawing the circles
+            self.resultsModel.setPixelSize(self.project.pixelsizes[index])
+        self.resultsModel.clear()
+        if index is not None:
+            self.resultsModel.extend(self.project.results[index])
+        # the commands on the undo stack refer to the results of the previous image
+        self.undoStack.clear()
+        # only the pixels of the image on display are kept: the others are read again when they are shown
+        self.imageLoader.clearCache()
+        self.updateProjectView()
+
+    def updateProjectView(self):
+        self.projectTreeWidget.clear()
+        if self.project is None:
+            return
+        for i, filename in enumerate(self.project.filenames):
+            item = QtWidgets.QTreeWidgetItem([os.path.basename(filename), '', '', ''])
+            item.setToolTip(0, filename)
+            self.projectTreeWidget.addTopLevelItem(item)
+            self.updateProjectItem(i)
+        self.updateProjectStatistics()
+
+    def updateProjectItem(self, index: int):
+        item = self.projectTreeWidget.topLevelItem(index)
+        if index == self.project.active:
+            results = self.resultsModel.getData()
+            pixelsize = self.resultsModel.pixelSize
+        else:
+            results = self.project.results[index]
+            pixelsize = self.project.pixelsizes[index]
+        item.setText(1, '{:.5f}'.format(pixelsize))
+        item.setText(2, str(len(results)))
+        item.setText(3, '{:.3f}'.format(results[:, 2].mean()) if len(results) else '--')
+        font = item.font(0)
+        font.setBold(index == self.project.active)
+        item.setFont(0, font)
+
+    def updateProjectStatistics(self):
+        if self.project is None:
+            return
+        if self.project.active is not None:
+            self.updateProjectItem(self.project.active)
+        diameters = self.project.diameters(self.resultsModel.getData())
+        stats = diameterStatistics(diameters)
+        self.projectImagesLabel.setText(str(len(self.project)))
+        self.projectCirclesLabel.setText(str(len(diameters)))
+        self.projectMeanDiameterLabel.setText('{:.3f}'.format(stats['mean']))
+        self.projectStdDiameterLabel.setText('{:.3f}'.format(stats['std']))
+        self.projectMinDiameterLabel.setText('{:.3f}'.format(stats['min']))
+        self.projectMaxDiameterLabel.setText('{:.3f}'.format(stats['max']))
+        self.projectPtPDiameterLabel.setText('{:.3f}'.format(stats['ptp']))
+
+    def clearResults(self):
+        if self.resultsModel.rowCount():
+            self.undoStack.push(ClearResultsCommand(self.resultsModel))
 
     def saveResults(self):
         if self.filename is None:
             dirname = os.path.join(os.getcwd(), 'untitled.txt')
         else:
             dirname = os.path.splitext(self.filename)[0] + '.txt'
-        filename, filter = QtWidgets.QFileDialog.getSaveFileName(self, "Save results to file...", dirname)
+        binaryfilter = f'Binary results files, saved automatically after each change (*{BINARY_EXTENSION})'
+        filename, filter = QtWidgets.QFileDialog.getSaveFileName(
+            self, "Save results to file...", dirname, f'Text files (*.txt);;{binaryfilter};;All files (*)')
         if not filename:
             return
+        if filter == binaryfilter and not filename.lower().endswith(BINARY_EXTENSION):
+            filename += BINARY_EXTENSION
         try:
-            with open(filename, 'wt', encoding='utf-8') as f:
-                f.write(
-                    '# Mean diameter: {:.3f}\n# STD diameter: {:.3f}\n# Min diameter: {:.3f}\n# Max diameter: {:.3f}\n# P-P diameter: {:.3f}\n'.format(
-                        self.resultsModel.getMeanDiameter(),
-                        self.resultsModel.getStdDiameter(),
-                        self.resultsModel.getMinDiameter(),
-                        self.resultsModel.getMaxDiameter(),
-                        self.resultsModel.getPtPDiameter()
-                    ))
-                f.write('# Pixel size: {:.5f}\n'.format(self.pixelsizeSpinBox.value()))
-                data = self.resultsModel.getData()
-                for x, y, diameter in data:
-                    f.write('{:12.6f}\t{:12.6f}\t{:12.6f}\n'.format(x, y, diameter))
+            if filename.lower().endswith(BINARY_EXTENSION):
+                if self._resultsWriter is not None:
+                    self._resultsWriter.close()
+                self._resultsWriter = BinaryResultsWriter(filename, self.resultsModel.getPixelData(),
+                                                          self.resultsModel.pixelSize, self.filename)
+            else:
+                saveText(filename, self.resultsModel.getPixelData(), self.resultsModel.pixelSize)
         except Exception as exc:
             mb = QtWidgets.QMessageBox(self)
             mb.setIcon(QtWidgets.QMessageBox.Critical)